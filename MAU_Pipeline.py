@@ -0,0 +1,594 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pulls 30 day active users for every configured platform into Redshift.
+
+Each entry in PLATFORMS names a Google Analytics profile, the first day of
+its history and the Redshift table and S3 prefix it is loaded into. The
+pipeline authenticates once, fetches ga:30dayUsers by ga:date for all
+platforms in HTTP batch requests, following each platform's pages, stages one
+file per platform and loads every platform's table in a single Redshift
+transaction, swapping rebuilt tables in by renaming them. Only the days after
+the latest one already loaded are fetched, unless --full is given. The Core
+Reporting API v3 is queried, or the Analytics Reporting API v4 if conf2.ini
+says so, see ga_reporting. With --sink local the tables are Parquet files in a
+local lake instead, see lake.py.
+
+Before you begin, you must sigup for a new project in the Google APIs console:
+https://code.google.com/apis/console
+
+Then register the project to use OAuth2.0 for installed applications.
+
+Finally you will need to add the client id, client secret, and redirect URL
+into the client_secrets.json file that is in the same directory as this sample.
+
+Sample Usage:
+
+  $ python MAU_Pipeline.py
+  $ python MAU_Pipeline.py --platform iOS --full
+  $ python MAU_Pipeline.py --plan
+
+Also you can also get help on all the command-line flags the program
+understands by running:
+
+  $ python MAU_Pipeline.py --help
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import datetime
+import sys
+
+import ga_auth
+import metrics
+import schema
+import settings
+from ga_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, ResponseCache, final_cutoff
+from ga_profiles import AmbiguousProfile, ProfileResolver
+from ga_reporting import backend_class, open_backend
+from lake import SINKS, LocalLake
+from object_store import open_store
+from redshift import Loader
+from staging import FORMATS, copy_options, open_parts, part_count, staging_name
+
+# One entry per platform. Its view is the one set under the platform's name in
+# the [GA Profiles] section of conf2.ini, or else the view at the (account,
+# webproperty, profile) list positions in indexes.
+PLATFORMS = [
+    {'name': 'Android', 'indexes': (0, 10, 1), 'start_date': datetime.date(2016, 1, 12),
+     'table': 'Android_MAU', 'prefix': 'Android_MAU/'},
+    {'name': 'iOS', 'indexes': (0, 10, 3), 'start_date': datetime.date(2016, 1, 15),
+     'table': 'iOS_MAU', 'prefix': 'iOS_MAU/'},
+]
+
+# Columns of the staged files, as loaded into the <table>2 staging tables.
+COLUMNS = [('date', 'string'), ('mau', 'int'), ('platform', 'string')]
+
+
+def mau_table(name):
+    """Returns the declared layout of a platform's MAU table.
+
+    One row a day is small enough to copy to every node, so joins with it
+    never redistribute; days are replaced by date, which is the sort key.
+    """
+
+    return schema.Table(name, [
+        schema.Column('date', 'date', 'raw'),
+        schema.Column('mau', 'integer', 'az64'),
+        schema.Column('platform', 'character varying(20)', 'bytedict'),
+    ], diststyle='all', sortkey=('date',))
+
+
+def staging_table(name):
+    """Returns the layout of the table a platform's staged files are COPYed into."""
+
+    return schema.Table(name, [
+        schema.Column('date', 'character varying(10)'),
+        schema.Column('mau', 'integer'),
+        schema.Column('platform', 'character varying(20)'),
+    ])
+
+argparser = argparse.ArgumentParser(add_help=False)
+argparser.add_argument(
+    '--platform', action='append', choices=[platform['name'] for platform in PLATFORMS],
+    help='Only pull this platform. May be repeated; all platforms by default.')
+argparser.add_argument(
+    '--full', action='store_true',
+    help='Refetch the whole MAU history and rebuild the tables from scratch.')
+argparser.add_argument(
+    '--trailing_days', type=int, default=3,
+    help='Days before the latest loaded date to refetch, so late-arriving '
+         'GA data replaces the provisional numbers.')
+argparser.add_argument(
+    '--store', default='s3://bibusuu',
+    help='Bucket URL, or a local directory standing in for it.')
+argparser.add_argument(
+    '--staging_format', choices=FORMATS, default='csv',
+    help='Format of the staged files and of the COPY that loads them.')
+argparser.add_argument(
+    '--copy_parts', type=part_count, default=1,
+    help='Files of about the same size each platform\'s rows are staged as. Set it to the '
+         'cluster\'s slice count (select count(*) from stv_slices) so COPY loads on every slice.')
+argparser.add_argument(
+    '--sink', choices=SINKS, default='redshift',
+    help='Load into the Redshift cluster in conf2.ini, or into Parquet files '
+         'under --lake_dir with a DuckDB catalog over them.')
+argparser.add_argument(
+    '--lake_dir', default='lake',
+    help='Directory of the local lake, with --sink local.')
+argparser.add_argument(
+    '--refresh_profiles', action='store_true',
+    help='List the GA accounts again instead of using the cached listing.')
+argparser.add_argument(
+    '--cache_dir', default=DEFAULT_CACHE_DIR,
+    help='Directory of the local cache of GA responses.')
+argparser.add_argument(
+    '--cache_max_mb', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+    help='Size of the response cache above which the least recently used entries are evicted.')
+argparser.add_argument(
+    '--no_cache', action='store_true',
+    help='Neither read nor write the response cache.')
+argparser.add_argument(
+    '--plan', action='store_true',
+    help='Only print what would be fetched, without authenticating or connecting to Redshift.')
+argparser.add_argument(
+    '--metrics_file', default='ga_pipeline_metrics.jsonl',
+    help='JSON lines file every stage timing and count of the run is appended to.')
+argparser.add_argument(
+    '--prometheus_file',
+    help='Also write the run\'s totals to this file, for the Prometheus node_exporter textfile collector.')
+
+
+def main(argv, platforms=None):
+    """Runs the pipeline.
+
+    Args:
+      argv: The command line.
+      platforms: Names of the platforms to pull, overriding --platform.
+    """
+
+    flags, _ = argparser.parse_known_args(argv[1:])
+    if flags.plan:
+        plan(flags, platforms or flags.platform)
+        return
+
+    from googleapiclient.errors import HttpError
+    from oauth2client.client import AccessTokenRefreshError
+
+    # Authenticate and construct service.
+    with metrics.stage('auth'):
+        service, flags = ga_auth.init(argv, __doc__, __file__, parents=[argparser])
+    metrics.configure(flags.metrics_file, flags.prometheus_file, job='mau')
+
+    # Try to make a request to the API. Print the results or handle errors.
+    try:
+        store = open_store(flags.store, *settings.aws_credentials())
+        loader = connect_sink(flags, store)
+        try:
+            staged = fetch(service, flags, store, loader, platforms or flags.platform)
+            with loader.transaction() as cursor:
+                load(loader, cursor, flags, staged)
+        finally:
+            loader.close()
+
+    except TypeError as error:
+        # Handle errors in constructing a query.
+        print(('There was an error in constructing your query : %s' % error))
+
+    except AmbiguousProfile as error:
+        # Handle ambiguous profile names in conf2.ini.
+        print(('There was an error in the profile configuration : %s' % error))
+
+    except HttpError as error:
+        # Handle API errors.
+        print(('Arg, there was an API error : %s : %s' %
+               (error.resp.status, error._get_reason())))
+
+    except AccessTokenRefreshError:
+        # Handle Auth errors.
+        print('The credentials have been revoked or expired, please re-run '
+              'the application to re-authorize')
+
+    finally:
+        metrics.write_prometheus()
+        metrics.print_summary()
+
+
+def fetch(service, flags, store, loader, names=None, backend=None):
+    """Fetches the MAU of the selected platforms and stages one file per platform.
+
+    Args:
+      service: The service object built by the Google API Python client library.
+      flags: The parsed command line flags.
+      store: The object store to stage the rows in.
+      loader: The redshift.Loader or lake.LocalLake of the run, to find where
+        each sync starts.
+      names: Names of the platforms to pull, all of them by default.
+      backend: The ga_reporting backend to query, opened from service by
+        default.
+
+    Returns:
+      A list of (platform, keys, start_date) tuples of the staged files, to be
+      passed to load().
+    """
+
+    selected = [platform for platform in PLATFORMS if not names or platform['name'] in names]
+    with metrics.stage('profile_discovery'):
+        profile_ids = get_profile_ids(service, selected, flags.refresh_profiles)
+    missing = [platform['name'] for platform in selected if not profile_ids.get(platform['name'])]
+    if missing:
+        print('Could not find a valid profile for %s, skipping it.' % ', '.join(missing))
+        selected = [platform for platform in selected if platform['name'] not in missing]
+    if not selected:
+        return []
+
+    start_dates = {}
+    with loader.transaction() as cursor:
+        for platform in selected:
+            start_dates[platform['name']] = None
+            if not flags.full:
+                start_dates[platform['name']] = get_sync_start_date(loader, cursor, platform, flags.trailing_days)
+
+    # With the cache, every platform's history is split into the days that
+    # are final, which are cached for good, and the recent ones. All queries
+    # go out together in one HTTP batch.
+    backend = backend or open_backend(service)
+    cache = None if flags.no_cache else ResponseCache(flags.cache_dir, flags.cache_max_mb * 1024 * 1024)
+    ranges = {}
+    for platform in selected:
+        start_date = start_dates[platform['name']] or platform['start_date']
+        for i, (first, last) in enumerate(history_ranges(start_date, cache)):
+            ranges[(platform['name'], i)] = (profile_ids[platform['name']], first, last)
+    pages = execute_pages(backend, ranges, cache=cache)
+
+    staged = []
+    for platform in selected:
+        parts = [page for key in sorted(pages) if key[0] == platform['name'] for page in pages[key]]
+        keys = print_results(merge_responses(parts), store, flags.staging_format, platform,
+                             start_dates[platform['name']], flags.copy_parts)
+        if keys:
+            staged.append((platform, keys, start_dates[platform['name']]))
+    return staged
+
+
+def plan(flags, names=None):
+    """Prints what fetch() would query, without authenticating or connecting anywhere.
+
+    Views are looked up in conf2.ini and the cached account listing only,
+    and where an incremental sync starts is only known once Redshift is
+    asked, so the plan gives the rule instead of the date.
+
+    Args:
+      flags: The parsed command line flags.
+      names: Names of the platforms to pull, all of them by default.
+    """
+
+    resolver = ProfileResolver(None)
+    cache = None if flags.no_cache else ResponseCache(flags.cache_dir, flags.cache_max_mb * 1024 * 1024)
+    print('Querying the %s reporting API' % backend_class().name)
+    for platform in PLATFORMS:
+        if names and platform['name'] not in names:
+            continue
+        profile_id = resolver.cached(settings.ga_profile(platform['name']), indexes=platform['indexes'])
+        print('%s: view %s' % (platform['name'], profile_id or 'not in the cached listing, resolved at run time'))
+        if flags.full:
+            ranges = history_ranges(platform['start_date'], cache)
+            print('  Rebuilding %s from %s queries: %s' % (
+                platform['table'], len(ranges), ', '.join('%s to %s' % (first, last) for first, last in ranges)))
+        else:
+            print('  Merging into %s from %s days before its latest date to %s, or its whole history from %s '
+                  'if it is empty' % (platform['table'], flags.trailing_days, datetime.date.today(),
+                                      platform['start_date']))
+    if flags.sink == 'local':
+        print('Loading into the lake at %s' % flags.lake_dir)
+
+
+def history_ranges(start_date, cache=None):
+    """Returns the (first, last) day ranges a history up to today is queried in.
+
+    With a cache, the days that are final get a query of their own, which is
+    cached for good, and the recent ones another.
+    """
+
+    today = datetime.date.today()
+    if cache is not None:
+        cutoff = final_cutoff(cache.final_days, today)
+        if start_date <= cutoff:
+            return [(start_date, cutoff), (cutoff + datetime.timedelta(days=1), today)]
+    return [(start_date, today)]
+
+
+def load(loader, cursor, flags, staged):
+    """Loads the files staged by fetch() into the platforms' tables, without committing.
+
+    Args:
+      loader: The redshift.Loader or, with --sink local, the lake.LocalLake of the run.
+      cursor: A cursor from loader.transaction().
+      flags: The parsed command line flags.
+      staged: As returned by fetch().
+    """
+
+    for platform, keys, start_date in staged:
+        if flags.sink == 'local':
+            load_local(loader, cursor, keys, flags.staging_format, platform, start_date)
+        else:
+            load_platform(loader, cursor, keys, flags.staging_format, platform, start_date)
+
+
+def execute_pages(backend, ranges, limiter=None, cache=None):
+    """Fetches every page of the MAU queries of several date ranges.
+
+    The first pages of all ranges go out together, then the next pages of
+    the ranges that have more, following nextLink and itemsPerPage.
+
+    Args:
+      backend: The ga_reporting backend to query.
+      ranges: A dict of {key: (profile_id, first_day, last_day)}.
+      limiter: Optional TokenBucket.
+      cache: Optional ga_cache.ResponseCache.
+
+    Returns:
+      A dict of {key: [response of each page, in order]}.
+    """
+
+    pages = dict((key, []) for key in ranges)
+    requests = dict(((key, 1), build_query(backend, profile_id, first, last))
+                    for key, (profile_id, first, last) in ranges.items())
+    while requests:
+        responses = backend.execute(requests, limiter, cache=cache)
+        requests = {}
+        for key, start_index in sorted(responses):
+            response = responses.pop((key, start_index))
+            pages[key].append(response)
+            if response.get('nextLink'):
+                profile_id, first, last = ranges[key]
+                next_index = start_index + (response.get('itemsPerPage') or backend.page_size)
+                requests[(key, next_index)] = build_query(backend, profile_id, first, last, next_index)
+    return pages
+
+
+def get_profile_ids(service, platforms, refresh=False):
+    """Resolves each platform's view through the cached account summaries.
+
+    A view ID or name set for the platform in the [GA Profiles] section of
+    conf2.ini takes precedence over the platform's list positions.
+
+    Args:
+      service: The service object built by the Google API Python client library.
+      platforms: Entries of PLATFORMS.
+      refresh: Ignore the cached account summaries.
+
+    Returns:
+      A dict of {platform name: profile ID}. Platforms whose view does not
+      exist are left out.
+    """
+
+    resolver = ProfileResolver(service)
+    if refresh:
+        resolver.refresh()
+
+    profile_ids = {}
+    for platform in platforms:
+        profile_id = resolver.resolve(settings.ga_profile(platform['name']), indexes=platform['indexes'])
+        if profile_id:
+            profile_ids[platform['name']] = profile_id
+    return profile_ids
+
+
+def build_query(backend, profile_id, start_date, end_date=None, start_index=1):
+    """Returns the unexecuted reporting API query of the 30 day active users of every day.
+
+    ga:30dayUsers of a day does not depend on the rest of the date range, so
+    a history can be fetched in parts. end_date defaults to today. Pages are
+    of the backend's page size rather than the API's default of 1,000 rows,
+    and start at start_index.
+    """
+
+    return backend.query(
+        profile_id, start_date, end_date or datetime.date.today(),
+        metrics='ga:30dayUsers',
+        dimensions='ga:date',
+        sort='ga:date',
+        start_index=start_index)
+
+
+def merge_responses(responses):
+    """Returns the first of several responses with the rows of all of them, in order."""
+
+    merged = dict(responses[0])
+    merged['rows'] = [row for response in responses for row in response.get('rows', [])]
+    return merged
+
+
+def connect_redshift(store):
+    """Returns a redshift.Loader for the cluster in conf2.ini that loads from store."""
+
+    conn_string, display = settings.redshift_dsn()
+    print("Connecting to database\n        ->%s" % display)
+    return Loader(conn_string, store, *settings.aws_credentials())
+
+
+def connect_sink(flags, store):
+    """Returns the redshift.Loader, or with --sink local the lake.LocalLake, that loads from store."""
+
+    if flags.sink == 'local':
+        print("Loading into the lake at %s" % flags.lake_dir)
+        return LocalLake(flags.lake_dir, store)
+    return connect_redshift(store)
+
+
+def get_sync_start_date(loader, cursor, platform, trailing_days):
+    """Returns the first day to fetch for an incremental sync.
+
+    The high-water mark is the latest date already loaded into the platform's
+    table; the sync goes back trailing_days from it because GA keeps revising
+    recent days.
+
+    Args:
+      loader: The redshift.Loader or lake.LocalLake of the run.
+      cursor: A cursor from loader.transaction().
+      platform: An entry of PLATFORMS.
+      trailing_days: How many already loaded days to fetch again.
+
+    Returns:
+      A datetime.date, or None when the table is missing or empty and a full
+      reload is needed.
+    """
+
+    if not loader.table_exists(cursor, platform['table']):
+        return None
+
+    cursor.execute("select max(date) from %s;" % platform['table'])
+    latest = cursor.fetchone()[0]
+    if latest is None:
+        return None
+
+    return max(platform['start_date'], latest - datetime.timedelta(days=trailing_days))
+
+
+def print_results(results, store, staging_format, platform, start_date=None, parts=1):
+    """Prints out the results.
+
+    This streams all the rows of data to the store.
+
+    Args:
+      results: The response returned from the reporting API.
+      store: The object store to stage the rows in.
+      staging_format: One of staging.FORMATS.
+      platform: An entry of PLATFORMS.
+      start_date: The first day fetched for an incremental sync, None for a
+        full reload.
+      parts: The largest number of files of about the same size to stage
+        the rows as.
+
+    Returns:
+      The keys of the staged files, empty if there were no rows.
+    """
+
+    name = platform['name']
+    print('Profile Name: %s' % results.get('profileInfo', {}).get('profileName'))
+
+    if not results.get('rows', []):
+        print('No Rows Found for %s' % name)
+        return []
+
+    # Incremental syncs stage under their own prefix so the full history file
+    # is only ever replaced by a full reload.
+    prefix = platform['prefix'] if start_date is None else platform['prefix'].rstrip('/') + '_incremental/'
+    print('Uploading to %s MAU to S3' % name)
+    keys = []
+
+    def open_part(part):
+        keys.append(prefix + staging_name('%s_MAU' % name, staging_format, part, parts))
+        return store.open(keys[-1])
+
+    with open_parts(open_part, parts, staging_format, COLUMNS,
+                    delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL) as spamwriter:
+        spamwriter.writerows(row + [name] for row in results.get('rows'))
+        metrics.add(rows=len(results.get('rows')))
+    return keys
+
+
+def load_platform(loader, cursor, keys, staging_format, platform, start_date=None):
+    """Loads staged files into the platform's table, without committing.
+
+    A full reload builds the table anew and swaps it in; an incremental sync
+    replaces every day from start_date onwards and leaves older history
+    untouched, after rebuilding the table if its layout differs from
+    mau_table(). Either way the table is analyzed after the commit.
+
+    Args:
+      loader: The redshift.Loader of the run.
+      cursor: A cursor from loader.transaction().
+      keys: The keys print_results staged the rows under.
+      staging_format: One of staging.FORMATS.
+      platform: An entry of PLATFORMS.
+      start_date: The first day fetched for an incremental sync, None for a
+        full reload.
+    """
+
+    table = platform['table']
+    # Update the redshift table with the new results
+    print("Deleting old table %s2" % table)
+    cursor.execute("drop table if exists %s2;" % table)
+    print("Creating new table \n %s2 " % table)
+    cursor.execute(staging_table("%s2" % table).create_sql(redshift=loader.is_redshift(cursor)))
+    print("Copying %s data from S3 to  \n %s2 " % (table, table))
+    loader.copy_files(cursor, "%s2" % table, keys, staging_format, copy_options(staging_format, "CSV"))
+
+    declared = mau_table(table)
+    select = "select concat(concat(concat(concat(substring(date,0,5),'-'),substring(date,5,2)),'-'),substring(date,7,2))::DATE as date, mau, platform from %s2" % table
+    if start_date is None:
+        print("Rebuilding Table  \n %s " % table)
+        schema.create(loader, cursor, declared, "%s_new" % table)
+        with metrics.stage('rebuild', table=table):
+            cursor.execute("insert into %s_new (%s) %s;" % (table, declared.column_list(), select))
+        loader.swap(cursor, table, "%s_new" % table)
+    else:
+        schema.ensure(loader, cursor, declared)
+        print("Upserting %s from %s" % (table, start_date))
+        with metrics.stage('merge', table=table):
+            cursor.execute("delete from " + table + " where date >= %s;", (start_date,))
+            cursor.execute("insert into %s (%s) %s;" % (table, declared.column_list(), select))
+            metrics.add(rows=max(cursor.rowcount, 0))
+    # A few hundred rows a run: analyze the table, but a vacuum isn't worth it.
+    loader.maintain(table)
+    print("Dropping table %s2 " % table)
+    cursor.execute("DROP TABLE if exists %s2" % table)
+
+
+def load_local(lake, cursor, keys, staging_format, platform, start_date=None):
+    """Loads staged files into the platform's table in a lake.LocalLake.
+
+    The table is partitioned by month, as a day is a single row. An
+    incremental sync rewrites the months from start_date onwards, keeping
+    their days before start_date; a full reload writes every month and
+    removes the partitions of months no longer in the history.
+
+    Args:
+      lake: The lake.LocalLake of the run.
+      cursor: A cursor from lake.transaction().
+      keys: The keys print_results staged the rows under.
+      staging_format: One of staging.FORMATS.
+      platform: An entry of PLATFORMS.
+      start_date: The first day fetched for an incremental sync, None for a
+        full reload.
+    """
+
+    table = platform['table']
+    with lake.staged(keys, staging_format, COLUMNS, delimiter=',', quotechar='|') as rows:
+        cursor.execute("create or replace temp table %s2 as select strptime(date, '%%Y%%m%%d')::date as date, "
+                       "mau, platform from %s;" % (table, rows))
+    cursor.execute("select distinct strftime(date, '%%Y-%%m') from %s2 order by 1;" % table)
+    months = [row[0] for row in cursor.fetchall()]
+
+    print("Writing %s months of %s" % (len(months), table))
+    for month in months:
+        select = "select date, mau, platform from %s2 where strftime(date, '%%Y-%%m') = '%s'" % (table, month)
+        if start_date is not None:
+            select = ("select date, mau, platform from %s where strftime(date, '%%Y-%%m') = '%s' and date < '%s' "
+                      "union all %s" % (table, month, start_date, select))
+        lake.write_partition(cursor, table, 'month=%s' % month, select + " order by date")
+    if start_date is None:
+        lake.drop_partitions(table, ['month=%s' % month for month in months])
+    lake.refresh_view(cursor, table)
+    cursor.execute("drop table %s2;" % table)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
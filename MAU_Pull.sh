@@ -1,4 +1,2 @@
 cd ~/Google-Analytics-Mobile-MAU-Pull
-python iOS_MAU.py
-python Android_MAU.py
-python Web_Channel_Attribution.py
\ No newline at end of file
+python Nightly_Pull.py
\ No newline at end of file
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the nightly MAU and web channel pulls in one process.
+
+The pulls share one authenticated service, one object store and one Redshift
+loader, and run as a small graph of jobs:
+
+  profiles  -> mau_fetch -> load
+            -> web_fetch ->
+
+profiles refreshes the cached GA account listing if needed and opens the
+reporting backend both fetches share. The two fetches run side by side, and
+load loads everything they staged into Redshift in a single transaction, or
+with --sink local into the lake under --lake_dir. A job that fails or runs
+past --timeout skips the jobs after it. The exit status is non-zero unless
+every job succeeded.
+
+Sample Usage:
+
+  $ python Nightly_Pull.py
+  $ python Nightly_Pull.py --pull web --web_args "--workers 8 --full_reload"
+  $ python Nightly_Pull.py --plan
+
+Also you can also get help on all the command-line flags the program
+understands by running:
+
+  $ python Nightly_Pull.py --help
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shlex
+import sys
+
+import dag
+import ga_auth
+import metrics
+import MAU_Pipeline
+import settings
+import Web_Channel_Attribution
+from ga_profiles import ProfileResolver
+from ga_reporting import open_backend
+from lake import SINKS
+from object_store import open_store
+from staging import FORMATS, part_count
+
+PULLS = ('mau', 'web')
+
+argparser = argparse.ArgumentParser(add_help=False)
+argparser.add_argument(
+    '--pull', action='append', choices=PULLS,
+    help='Only run this pull. May be repeated; all pulls by default.')
+argparser.add_argument(
+    '--timeout', type=float, default=3 * 60 * 60,
+    help='Seconds after which a job is given up on.')
+argparser.add_argument(
+    '--mau_args', default='',
+    help='Extra MAU_Pipeline.py flags, e.g. "--full --platform iOS".')
+argparser.add_argument(
+    '--web_args', default='',
+    help='Extra Web_Channel_Attribution.py flags, e.g. "--workers 8".')
+argparser.add_argument(
+    '--store', default='s3://bibusuu',
+    help='Bucket URL, or a local directory standing in for it.')
+argparser.add_argument(
+    '--staging_format', choices=FORMATS, default='csv',
+    help='Format of the staged files of both pulls.')
+argparser.add_argument(
+    '--copy_parts', type=part_count, default=1,
+    help='Files of about the same size each staged file is split into, for both pulls; '
+         'the cluster\'s slice count.')
+argparser.add_argument(
+    '--sink', choices=SINKS, default='redshift',
+    help='Load both pulls into the Redshift cluster in conf2.ini, or into the local lake under --lake_dir.')
+argparser.add_argument(
+    '--lake_dir', default='lake',
+    help='Directory of the local lake, with --sink local.')
+argparser.add_argument(
+    '--refresh_profiles', action='store_true',
+    help='List the GA accounts again instead of using the cached listing.')
+argparser.add_argument(
+    '--plan', action='store_true',
+    help='Only print what the pulls would fetch, without authenticating or connecting anywhere.')
+argparser.add_argument(
+    '--metrics_file', default='ga_pipeline_metrics.jsonl',
+    help='JSON lines file every stage timing and count of the run is appended to.')
+argparser.add_argument(
+    '--prometheus_file',
+    help='Also write the run\'s totals to this file, for the Prometheus node_exporter textfile collector.')
+
+
+def main(argv):
+    flags, _ = argparser.parse_known_args(argv[1:])
+    if flags.plan:
+        mau_flags, web_flags = pull_flags(flags)
+        if 'mau' in (flags.pull or PULLS):
+            MAU_Pipeline.plan(mau_flags, mau_flags.platform)
+        if 'web' in (flags.pull or PULLS):
+            Web_Channel_Attribution.plan(web_flags)
+        return 0
+
+    # Authenticate and construct service.
+    with metrics.stage('auth'):
+        service, flags = ga_auth.init(argv, __doc__, __file__, parents=[argparser])
+    metrics.configure(flags.metrics_file, flags.prometheus_file, job='nightly')
+
+    mau_flags, web_flags = pull_flags(flags)
+    pulls = flags.pull or PULLS
+
+    store = open_store(flags.store, *settings.aws_credentials())
+    loader = MAU_Pipeline.connect_sink(mau_flags, store)
+    try:
+        # The profile listing is refreshed once here rather than by both
+        # fetches at the same time.
+        jobs = [dag.Job('profiles', lambda inputs: prepare(service, flags.refresh_profiles),
+                        timeout=flags.timeout)]
+        if 'mau' in pulls:
+            jobs.append(dag.Job('mau_fetch', lambda inputs: MAU_Pipeline.fetch(
+                service, mau_flags, store, loader, mau_flags.platform, inputs['profiles']),
+                deps=['profiles'], timeout=flags.timeout))
+        if 'web' in pulls:
+            jobs.append(dag.Job('web_fetch', lambda inputs: Web_Channel_Attribution.fetch(
+                service, web_flags, store, inputs['profiles']), deps=['profiles'], timeout=flags.timeout))
+        jobs.append(dag.Job('load', lambda inputs: load(loader, inputs, mau_flags, web_flags),
+                            deps=[job.name for job in jobs if job.name.endswith('_fetch')], timeout=flags.timeout))
+
+        results = dag.run(jobs)
+        print('Job summary:')
+        succeeded = dag.print_summary(results)
+    finally:
+        metrics.write_prometheus()
+        metrics.print_summary()
+
+    if any(result.status == dag.TIMEOUT for result in results.values()):
+        # An abandoned job's thread would keep the interpreter alive.
+        sys.stdout.flush()
+        os._exit(1)
+    loader.close()
+    return 0 if succeeded else 1
+
+
+def pull_flags(flags):
+    """Returns the parsed flags of MAU_Pipeline and Web_Channel_Attribution.
+
+    The shared flags are set the same for both.
+    """
+
+    shared = ['--store', flags.store, '--staging_format', flags.staging_format,
+              '--copy_parts', '%s' % flags.copy_parts, '--sink', flags.sink, '--lake_dir', flags.lake_dir,
+              '--metrics_file', flags.metrics_file]
+    return (MAU_Pipeline.argparser.parse_args(shared + shlex.split(flags.mau_args)),
+            Web_Channel_Attribution.argparser.parse_args(shared + shlex.split(flags.web_args)))
+
+
+def prepare(service, refresh=False):
+    """Makes sure the cached account listing is there and fresh, and returns the reporting backend.
+
+    Both fetches query through the one backend, so the v4 discovery
+    document is fetched at most once, before they start side by side.
+    """
+
+    with metrics.stage('profile_discovery'):
+        resolver = ProfileResolver(service)
+        if refresh:
+            resolver.refresh()
+        else:
+            resolver.accounts()
+    return open_backend(service)
+
+
+def load(loader, inputs, mau_flags, web_flags):
+    """Loads everything the fetch jobs staged, in one transaction.
+
+    Args:
+      loader: The redshift.Loader or lake.LocalLake of the run.
+      inputs: The return values of the fetch jobs.
+      mau_flags: MAU_Pipeline's parsed flags.
+      web_flags: Web_Channel_Attribution's parsed flags.
+    """
+
+    manifest, days = inputs.get('web_fetch', (None, None))
+    load_web = (manifest is not None and (web_flags.full_reload or days) and
+                not Web_Channel_Attribution.refuse_reload(web_flags, manifest))
+    with loader.transaction() as cursor:
+        if 'mau_fetch' in inputs:
+            MAU_Pipeline.load(loader, cursor, mau_flags, inputs['mau_fetch'])
+        if load_web:
+            Web_Channel_Attribution.load(loader, cursor, web_flags, manifest, days)
+    if load_web:
+        manifest.mark_loaded(None if web_flags.full_reload else days, web_flags.sink)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
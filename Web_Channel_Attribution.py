@@ -37,82 +37,219 @@ from __future__ import print_function
 import argparse
 import sys
 
-from googleapiclient.errors import HttpError
-from googleapiclient import sample_tools
-from oauth2client.client import AccessTokenRefreshError
 from datetime import date, timedelta, datetime
-import csv
-import json
-from subprocess import call, check_output
-import configparser
-import psycopg2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import contextlib
+import itertools
 import os
+import re
+
+import ga_auth
+import metrics
+import schema
+import settings
+from ga_batch import GA_BATCH_LIMIT
+from ga_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, ResponseCache
+from ga_client import (GA_DAILY_REQUESTS_PER_VIEW, GA_MAX_CONCURRENT_REQUESTS, GA_QPS_PER_VIEW, QuotaBudget,
+                       QuotaExhausted, TokenBucket, positive_rate)
+from ga_planner import VolumeHistory, plan_ranges, should_split, split_range
+from ga_profiles import AmbiguousProfile, ProfileResolver
+from ga_reporting import backend_class, open_backend
+from ga_stream import MemoryCeiling, page_rows
+from lake import SINKS, LocalLake
+from manifest import Manifest, list_prefix, range_key
+from object_store import open_store
+from redshift import Loader
+from staging import ESCAPED_TEXT_OPTIONS, FORMATS, copy_options, open_parts, part_count, read_rows, staging_name
 
 __author__ = 'api.nickm@gmail.com (Nick Mihailovski)'
 
-import argparse
-import sys
-
-from googleapiclient.errors import HttpError
-from googleapiclient import sample_tools
-from oauth2client.client import AccessTokenRefreshError
+# Pages are not made smaller than this to stay under --max_memory_mb.
+MIN_PAGE_SIZE = 1000
+
+# The first day of the channel history.
+FIRST_DAY = date(2016, 5, 1)
+
+# The web view is the one set under web in the [GA Profiles] section of
+# conf2.ini, or else the first view of the first property of the first account.
+WEB_PROFILE_INDEXES = (0, 0, 0)
+
+# Key prefix of the daily page files in the store. The files under the old
+# Web_Acquisition_Channel/ prefix hold raw GA rows and can't be COPYed into
+# web_acquisition_channel directly; --migrate_v1 re-stages them under PREFIX.
+PREFIX = 'Web_Acquisition_Channel_v2/'
+OLD_PREFIX = 'Web_Acquisition_Channel/'
+
+# Columns of the staged page files, which are those of web_acquisition_channel.
+COLUMNS = [('date', 'date'), ('source', 'string'), ('medium', 'string'), ('campaign', 'string'),
+           ('social_network', 'string'), ('keyword', 'string'), ('uid', 'int')]
+
+# Both tables are distributed on uid, which the registration query joins
+# bs_users on and partitions its window functions by, so they run on each
+# slice without redistributing rows. Days are replaced by date, so that
+# leads the channel table's sort key, left raw for range restricted scans.
+CHANNEL = schema.Table('web_acquisition_channel', [
+    schema.Column('date', 'date', 'raw'),
+    schema.Column('source', 'character varying(250)', 'zstd'),
+    schema.Column('medium', 'character varying(250)', 'bytedict'),
+    schema.Column('campaign', 'character varying(250)', 'zstd'),
+    schema.Column('social_network', 'character varying(250)', 'bytedict'),
+    schema.Column('keyword', 'character varying(1000)', 'zstd'),
+    schema.Column('uid', 'integer', 'az64'),
+], distkey='uid', sortkey=('date', 'uid'))
+
+REGISTRATION = schema.Table('web_acquisition_channel_registration', [
+    schema.Column('uid', 'integer', 'raw'),
+    schema.Column('source', 'character varying(250)', 'zstd'),
+    schema.Column('medium', 'character varying(250)', 'bytedict'),
+    schema.Column('campaign', 'character varying(250)', 'zstd'),
+    schema.Column('social_network', 'character varying(250)', 'bytedict'),
+    schema.Column('keyword', 'character varying(1000)', 'zstd'),
+], distkey='uid', sortkey=('uid',))
+
+# COPY options of the staged page files. Trailing blanks of the text values
+# are trimmed, as they always were; Parquet files are loaded as they are.
+COPY_OPTIONS = ESCAPED_TEXT_OPTIONS + ' trimblanks'
+
+# The same trim of the string columns, for the local lake.
+TRIMMED_COLUMNS = ', '.join("rtrim(%s, ' ') as %s" % (column.name, column.name)
+                            if column.type.startswith('character') else column.name for column in CHANNEL.columns)
+
+# ga:sourceMedium is split the way the old regexp_substr/replace SQL did it:
+# source is everything up to the last '/', medium everything after the first.
+SOURCE_RE = re.compile(r'^.*/', re.S)
+MEDIUM_RE = re.compile(r'/.*', re.S)
+
+argparser = argparse.ArgumentParser(add_help=False)
+argparser.add_argument(
+    '--workers', type=int, default=4,
+    help='Number of days fetched and uploaded at once, at most %s. '
+         'Use 1 for the serial path.' % GA_MAX_CONCURRENT_REQUESTS)
+argparser.add_argument(
+    '--qps', type=positive_rate, default=GA_QPS_PER_VIEW,
+    help='Reporting API requests per second shared by all workers.')
+argparser.add_argument(
+    '--daily_quota', type=int, default=GA_DAILY_REQUESTS_PER_VIEW,
+    help='Reporting API requests allowed per day, counted across runs.')
+argparser.add_argument(
+    '--quota_file', default='ga_quota.json',
+    help='Local file counting the requests made today against --daily_quota.')
+argparser.add_argument(
+    '--wait_for_quota', action='store_true',
+    help='Pause until the daily quota resets instead of stopping when it is '
+         'used up. Stopped runs resume from the last uploaded page.')
+argparser.add_argument(
+    '--batch_size', type=int, default=GA_BATCH_LIMIT,
+    help='Date ranges whose pages are requested together in one HTTP batch, '
+         'at most %s. Use 1 to send every query on its own.' % GA_BATCH_LIMIT)
+argparser.add_argument(
+    '--volumes', default='Web_Acquisition_Channel_volumes.json',
+    help='Local file of rows per day, used to merge quiet days into one query.')
+argparser.add_argument(
+    '--store', default='s3://bibusuu',
+    help='Bucket URL, or a local directory standing in for it.')
+argparser.add_argument(
+    '--staging_format', choices=FORMATS, default='csv',
+    help='Format of the staged page files. Every file under the prefix has to '
+         'be in the same format, since they are COPYed together.')
+argparser.add_argument(
+    '--copy_parts', type=part_count, default=1,
+    help='Files of about the same size each day\'s page is staged as. Set it to the '
+         'cluster\'s slice count (select count(*) from stv_slices) so COPY loads on every slice.')
+argparser.add_argument(
+    '--sink', choices=SINKS, default='redshift',
+    help='Load into the Redshift cluster in conf2.ini, or into Parquet files '
+         'under --lake_dir with a DuckDB catalog over them.')
+argparser.add_argument(
+    '--lake_dir', default='lake',
+    help='Directory of the local lake, with --sink local.')
+argparser.add_argument(
+    '--bs_users',
+    help='Parquet or CSV export of bs_users, which web_acquisition_channel_registration '
+         'is computed from with --sink local.')
+argparser.add_argument(
+    '--full_reload', action='store_true',
+    help='Rebuild web_acquisition_channel from every file under the prefix '
+         'instead of merging in the days fetched by this run. Refused while '
+         'a day of the history is missing from the manifest.')
+argparser.add_argument(
+    '--migrate_v1', action='store_true',
+    help='Re-stage the days under the old Web_Acquisition_Channel/ prefix '
+         'that are not in the manifest yet, instead of fetching them again.')
+argparser.add_argument(
+    '--refresh_profiles', action='store_true',
+    help='List the GA accounts again instead of using the cached listing.')
+argparser.add_argument(
+    '--manifest', default='Web_Acquisition_Channel_v2_manifest.json',
+    help='Local file recording the days already uploaded to S3.')
+argparser.add_argument(
+    '--verify_manifest', action='store_true',
+    help='Re-list the S3 prefix and reconcile it with the manifest first.')
+argparser.add_argument(
+    '--cache_dir', default=DEFAULT_CACHE_DIR,
+    help='Directory of the local cache of GA responses.')
+argparser.add_argument(
+    '--cache_max_mb', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+    help='Size of the response cache above which the least recently used entries are evicted.')
+argparser.add_argument(
+    '--no_cache', action='store_true',
+    help='Neither read nor write the response cache.')
+argparser.add_argument(
+    '--stream_rows', action='store_true',
+    help='Decode each page one row at a time while writing it out, instead '
+         'of decoding the whole page first. Only with the v3 reporting API.')
+argparser.add_argument(
+    '--max_memory_mb', type=int,
+    help='Resident memory above which date ranges are split and pages made smaller.')
+argparser.add_argument(
+    '--plan', action='store_true',
+    help='Only print the days and queries that would be fetched, without authenticating or listing S3.')
+argparser.add_argument(
+    '--metrics_file', default='ga_pipeline_metrics.jsonl',
+    help='JSON lines file every stage timing and count of the run is appended to.')
+argparser.add_argument(
+    '--prometheus_file',
+    help='Also write the run\'s totals to this file, for the Prometheus node_exporter textfile collector.')
 
-config = configparser.ConfigParser()
-ini = config.read('conf2.ini')
 
-AWS_ACCESS_KEY_ID = config.get('AWS Credentials', 'key')
-AWS_SECRET_ACCESS_KEY = config.get('AWS Credentials', 'secret')
-RED_HOST = config.get('Redshift Creds', 'host')
-RED_PORT = config.get('Redshift Creds', 'port')
-RED_USER = config.get('Redshift Creds', 'user')
-RED_PASSWORD = config.get('Redshift Creds', 'password')
+def main(argv):
+    flags, _ = argparser.parse_known_args(argv[1:])
+    if flags.plan:
+        plan(flags)
+        return
 
+    from googleapiclient.errors import HttpError
+    from oauth2client.client import AccessTokenRefreshError
 
-def main(argv):
     # Authenticate and construct service.
-    service, flags = sample_tools.init(
-        argv, 'analytics', 'v3', __doc__, __file__,
-        scope='https://www.googleapis.com/auth/analytics.readonly')
+    with metrics.stage('auth'):
+        service, flags = ga_auth.init(argv, __doc__, __file__, parents=[argparser])
+    metrics.configure(flags.metrics_file, flags.prometheus_file, job='web')
 
     # Try to make a request to the API. Print the results or handle errors.
     try:
-        first_profile_id = get_first_profile_id(service)
-        if not first_profile_id:
-            print('Could not find a valid profile for this user.')
-
-        else:
-
-            start_date = date(2016, 5, 1)
-            end_date = date(2016, 5, 2)
-
-            while end_date <= date.today():
-                rs = check_output(["s3cmd", "ls", "s3://bibusuu/Web_Acquisition_Channel/%s" % start_date])
-
-                if len(rs) > 1:
-                    print("File Exists for %s, Skipping processing for this file" % start_date)
-
-                else:
-                    page_index = 1
-
-                    results = get_top_keywords(service, first_profile_id, start_date, end_date, page_index)
-                    max_pages = results['totalResults']
-
-                    while page_index <= max_pages:
-                        print("Grabbing Acquisition data for %s to %s page %s" % (start_date, end_date, page_index))
-                        results = get_top_keywords(service, first_profile_id, start_date, end_date, page_index)
-                        print_results(results, start_date, page_index)
-
-                        page_index = page_index + 10000
-
-                start_date = start_date + timedelta(days=1)
-                end_date = end_date + timedelta(days=1)
-
-            import_redshift()
+        store = open_store(flags.store, *settings.aws_credentials())
+        manifest, days = fetch(service, flags, store)
+        if manifest is not None and (flags.full_reload or days) and not refuse_reload(flags, manifest):
+            loader = connect_sink(flags, store)
+            try:
+                with loader.transaction() as cursor:
+                    load(loader, cursor, flags, manifest, days)
+            finally:
+                loader.close()
+            manifest.mark_loaded(None if flags.full_reload else days, flags.sink)
+        elif manifest is not None and not flags.full_reload:
+            print("No new days fetched, nothing to load")
 
     except TypeError as error:
         # Handle errors in constructing a query.
         print(('There was an error in constructing your query : %s' % error))
 
+    except AmbiguousProfile as error:
+        # Handle ambiguous profile names in conf2.ini.
+        print(('There was an error in the profile configuration : %s' % error))
+
     except HttpError as error:
         # Handle API errors.
         print(('Arg, there was an API error : %s : %s' % (error.resp.status, error._get_reason())))
@@ -121,124 +258,602 @@ def main(argv):
         # Handle Auth errors.
         print('The credentials have been revoked or expired, please re-run ' 'the application to re-authorize')
 
+    finally:
+        metrics.write_prometheus()
+        metrics.print_summary()
 
-def get_first_profile_id(service):
-    """Traverses Management API to return the first profile id.
-    This first queries the Accounts collection to get the first account ID.
-    This ID is used to query the Webproperties collection to retrieve the first
-    webproperty ID. And both account and webproperty IDs are used to query the
-    Profile collection to get the first profile id.
+
+def fetch(service, flags, store, backend=None):
+    """Fetches and uploads every day that is not in the manifest yet.
+    Days are planned into ranges of about a page of the reporting API chosen
+    in conf2.ini, resuming the ranges a previous run was stopped in, and
+    fetched by a pool of flags.workers threads. When the
+    daily quota runs out the fetch stops early and what was uploaded so far
+    is returned for loading.
     Args:
       service: The service object built by the Google API Python client library.
+      flags: The parsed command line flags.
+      store: The object store to upload the pages to.
+      backend: The ga_reporting backend to query, opened from service by
+        default.
     Returns:
-      A string with the first profile ID. None if a user does not have any
-      accounts, webproperties, or profiles.
+      A (manifest, days) tuple, days being those uploaded but not loaded into
+      flags.sink yet, including days left unloaded by an earlier run. Both
+      are None if there is no web view.
+    """
+
+    with metrics.stage('profile_discovery'):
+        resolver = ProfileResolver(service)
+        if flags.refresh_profiles:
+            resolver.refresh()
+        first_profile_id = resolver.resolve(settings.ga_profile('web'), indexes=WEB_PROFILE_INDEXES)
+    if not first_profile_id:
+        print('Could not find a valid profile for this user.')
+        return None, None
+
+    backend = backend or open_backend(service)
+    manifest = Manifest(flags.manifest, store, PREFIX)
+    manifest.load(verify=flags.verify_manifest)
+    if flags.migrate_v1:
+        with metrics.stage('migrate'):
+            migrate_v1(store, manifest, flags.staging_format, flags.copy_parts)
+    history = VolumeHistory(flags.volumes)
+    ranges, resumed = pending_ranges(manifest, history, backend.page_size)
+    print("Fetching %s days in %s %s queries, %s of them resumed" % (
+        sum((last - first).days + 1 for first, last in ranges), len(ranges), backend.name, len(resumed)))
+
+    budget = QuotaBudget(flags.quota_file, flags.daily_quota, wait=flags.wait_for_quota)
+    limiter = TokenBucket(flags.qps, budget=budget)
+    cache = None if flags.no_cache else ResponseCache(flags.cache_dir, flags.cache_max_mb * 1024 * 1024)
+    ceiling = MemoryCeiling(flags.max_memory_mb * 1024 * 1024) if flags.max_memory_mb else None
+    workers = max(1, min(flags.workers, GA_MAX_CONCURRENT_REQUESTS))
+    batch_size = max(1, min(flags.batch_size, GA_BATCH_LIMIT))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(process_days, backend, first_profile_id, ranges[i:i + batch_size], store, flags.staging_format, manifest, history, limiter, cache, flags.stream_rows, ceiling, flags.copy_parts)
+               for i in range(0, len(ranges), batch_size)]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except QuotaExhausted as error:
+        # Load what was fetched; the next run picks up from there.
+        print("%s, stopping. The remaining days are fetched by the next run." % error)
+    finally:
+        # Stop handing out new days as soon as one of them fails.
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return manifest, manifest.unloaded(flags.sink)
+
+
+def plan(flags):
+    """Prints the queries fetch() would make, without authenticating or listing S3.
+    The view comes from conf2.ini or the cached account listing, and the
+    days from the local manifest; without one, every day is counted as
+    pending although the run would first list the prefix.
+    Args:
+      flags: The parsed command line flags.
     """
 
-    accounts = service.management().accounts().list().execute()
+    profile_id = ProfileResolver(None).cached(settings.ga_profile('web'), indexes=WEB_PROFILE_INDEXES)
+    print("View %s" % (profile_id or 'not in the cached listing, resolved at run time'))
 
-    if accounts.get('items'):
-        firstAccountId = accounts.get('items')[0].get('id')
-        webproperties = service.management().webproperties().list(
-            accountId=firstAccountId).execute()
+    manifest = Manifest(flags.manifest, None, PREFIX)
+    if os.path.exists(flags.manifest):
+        manifest.load()
+    else:
+        print("No manifest at %s, the run lists %s first" % (flags.manifest, PREFIX))
+    backend = backend_class()
+    ranges, resumed = pending_ranges(manifest, VolumeHistory(flags.volumes), backend.MAX_PAGE_SIZE, quiet=True)
+    for first_day, last_day in resumed:
+        print("  Resuming %s to %s from row %s" % (
+            first_day, last_day, manifest.partial[range_key(first_day, last_day)]['next_index']))
+    print("Would fetch %s days in %s %s queries, %s of them resumed%s" % (
+        sum((last - first).days + 1 for first, last in ranges), len(ranges), backend.name, len(resumed),
+        ', from %s to %s' % (ranges[0][0], ranges[-1][1]) if ranges else ''))
+    target = 'web_acquisition_channel' + (' in the lake at %s' % flags.lake_dir if flags.sink == 'local' else '')
+    if flags.full_reload:
+        print("and rebuild %s from every file under %s" % (target, PREFIX))
+    else:
+        print("and merge them and %s fetched but unloaded days into %s" % (len(manifest.unloaded(flags.sink)), target))
+
+
+def pending_ranges(manifest, history, page_size, quiet=False):
+    """Plans the days up to yesterday that are not in the manifest into ranges.
+    Ranges a previous run stopped in the middle of are resumed as they were
+    planned; the other days are planned afresh, into ranges of about
+    page_size rows.
+    Args:
+      manifest: The loaded Manifest.
+      history: VolumeHistory of rows per day.
+      page_size: Rows per page of the reporting API.
+      quiet: Don't print the days that are skipped or resumed.
+    Returns:
+      A (ranges, resumed) tuple of sorted (first_day, last_day) lists,
+      resumed being the ranges with a checkpoint.
+    """
 
-        if webproperties.get('items'):
-            firstWebpropertyId = webproperties.get('items')[0].get('id')
-            profiles = service.management().profiles().list(
-                accountId=firstAccountId,
-                webPropertyId=firstWebpropertyId).execute()
+    pending = []
+    day = FIRST_DAY
+    while day < date.today():
+        if day not in manifest:
+            pending.append(day)
+        elif not quiet:
+            print("File Exists for %s, Skipping processing for this file" % day)
+        day = day + timedelta(days=1)
+
+    resumed = []
+    for key in sorted(manifest.partial):
+        first_day, last_day = [datetime.strptime(day, '%Y-%m-%d').date() for day in key.split('/')]
+        if first_day in pending and last_day in pending:
+            if not quiet:
+                print("Resuming %s to %s from row %s" % (first_day, last_day, manifest.partial[key]['next_index']))
+            resumed.append((first_day, last_day))
+    pending = [day for day in pending if not any(first <= day <= last for first, last in resumed)]
+    return sorted(resumed + plan_ranges(pending, history, page_size)), resumed
+
+
+def missing_days(manifest, history):
+    """Returns the days up to yesterday that are neither in the manifest nor known to have no rows."""
+
+    missing = []
+    day = FIRST_DAY
+    while day < date.today():
+        if day not in manifest and history.get(day) != 0:
+            missing.append(day)
+        day = day + timedelta(days=1)
+    return missing
+
+
+def refuse_reload(flags, manifest):
+    """Returns True, and says why, if --full_reload would rebuild from a partial history.
+    A rebuild replaces web_acquisition_channel with the files in the
+    manifest, so the days missing from it would be dropped from the table.
+    """
 
-            if profiles.get('items'):
-                return profiles.get('items')[0].get('id')
+    missing = missing_days(manifest, VolumeHistory(flags.volumes)) if flags.full_reload else []
+    if missing:
+        print("Not rebuilding web_acquisition_channel, %s days from %s on are not staged under %s yet%s" % (
+            len(missing), missing[0], PREFIX, '' if flags.migrate_v1 else ', run with --migrate_v1'))
+    return bool(missing)
 
-    return None
 
+def migrate_v1(store, manifest, staging_format, parts=1):
+    """Re-stages the raw page files under OLD_PREFIX under PREFIX.
+    The old pull wrote, under each day, tab delimited and fully quoted raw
+    GA rows of that day and the next, the next day possibly unfinished. Only
+    the rows of the day itself are kept, normalized by normalize_row and
+    staged as one page; the next day is taken from its own files. Days
+    already in the manifest are left alone, so this can be run again.
+    Args:
+      store: The object store of both prefixes.
+      manifest: The loaded Manifest of PREFIX.
+      staging_format: One of staging.FORMATS.
+      parts: Files each day is staged as.
+    Returns:
+      The days re-staged.
+    """
 
-def get_top_keywords(service, profile_id, start_date, end_date, page_index):
-    """Executes and returns data from the Core Reporting API.
-    This queries the API for the top 25 organic search terms by visits.
+    migrated = []
+    for day, names in sorted(list_prefix(store, OLD_PREFIX).items()):
+        if day in manifest:
+            continue
+        ga_date = day.replace('-', '')
+        rows = []
+        for name in sorted(names):
+            with contextlib.closing(store.read('%s%s/%s' % (OLD_PREFIX, day, name))) as raw:
+                rows.extend(row for row in read_rows(raw, 'csv', delimiter='\t') if row[0] == ga_date)
+        if not rows:
+            continue
+        print("Migrating %s rows of %s from %s" % (len(rows), day, store.url(OLD_PREFIX)))
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+        etags, _ = print_results(rows, store, staging_format, day, 1, parts)
+        manifest.record(day, etags)
+        migrated.append(day)
+    print("Migrated %s days from %s" % (len(migrated), store.url(OLD_PREFIX)))
+    return migrated
+
+
+def load(loader, cursor, flags, manifest, days):
+    """Loads the days returned by fetch(), or every day with --full_reload, without committing.
+    The caller marks the days loaded in the manifest once committed.
     Args:
-      service: The service object built by the Google API Python client library.
+      loader: The redshift.Loader or, with --sink local, the lake.LocalLake of the run.
+      cursor: A cursor from loader.transaction().
+      flags: The parsed command line flags.
+      manifest: The Manifest returned by fetch().
+      days: As returned by fetch().
+    """
+
+    days = None if flags.full_reload else days
+    if flags.sink == 'local':
+        import_local(loader, cursor, flags.staging_format, manifest, days, flags.bs_users)
+    else:
+        import_redshift(loader, cursor, flags.staging_format, manifest, days)
+
+
+def process_days(backend, profile_id, ranges, store, staging_format, manifest, history, limiter=None, cache=None,
+                 stream=False, ceiling=None, parts=1):
+    """Fetches several date ranges of acquisition data and uploads them to the store.
+    The ranges' pages are requested together through iter_pages and their
+    rows, which come sorted by ga:date, are written out as they are read,
+    one file per day and page. After every page but the last the range is
+    checkpointed in the manifest, and a range with a checkpoint resumes from
+    the page after it. A day is recorded in
+    the manifest, and its row count in the volume history, once all pages of
+    its range are uploaded. This is run from the worker pool in fetch, one
+    call per group of ranges.
+    Args:
+      backend: The ga_reporting backend to query.
       profile_id: String The profile ID from which to retrieve analytics data.
-      start_date: the dat to start the report from.
-      end_date: The day to end the report from
-      page_index: Get even more results
+      ranges: (first_day, last_day) tuples, both inclusive.
+      store: The object store to upload the pages to.
+      staging_format: One of staging.FORMATS.
+      manifest: Manifest of the days already in the store.
+      history: VolumeHistory of rows per day.
+      limiter: TokenBucket shared by all workers.
+      cache: Optional ga_cache.ResponseCache shared by all workers.
+      stream: Decode the pages one row at a time.
+      ceiling: Optional ga_stream.MemoryCeiling of the process.
+      parts: Files each day's page is staged as.
     Returns:
-      The response returned from the Core Reporting API.
+      The days that had pages uploaded.
+    """
+
+    files = {}
+    counts = {}
+    fetched = []
+    start_indexes = {}
+    for first_day, last_day in ranges:
+        checkpoint = manifest.resume_point(first_day, last_day)
+        if checkpoint:
+            start_indexes[(first_day, last_day)] = checkpoint['next_index']
+            for day, names in checkpoint['files'].items():
+                files[datetime.strptime(day, '%Y-%m-%d').date()] = dict(names)
+            for day, count in checkpoint['rows'].items():
+                counts[datetime.strptime(day, '%Y-%m-%d').date()] = count
+
+    for first_day, last_day, page_index, rows, next_index in iter_pages(backend, profile_id, ranges, limiter,
+                                                                        start_indexes, cache, stream, ceiling):
+        written = set()
+        for ga_date, day_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            day = datetime.strptime(ga_date, '%Y%m%d').date()
+            if day in written:
+                # A second file for the day would replace the first.
+                raise ValueError('Page %s of %s to %s is not sorted by ga:date' % (page_index, first_day, last_day))
+            written.add(day)
+            print("Grabbing Acquisition data for %s page %s" % (day, page_index))
+            etags, rows_written = print_results(day_rows, store, staging_format, day, page_index, parts)
+            files.setdefault(day, {}).update(etags)
+            counts[day] = counts.get(day, 0) + rows_written
+
+        if next_index:
+            manifest.checkpoint(first_day, last_day, next_index,
+                                dict((day, names) for day, names in files.items() if first_day <= day <= last_day),
+                                dict((day, count) for day, count in counts.items() if first_day <= day <= last_day))
+            continue
+
+        day = first_day
+        while day <= last_day:
+            if files.get(day):
+                manifest.record(day, files.pop(day))
+                fetched.append(day)
+            history.record({day: counts.pop(day, 0)})
+            day = day + timedelta(days=1)
+        manifest.checkpoint(first_day, last_day)
+
+    return fetched
+
+
+def iter_pages(backend, profile_id, ranges, limiter=None, start_indexes=None, cache=None, stream=False,
+               ceiling=None):
+    """Pages through the reporting API results for several date ranges.
+    The first pages of all ranges are requested together as one batch, then
+    the next pages of the ranges that have more, and so on. Each page is
+    requested exactly once; the next start index comes from the itemsPerPage
+    of the page just fetched and a range ends with the page that has no
+    nextLink. A multi-day range whose first page is sampled or much bigger
+    than planned is dropped and fetched as two halves instead. Ranges in
+    start_indexes start from that row instead of the first.
+    Once a range's row count is known, a backend that packs several reports
+    into one request, the v4 one, is asked for up to reports_per_request of
+    its pages at once; otherwise at most one page per range is held at a
+    time. While the process is over its memory ceiling, ranges get one page
+    at a time, multi-day ranges that need more than one page are dropped and
+    fetched as two halves, and the other ranges get their next pages at half
+    the size, down to MIN_PAGE_SIZE.
+    Args:
+      backend: The ga_reporting backend to query.
+      profile_id: String The profile ID from which to retrieve analytics data.
+      ranges: (first_day, last_day) tuples, both inclusive.
+      limiter: Optional TokenBucket shared by all worker threads.
+      start_indexes: Optional {(first_day, last_day): start index} of ranges
+        resumed from a checkpoint.
+      cache: Optional ga_cache.ResponseCache to answer pages from.
+      stream: Decode the pages one row at a time, see ga_stream, if the
+        backend can.
+      ceiling: Optional ga_stream.MemoryCeiling of the process.
+    Yields:
+      (first_day, last_day, start_index, rows, next_index) tuples, one per
+      page, rows being an iterable to be consumed before the next page;
+      next_index is the start index of the range's next page, or None for
+      its final page.
     """
 
-    return service.data().ga().get(
-        ids='ga:' + profile_id,
-        start_date='%s' % start_date,
-        end_date='%s' % end_date,
+    start_indexes = start_indexes or {}
+    pending = dict(((first_day, last_day), start_indexes.get((first_day, last_day), 1))
+                   for first_day, last_day in ranges)
+    page_sizes = {}
+    totals = {}
+    over_ceiling = False
+    while pending:
+        requests = {}
+        for key, page_index in pending.items():
+            page_size = page_sizes.get(key, backend.page_size)
+            pages = backend.reports_per_request if key in totals and not over_ceiling else 1
+            for index in range(page_index, page_index + pages * page_size, page_size):
+                if index > totals.get(key, index):
+                    break
+                request = build_query(backend, profile_id, key[0], key[1], index, page_size)
+                requests[key + (index,)] = backend.stream(request) if stream else request
+        responses = backend.execute(requests, limiter, cache=cache)
+        over_ceiling = ceiling is not None and ceiling.exceeded()
+        if over_ceiling:
+            metrics.count('memory_ceiling_hits')
+
+        next_pending = {}
+        expected = {}
+        for request_key in sorted(responses):
+            first_day, last_day, page_index = request_key
+            key = (first_day, last_day)
+            results = responses.pop(request_key)
+            if expected.get(key, page_index) != page_index:
+                # An earlier page of the range ended somewhere else.
+                continue
+            if page_index == 1 and (should_split(first_day, last_day, results, 2 * backend.page_size) or
+                                    (over_ceiling and first_day != last_day and results.get('nextLink'))):
+                print("Splitting %s to %s, %s rows%s" % (first_day, last_day, results.get('totalResults'),
+                                                       ' (sampled)' if results.get('containsSampledData') else
+                                                       ' (over the memory ceiling)' if over_ceiling else ''))
+                for half in split_range(first_day, last_day):
+                    next_pending[half] = 1
+                continue
+
+            totals[key] = results.get('totalResults', 0)
+            next_index = None
+            if results.get('nextLink'):
+                next_index = page_index + (results.get('itemsPerPage') or page_sizes.get(key, backend.page_size))
+                if next_index > totals[key]:
+                    next_index = None
+                elif key + (next_index,) not in responses:
+                    next_pending[key] = next_index
+                    if over_ceiling:
+                        page_sizes[key] = max(MIN_PAGE_SIZE, page_sizes.get(key, backend.page_size) // 2)
+            expected[key] = next_index
+            rows = page_rows(results)
+            results = None
+            yield first_day, last_day, page_index, rows, next_index
+        pending = next_pending
+
+
+def build_query(backend, profile_id, start_date, end_date, page_index, page_size=None):
+    """Returns the unexecuted reporting API query of one page of users by channel, keyword and uid.
+    The rows are sorted by ga:date so that each day's rows can be written out
+    as they come.
+    """
+
+    return backend.query(
+        profile_id, start_date, end_date,
         metrics='ga:users',
         dimensions='ga:date,ga:channelGrouping,ga:sourceMedium,ga:campaign,ga:socialNetwork,ga:keyword,ga:dimension2',
-        # sort='-ga:visits',
+        sort='ga:date',
         filters='ga:channelGrouping!=Direct',
-        start_index='%s' % page_index,
-        max_results='1000000').execute()
+        start_index=page_index,
+        page_size=page_size)
+
+
+def not_set(value):
+    return None if value == '(not set)' else value
 
 
-def print_results(results, start_date, page_index):
+@lru_cache(maxsize=65536)
+def split_source_medium(source_medium):
+    """Returns (source, medium) for a ga:sourceMedium value."""
+
+    match = SOURCE_RE.match(source_medium)
+    source = match.group(0).replace(' /', '') if match else ''
+    match = MEDIUM_RE.search(source_medium)
+    medium = match.group(0).replace('/ ', '') if match else ''
+    return source, not_set(medium)
+
+
+def normalize_row(row):
+    """Turns a raw Core Reporting API row into a web_acquisition_channel row.
+    The ga:date is made an ISO date, ga:sourceMedium is split and '(not set)'
+    values become None. ga:channelGrouping and ga:users are dropped.
+    Args:
+      row: [date, channelGrouping, sourceMedium, campaign, socialNetwork,
+        keyword, dimension2, users] as returned by build_query's query.
+    """
+
+    ga_date, _, source_medium, campaign, social_network, keyword, uid, _ = row
+    source, medium = split_source_medium(source_medium)
+    return ['%s-%s-%s' % (ga_date[:4], ga_date[4:6], ga_date[6:]), source, medium,
+            not_set(campaign), not_set(social_network), not_set(keyword), uid]
+
+
+def print_results(rows, store, staging_format, start_date, page_index, parts=1):
     """Prints out the results.
-    This prints out the profile name, the column headers, and all the rows of
-    data.
+    This normalizes one day's rows of a page and streams them to up to parts
+    files of about the same size in the store as they are read.
     Args:
-      results: The response returned from the Core Reporting API.
+      rows: Iterable of one day's rows of a page returned from the Core
+        Reporting API.
+      store: The object store to upload the page to.
+      staging_format: One of staging.FORMATS.
       start_date: the date to put on the fullname when it is written down
       page_index: add more stuff to the day
+      parts: The largest number of files.
+    Returns:
+      A ({file name: ETag}, rows written) tuple.
     """
 
     # print('Profile Name: %s' % results.get('profileInfo').get('profileName'))
 
-    # Print header.
-    if results.get('rows', []):
-        with open('Web_Channel_Attribution_%s_%s.csv' % (start_date, page_index), 'wb') as csvfile:
+    print('Uploading %s page %s to S3' % (start_date, page_index))
+    uploads = {}
 
-            spamwriter = csv.writer(csvfile, delimiter='\t', quoting=csv.QUOTE_ALL)
+    def open_part(part):
+        name = staging_name('Web_Channel_Attribution_%s_%s' % (start_date, page_index), staging_format, part, parts)
+        uploads[name] = store.open('%s%s/%s' % (PREFIX, start_date, name))
+        return uploads[name]
 
-            for row in results.get('rows'):
-                output = []
-                for cell in row:
-                    output.append('%s' % cell)
-                spamwriter.writerow([s.encode('ascii', 'ignore') for s in output])
+    # zip draws from the counter once per row, so it ends at the row count.
+    counter = itertools.count()
+    with open_parts(open_part, parts, staging_format, COLUMNS, escaped=True) as spamwriter:
+        spamwriter.writerows(normalize_row(row) for row, _ in zip(rows, counter))
+        rows_written = next(counter)
+        metrics.add(rows=rows_written)
 
-        print('Uploading %s page %s to S3' % (start_date, page_index))
-        call(["s3cmd", "put", 'Web_Channel_Attribution_%s_%s.csv' % (start_date, page_index),"s3://bibusuu/Web_Acquisition_Channel/%s/Web_Channel_Attribution_%s_%s.csv" % (start_date, start_date, page_index)])
-        os.remove('Web_Channel_Attribution_%s_%s.csv' % (start_date, page_index))
+    return dict((name, upload.etag) for name, upload in uploads.items()), rows_written
+
+
+# First touch attribution of every user on the day they registered.
+REGISTRATION_SELECT = "select distinct bu.uid,  first_value(source) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as source, first_value(medium) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as medium, first_value(campaign) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as campaign, first_value(social_network) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as social_network, first_value(keyword) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as keyword  from web_acquisition_channel acquisition inner join bs_users bu on bu.uid = acquisition.uid and date((TIMESTAMP 'epoch' + bu.created * INTERVAL '1 Second ')) = acquisition.date"
+
+
+def connect_redshift(store):
+    """Returns a redshift.Loader for the cluster in conf2.ini that loads from store."""
+
+    conn_string, display = settings.redshift_dsn()
+    print("Connecting to database\n        ->%s" % display)
+    return Loader(conn_string, store, *settings.aws_credentials())
+
+
+def connect_sink(flags, store):
+    """Returns the redshift.Loader, or with --sink local the lake.LocalLake, that loads from store."""
+
+    if flags.sink == 'local':
+        print("Loading into the lake at %s" % flags.lake_dir)
+        return LocalLake(flags.lake_dir, store)
+    return connect_redshift(store)
+
+
+def import_redshift(loader, cursor, staging_format, manifest, days=None):
+    """Loads the staged page files into web_acquisition_channel, without committing.
+    The files are already normalized by normalize_row, so they are COPYed
+    without any transformation, in one COPY of exactly the files the
+    manifest lists. With days, only those days' files are COPYed; their
+    dates are replaced in web_acquisition_channel and the registration
+    attribution is rebuilt for the uids seen in them. Without days, or when
+    web_acquisition_channel does not exist yet, both tables are rebuilt from
+    every day in the manifest and swapped in by renaming, so readers never
+    see them missing. Both are built from their declarations in CHANNEL and
+    REGISTRATION, and an incremental load first rebuilds a table whose
+    layout differs. Rebuilt tables are analyzed after the commit, and merged
+    ones vacuumed too when the merge was large.
+    Args:
+      loader: The redshift.Loader of the run.
+      cursor: A cursor from loader.transaction().
+      staging_format: One of staging.FORMATS.
+      manifest: The Manifest of the staged files.
+      days: The dates to load, or None for a full reload.
+    """
+
+    if days is not None and not loader.table_exists(cursor, 'web_acquisition_channel'):
+        print("web_acquisition_channel does not exist yet, reloading all days")
+        days = None
+
+    options = copy_options(staging_format, COPY_OPTIONS)
+    if days is None:
+        print("Creating new table \n web_acquisition_channel_new")
+        schema.create(loader, cursor, CHANNEL, 'web_acquisition_channel_new')
+        print("Copying Web Acquisition Channel data from S3 to  \n web_acquisition_channel_new ")
+        loader.copy_files(cursor, 'web_acquisition_channel_new', manifest.keys(), staging_format, options)
+        loader.swap(cursor, 'web_acquisition_channel', 'web_acquisition_channel_new')
+        loader.maintain('web_acquisition_channel')
+        print("Aggregating web_acquisition_channel_registration")
+        schema.create(loader, cursor, REGISTRATION, 'web_acquisition_channel_registration_new')
+        with metrics.stage('rebuild', table='web_acquisition_channel_registration'):
+            cursor.execute("insert into web_acquisition_channel_registration_new (%s) %s;"
+                           % (REGISTRATION.column_list(), REGISTRATION_SELECT))
+        loader.swap(cursor, 'web_acquisition_channel_registration', 'web_acquisition_channel_registration_new')
+        loader.maintain('web_acquisition_channel_registration')
+
+    else:
+        schema.ensure(loader, cursor, CHANNEL)
+        schema.ensure(loader, cursor, REGISTRATION)
+        print("Creating new table \n web_acquisition_channel_stage ")
+        # Same distribution as web_acquisition_channel, so the merge stays on each slice.
+        schema.create(loader, cursor, CHANNEL, 'web_acquisition_channel_stage')
+        print("Copying %s days of Web Acquisition Channel data from S3 to  \n web_acquisition_channel_stage " % len(days))
+        loader.copy_files(cursor, 'web_acquisition_channel_stage', manifest.keys(days), staging_format, options)
+
+        print("Merging %s days into web_acquisition_channel" % len(days))
+        with metrics.stage('merge', table='web_acquisition_channel'):
+            cursor.execute("delete from web_acquisition_channel where date in (select distinct date from web_acquisition_channel_stage);")
+            cursor.execute("insert into web_acquisition_channel (%s) select %s from web_acquisition_channel_stage;"
+                           % (CHANNEL.column_list(), CHANNEL.column_list()))
+            metrics.add(rows=max(cursor.rowcount, 0))
+        loader.maintain('web_acquisition_channel', max(cursor.rowcount, 0), vacuum=True)
+
+        print("Updating web_acquisition_channel_registration for the new uids")
+        with metrics.stage('merge', table='web_acquisition_channel_registration'):
+            cursor.execute("delete from web_acquisition_channel_registration where uid in (select distinct uid from web_acquisition_channel_stage);")
+            # The uid filter runs before the window functions, which partition
+            # by uid anyway, so only the affected users are recomputed.
+            cursor.execute("insert into web_acquisition_channel_registration (%s) %s where acquisition.uid in (select distinct uid from web_acquisition_channel_stage);" % (REGISTRATION.column_list(), REGISTRATION_SELECT))
+            metrics.add(rows=max(cursor.rowcount, 0))
+        loader.maintain('web_acquisition_channel_registration', max(cursor.rowcount, 0), vacuum=True)
+
+        print("Dropping Staging Table  \n web_acquisition_channel_stage")
+        cursor.execute("DROP TABLE if exists web_acquisition_channel_stage;")
+
+
+def import_local(lake, cursor, staging_format, manifest, days=None, bs_users=None):
+    """Loads the staged page files into web_acquisition_channel in a lake.LocalLake.
+    Each day is one partition, and only the partitions of days are
+    rewritten. Without days, or when the table does not exist yet, every day
+    in the manifest is written and partitions of days no longer in it are
+    removed. web_acquisition_channel_registration is a view of the
+    catalog running the same first touch query as import_redshift, over
+    bs_users, which is registered from an export of the cluster's table.
+    Args:
+      lake: The lake.LocalLake of the run.
+      cursor: A cursor from lake.transaction().
+      staging_format: One of staging.FORMATS.
+      manifest: The Manifest of the staged files.
+      days: The dates to load, or None for a full reload.
+      bs_users: Path of a Parquet or CSV export of bs_users, or None to
+        keep the one registered before.
+    """
 
+    if days is not None and not lake.table_exists(cursor, CHANNEL.name):
+        print("%s does not exist yet, reloading all days" % CHANNEL.name)
+        days = None
+
+    full = days is None
+    days = sorted(manifest.days) if full else days
+    print("Writing %s days of Web Acquisition Channel data to %s" % (len(days), CHANNEL.name))
+    partitions = []
+    for day in days:
+        keys = manifest.keys([day])
+        if not keys:
+            continue
+        partitions.append('date=%s' % day)
+        with lake.staged(keys, staging_format, COLUMNS, escaped=True) as rows:
+            # Sorted like the cluster table, for the row group statistics.
+            lake.write_partition(cursor, CHANNEL.name, partitions[-1],
+                                 "select %s from %s order by uid" % (TRIMMED_COLUMNS, rows))
+    if full:
+        lake.drop_partitions(CHANNEL.name, partitions)
+    lake.refresh_view(cursor, CHANNEL.name)
+
+    if bs_users:
+        print("Registering %s as bs_users" % bs_users)
+        lake.register(cursor, 'bs_users', bs_users)
+    if lake.table_exists(cursor, 'bs_users'):
+        cursor.execute("create or replace view %s as %s;" % (REGISTRATION.name, REGISTRATION_SELECT))
     else:
-        print('No Rows Found')
-
-
-def import_redshift():
-    conn_string = "dbname=%s port=%s user=%s password=%s host=%s" % (
-        RED_USER, RED_PORT, RED_USER, RED_PASSWORD, RED_HOST)
-    print("Connecting to database\n        ->%s" % (conn_string))
-    conn = psycopg2.connect(conn_string)
-
-    cursor = conn.cursor()
-    # Update the redshift table with the new results
-
-    print("Deleting old table web_acquisition_channel2")
-    cursor.execute("drop table if exists web_acquisition_channel2;")
-    print("Creating new table \n web_acquisition_channel2 ")
-    cursor.execute("create table web_acquisition_channel2( date varchar(20), channel_grouping varchar(250), source_medium varchar(250), campaign varchar(250),  social_network varchar(250), keyword varchar(1000), uid int,  users int); ")
-    print("Copying Web Acquisition Channel data from S3 to  \n web_acquisition_channel2 ")
-    cursor.execute("COPY web_acquisition_channel2  FROM 's3://bibusuu/Web_Acquisition_Channel/'  CREDENTIALS 'aws_access_key_id=%s;aws_secret_access_key=%s' trimblanks removequotes delimiter as '\t';" % (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY))
-
-    print("Dropping Table  \n web_acquisition_channel")
-    cursor.execute("DROP TABLE if exists web_acquisition_channel;")
-    print("Aggregating web_acquisition_channel")
-    cursor.execute("create table web_acquisition_channel as select date(concat(concat(concat(concat(substring(date,0,5),'-'), substring(date,5,2)),'-'), substring(date,7,2))) as date, replace(regexp_substr(source_medium,'^.*/'),' /', '') as source, case when replace(regexp_substr(source_medium,'/.*'),'/ ', '') = '(not set)' then null else replace(regexp_substr(source_medium,'/.*'),'/ ', '') end as medium, case when campaign = '(not set)' then null else campaign end as campaign, case when social_network = '(not set)' then null else social_network end as social_network, case when keyword = '(not set)' then null else keyword end as keyword, uid::int as uid from web_acquisition_channel2;")
-    print("Dropping Staging Table  \n web_acquisition_channel2")
-    cursor.execute("DROP TABLE if exists web_acquisition_channel2;")
-    cursor.execute("DROP TABLE if exists web_acquisition_channel_registration;")
-    print("Aggregating web_acquisition_channel_registration")
-    cursor.execute("create table web_acquisition_channel_registration as select distinct bu.uid,  first_value(source) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as source, first_value(medium) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as medium, first_value(campaign) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as campaign, first_value(social_network) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as social_network, first_value(keyword) over (partition by bu.uid order by date asc rows between unbounded preceding and unbounded following) as keyword  from web_acquisition_channel acquisition inner join bs_users bu on bu.uid = acquisition.uid and date((TIMESTAMP 'epoch' + bu.created * INTERVAL '1 Second ')) = acquisition.date;")
-
-    conn.commit()
-    conn.close()
+        print("No bs_users in the lake, pass --bs_users to compute %s" % REGISTRATION.name)
 
 
 if __name__ == '__main__':
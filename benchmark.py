@@ -0,0 +1,446 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Measures the MAU and web pipelines against fake GA, S3 and Redshift.
+
+The Core Reporting API v3, or with --api v4 the Analytics Reporting API v4,
+is replaced by FakeAnalytics, which serves synthetic rows, or rows replayed
+from a recorded response, with configurable volume, page size, latency and
+error rate. Files are staged in a LocalStore under a
+work directory, and with --dsn they are loaded into a local PostgreSQL
+standing in for Redshift, or with --lake into a lake.LocalLake under the work
+directory; without either the load is skipped. Each pipeline runs
+in its own process so its peak RSS is its own.
+
+Sample Usage:
+
+  $ python benchmark.py
+  $ python benchmark.py --pipeline web --days 60 --rows_per_day 25000 --latency 0.2
+  $ python benchmark.py --pipeline web --days 60 --rows_per_day 25000 --api v4
+  $ python benchmark.py --dsn "dbname=bench user=postgres host=localhost" --json results.json
+  $ python benchmark.py --lake --staging_format parquet --work_dir bench
+
+Reports rows/sec, GA requests per run, peak RSS and wall time per stage.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+PIPELINES = ('mau', 'web')
+
+argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+argparser.add_argument('--pipeline', choices=PIPELINES + ('all',), default='all')
+argparser.add_argument('--days', type=int, default=30, help='Days of history to fetch.')
+argparser.add_argument('--rows_per_day', type=int, default=5000, help='Web rows GA returns per day.')
+argparser.add_argument('--api', choices=('v3', 'v4'), default='v3', help='Reporting API to query.')
+argparser.add_argument('--page_size', type=int, help='Rows per GA page, the API\'s largest by default.')
+argparser.add_argument('--latency', type=float, default=0.05, help='Seconds per GA round trip.')
+argparser.add_argument('--error_rate', type=float, default=0.0,
+                       help='Fraction of GA requests failing with a 503 backendError.')
+argparser.add_argument('--dirty_rate', type=float, default=0.01,
+                       help='Fraction of web rows with non-ASCII or escaped characters.')
+argparser.add_argument('--responses', help='Recorded Core Reporting API response (JSON) to replay rows from.')
+argparser.add_argument('--workers', type=int, default=4)
+argparser.add_argument('--qps', type=float, default=1000.0, help='Client-side rate limit.')
+argparser.add_argument('--staging_format', choices=('csv', 'gzip', 'zstd', 'parquet'), default='csv')
+argparser.add_argument('--dsn', help='PostgreSQL connection string to load into; no load without it.')
+argparser.add_argument('--lake', action='store_true', help='Load into a local Parquet lake in the work directory.')
+argparser.add_argument('--work_dir', help='Directory for the staged files, kept afterwards. A temporary one by default.')
+argparser.add_argument('--cache', action='store_true',
+                       help='Answer GA requests from a response cache in the work directory, to measure reruns.')
+argparser.add_argument('--copy_parts', type=int, default=1, help='Files each staged file is split into.')
+argparser.add_argument('--stream_rows', action='store_true', help='Decode web pages one row at a time.')
+argparser.add_argument('--max_memory_mb', type=int, help='Memory ceiling of the web pull.')
+argparser.add_argument('--seed', type=int, default=1)
+argparser.add_argument('--json', help='Also write the results to this file.')
+
+
+def http_error(status, reason):
+    """Returns an HttpError like the ones GA sends."""
+
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode('utf-8'))
+
+
+class FakeResponse(object):
+    status = 200
+
+
+class FakeCredentials(object):
+    def authorize(self, http):
+        return http
+
+
+class FakeAnalytics(object):
+    """The parts of the Analytics v3 service object the pipelines use.
+
+    Args:
+      rows_per_day: Rows of a web channel report per day.
+      latency: Seconds every round trip, single request or batch, takes.
+      error_rate: Fraction of requests that fail with a 503.
+      dirty_rate: Fraction of rows with characters that need escaping.
+      recorded: Rows of a recorded response to replay instead of synthetic ones.
+      seed: Seed of the error and dirty row choices.
+    """
+
+    def __init__(self, rows_per_day, latency=0.0, error_rate=0.0, dirty_rate=0.0, recorded=None, seed=1):
+        self.rows_per_day = rows_per_day
+        self.latency = latency
+        self.error_rate = error_rate
+        self.dirty_rate = dirty_rate
+        self.recorded = recorded
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.round_trips = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+        class _Request(object):
+            credentials = FakeCredentials()
+
+        class _Http(object):
+            request = _Request()
+
+        self._http = _Http()
+
+    def data(self):
+        return self
+
+    def ga(self):
+        return self
+
+    def get(self, **query):
+        return FakeRequest(self, query)
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        return FakeReportsRequest(self, body)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips = self.round_trips + 1
+        time.sleep(self.latency)
+
+    def count_request(self):
+        """Counts one request against the quota, or raises the HttpError it fails with."""
+
+        with self._lock:
+            self.requests = self.requests + 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors = self.errors + 1
+        if failed:
+            raise http_error(503, 'backendError')
+
+    def respond(self, query):
+        """Returns the response to one query, or raises its HttpError."""
+
+        self.count_request()
+        return self.report(query)
+
+    def respond_reports(self, body):
+        """Returns the response to a v4 batchGet, which counts as one request."""
+
+        self.count_request()
+        reports = []
+        for request in body['reportRequests']:
+            query = {
+                'start_date': request['dateRanges'][0]['startDate'],
+                'end_date': request['dateRanges'][0]['endDate'],
+                'metrics': ','.join(metric['expression'] for metric in request['metrics']),
+                'start_index': int(request.get('pageToken', 0)) + 1,
+                'max_results': request['pageSize'],
+            }
+            response = self.report(query)
+            metric_count = len(request['metrics'])
+            report = {'data': {'rowCount': response['totalResults'],
+                               'rows': [{'dimensions': row[:-metric_count], 'metrics': [{'values': row[-metric_count:]}]}
+                                        for row in response.get('rows', [])]}}
+            if response.get('nextLink') or query['start_index'] - 1 + len(report['data']['rows']) < response['totalResults']:
+                report['nextPageToken'] = '%s' % (query['start_index'] - 1 + len(report['data']['rows']))
+            reports.append(report)
+        return {'reports': reports}
+
+    def report(self, query):
+        """Returns the v3 response to one query."""
+
+        first = datetime.datetime.strptime(query['start_date'], '%Y-%m-%d').date()
+        last = datetime.datetime.strptime(query['end_date'], '%Y-%m-%d').date()
+        days = (last - first).days + 1
+        mau = query['metrics'] == 'ga:30dayUsers'
+        total = days if mau else days * self.rows_per_day
+        start = int(query.get('start_index', 1)) - 1
+        # Without max_results the API returns its default page of 1,000 rows.
+        size = int(query.get('max_results', 1000))
+        end = min(total, start + size)
+        response = {'totalResults': total, 'itemsPerPage': size, 'containsSampledData': False,
+                    'profileInfo': {'profileName': 'Benchmark'}}
+        if end > start and mau:
+            response['rows'] = [['%s' % (first + datetime.timedelta(days=i)).strftime('%Y%m%d'), '%s' % (100000 + i)]
+                                for i in range(start, end)]
+        elif end > start:
+            response['rows'] = [self.web_row(first, index) for index in range(start, end)]
+        if end < total:
+            response['nextLink'] = 'start-index=%s' % (end + 1)
+        return response
+
+    def web_row(self, first, index):
+        day = (first + datetime.timedelta(days=index // self.rows_per_day)).strftime('%Y%m%d')
+        if self.recorded:
+            row = list(self.recorded[index % len(self.recorded)])
+            row[0] = day
+            return row
+        keyword = 'keyword %s' % (index % 997)
+        if self.dirty_rate and index % max(1, int(1 / self.dirty_rate)) == 0:
+            keyword = u'caf\xe9\tau\\lait'
+        return [day, 'Organic Search', 'google / organic', '(not set)' if index % 3 else 'campaign %s' % (index % 31),
+                '(not set)', keyword, '%s' % (index % 50000), '1']
+
+
+class FakeRequest(object):
+    def __init__(self, service, query):
+        self.service = service
+        self.query = query
+        # Named the way the API client puts them in the URL.
+        self.uri = 'https://www.googleapis.com/analytics/v3/data/ga?' + urlencode(
+            sorted((name.replace('_', '-'), value) for name, value in query.items()))
+
+        # Set by ga_stream.stream_response, which wants the JSON text.
+        self.postproc = None
+
+    def respond(self):
+        return self.service.respond(self.query)
+
+    def execute(self, http=None):
+        self.service.round_trip()
+        return self.finish(self.respond())
+
+    def finish(self, response):
+        if self.postproc is None:
+            return response
+        return self.postproc(FakeResponse(), json.dumps(response).encode('utf-8'))
+
+
+class FakeReportsRequest(FakeRequest):
+    """A v4 reports.batchGet, POSTed with the query as its JSON body."""
+
+    def __init__(self, service, body):
+        self.service = service
+        self.body = json.dumps(body)
+        self.method = 'POST'
+        self.uri = 'https://analyticsreporting.googleapis.com/v4/reports:batchGet'
+        self.postproc = None
+
+    def respond(self):
+        return self.service.respond_reports(json.loads(self.body))
+
+
+class FakeBatch(object):
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            try:
+                response = request.finish(request.respond())
+            except Exception as error:
+                self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, response, None)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def reporting_backend(flags, service):
+    from ga_reporting import backend_class
+
+    return backend_class(flags.api)(service, flags.page_size)
+
+
+def response_cache(flags):
+    from ga_cache import ResponseCache
+
+    return ResponseCache('benchmark_cache') if flags.cache else None
+
+
+def run_mau(flags, service, store, loader):
+    import MAU_Pipeline
+
+    timings = {}
+    start = time.time()
+    begin = datetime.date.today() - datetime.timedelta(days=flags.days)
+    platforms = MAU_Pipeline.PLATFORMS
+    backend = reporting_backend(flags, service)
+    pages = MAU_Pipeline.execute_pages(backend, dict(
+        (platform['name'], ('benchmark', begin, datetime.date.today())) for platform in platforms),
+        cache=response_cache(flags))
+    responses = dict((name, MAU_Pipeline.merge_responses(parts)) for name, parts in pages.items())
+    timings['fetch'] = time.time() - start
+
+    start = time.time()
+    rows = 0
+    keys = {}
+    for platform in platforms:
+        rows = rows + len(responses[platform['name']].get('rows', []))
+        keys[platform['name']] = MAU_Pipeline.print_results(responses[platform['name']], store,
+                                                            flags.staging_format, platform, None, flags.copy_parts)
+    timings['stage'] = time.time() - start
+
+    if loader is not None:
+        start = time.time()
+        with loader.transaction() as cursor:
+            for platform in platforms:
+                load = MAU_Pipeline.load_local if flags.lake else MAU_Pipeline.load_platform
+                load(loader, cursor, keys[platform['name']], flags.staging_format, platform)
+        timings['load'] = time.time() - start
+    return rows, timings
+
+
+def run_web(flags, service, store, loader):
+    import Web_Channel_Attribution
+    from ga_batch import GA_BATCH_LIMIT
+    from ga_client import TokenBucket
+    from ga_planner import VolumeHistory, plan_ranges
+    from ga_stream import MemoryCeiling
+    from manifest import Manifest
+
+    timings = {}
+    start = time.time()
+    first = datetime.date.today() - datetime.timedelta(days=flags.days)
+    days = [first + datetime.timedelta(days=i) for i in range(flags.days)]
+    backend = reporting_backend(flags, service)
+    manifest = Manifest('benchmark_manifest.json', store, Web_Channel_Attribution.PREFIX).load()
+    history = VolumeHistory('benchmark_volumes.json')
+    ranges = plan_ranges(days, history, backend.page_size)
+    limiter = TokenBucket(flags.qps)
+    cache = response_cache(flags)
+    ceiling = MemoryCeiling(flags.max_memory_mb * 1024 * 1024) if flags.max_memory_mb else None
+    with ThreadPoolExecutor(max_workers=flags.workers) as pool:
+        futures = [pool.submit(Web_Channel_Attribution.process_days, backend, 'benchmark', ranges[i:i + GA_BATCH_LIMIT],
+                               store, flags.staging_format, manifest, history, limiter, cache, flags.stream_rows,
+                               ceiling, flags.copy_parts)
+                   for i in range(0, len(ranges), GA_BATCH_LIMIT)]
+        for future in futures:
+            future.result()
+    rows = sum(history.get(day) or 0 for day in days)
+    timings['fetch_and_stage'] = time.time() - start
+
+    if loader is not None:
+        start = time.time()
+        with loader.transaction() as cursor:
+            # The registration query joins the users table.
+            cursor.execute("create table if not exists bs_users (uid int, created bigint);")
+            if flags.lake:
+                Web_Channel_Attribution.import_local(loader, cursor, flags.staging_format, manifest)
+            else:
+                Web_Channel_Attribution.import_redshift(loader, cursor, flags.staging_format, manifest)
+        timings['load'] = time.time() - start
+    return rows, timings
+
+
+def run_pipeline(flags, pipeline):
+    """Runs one pipeline in this process and returns its results."""
+
+    work_dir = os.path.abspath(flags.work_dir or tempfile.mkdtemp(prefix='benchmark_'))
+    os.makedirs(work_dir, exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+
+    import metrics
+    from lake import LocalLake
+    from object_store import open_store
+    from redshift import Loader
+
+    metrics.configure(os.path.join(work_dir, 'metrics.jsonl'), job=pipeline)
+
+    recorded = None
+    if flags.responses:
+        with open(flags.responses) as f:
+            recorded = json.load(f).get('rows')
+
+    service = FakeAnalytics(flags.rows_per_day, flags.latency, flags.error_rate, flags.dirty_rate, recorded,
+                            flags.seed)
+    store = open_store(os.path.join(work_dir, 'store'))
+    loader = LocalLake('lake', store) if flags.lake else Loader(flags.dsn, store) if flags.dsn else None
+    start = time.time()
+    try:
+        rows, timings = (run_mau if pipeline == 'mau' else run_web)(flags, service, store, loader)
+    finally:
+        if loader is not None:
+            loader.close()
+        if not flags.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    wall = time.time() - start
+
+    return {
+        'pipeline': pipeline,
+        'rows': rows,
+        'rows_per_sec': rows / wall if wall else 0.0,
+        'requests': service.requests,
+        'round_trips': service.round_trips,
+        'errors': service.errors,
+        'peak_rss_mb': peak_rss_mb(),
+        'wall_seconds': wall,
+        'stages': timings,
+        'metrics': dict((name, round(seconds, 3)) for name, seconds, _ in metrics.summary()),
+    }
+
+
+def main(argv):
+    flags = argparser.parse_args(argv[1:])
+    if flags.pipeline != 'all':
+        print(json.dumps(run_pipeline(flags, flags.pipeline)))
+        return 0
+
+    results = []
+    for pipeline in PIPELINES:
+        # The last --pipeline given wins.
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + argv[1:] +
+                                         ['--pipeline', pipeline])
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    print('%-5s %10s %12s %9s %12s %10s %9s' % ('', 'rows', 'rows/sec', 'requests', 'round trips', 'peak MB', 'wall s'))
+    for result in results:
+        print('%-5s %10d %12.0f %9d %12d %10.1f %9.2f' % (
+            result['pipeline'], result['rows'], result['rows_per_sec'], result['requests'], result['round_trips'],
+            result['peak_rss_mb'], result['wall_seconds']))
+        print('      %s' % ', '.join('%s %.2fs' % item for item in sorted(result['stages'].items())))
+        print('      %s' % ', '.join('%s %.2fs' % item for item in sorted(result['metrics'].items())))
+    if flags.json:
+        with open(flags.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,123 @@
+"""Runs a small graph of dependent jobs on a thread pool.
+
+Every job starts as soon as all the jobs it depends on have succeeded, so
+independent jobs run side by side and the graph takes about as long as its
+longest chain. A job whose dependency failed, timed out or was skipped is
+skipped itself. Each job gets the return values of its dependencies.
+
+Python threads can not be killed, so a job that runs past its timeout is
+only abandoned: it is reported as timed out and its dependents are skipped,
+but its thread keeps running until the process exits.
+"""
+from __future__ import print_function
+
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+SKIPPED = 'skipped'
+
+
+class Job(object):
+    """One node of the graph.
+
+    Args:
+      name: Unique name of the job.
+      func: Called as func(inputs), inputs being {dependency name: its return
+        value}.
+      deps: Names of the jobs that have to succeed first.
+      timeout: Seconds after which the job is abandoned, or None.
+    """
+
+    def __init__(self, name, func, deps=(), timeout=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.timeout = timeout
+
+
+class Result(object):
+    def __init__(self, status, seconds=0.0, value=None, error=None):
+        self.status = status
+        self.seconds = seconds
+        self.value = value
+        self.error = error
+
+
+def run(jobs, max_workers=None):
+    """Runs the jobs and returns {name: Result}.
+
+    Args:
+      jobs: Job objects, in any order.
+      max_workers: Largest number of jobs running at once, all of them by
+        default.
+
+    Raises:
+      ValueError: a job depends on an unknown job, or the graph has a cycle.
+    """
+
+    jobs = dict((job.name, job) for job in jobs)
+    for job in jobs.values():
+        unknown = [dep for dep in job.deps if dep not in jobs]
+        if unknown:
+            raise ValueError('Job %s depends on unknown jobs %s' % (job.name, ', '.join(unknown)))
+
+    results = {}
+    pending = dict(jobs)
+    running = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(jobs) or 1)
+    try:
+        while pending or running:
+            for name, job in sorted(pending.items()):
+                states = [results[dep].status if dep in results else None for dep in job.deps]
+                if any(state not in (None, OK) for state in states):
+                    print('Skipping %s, a job it depends on did not succeed' % name)
+                    results[name] = Result(SKIPPED)
+                    del pending[name]
+                elif all(state == OK for state in states):
+                    print('Starting %s' % name)
+                    inputs = dict((dep, results[dep].value) for dep in job.deps)
+                    running[pool.submit(job.func, inputs)] = (job, time.time())
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError('Jobs %s depend on each other' % ', '.join(sorted(pending)))
+                break
+
+            deadlines = [start + job.timeout for job, start in running.values() if job.timeout]
+            timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            now = time.time()
+            for future in list(running):
+                job, start = running[future]
+                if future in done:
+                    del running[future]
+                    try:
+                        results[job.name] = Result(OK, now - start, future.result())
+                        print('Finished %s in %.1fs' % (job.name, now - start))
+                    except Exception as error:
+                        traceback.print_exc()
+                        results[job.name] = Result(FAILED, now - start, error=error)
+                        print('Job %s failed after %.1fs: %s' % (job.name, now - start, error))
+                elif job.timeout and now - start >= job.timeout:
+                    del running[future]
+                    results[job.name] = Result(TIMEOUT, now - start)
+                    print('Job %s timed out after %.1fs' % (job.name, now - start))
+    finally:
+        # Don't wait for abandoned jobs.
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def print_summary(results):
+    """Prints one line per job and returns whether all of them succeeded."""
+
+    for name, result in sorted(results.items()):
+        print('%-12s %-8s %8.1fs%s' % (name, result.status, result.seconds,
+                                       '  %s' % result.error if result.error else ''))
+    return all(result.status == OK for result in results.values())
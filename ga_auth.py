@@ -0,0 +1,117 @@
+"""Authenticates and builds the Analytics service, with a cached discovery document.
+
+init() does what googleapiclient's sample_tools.init does, but imports the
+API client and oauth2client only when called, so --help doesn't pay for them,
+and builds the service from a local copy of the Analytics v3 discovery
+document, fetched once and then again only after DISCOVERY_TTL. The cold start
+of the many short runs is then mostly the OAuth token refresh.
+
+reporting_service() builds the Analytics Reporting API v4 service the same
+way, on the v3 service's authorized Http, for the v4 backend of
+ga_reporting.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import threading
+import time
+
+import metrics
+
+SCOPE = 'https://www.googleapis.com/auth/analytics.readonly'
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/analytics/v3/rest'
+DEFAULT_DISCOVERY_PATH = 'analytics_v3_discovery.json'
+DISCOVERY_TTL = 30 * 24 * 60 * 60
+
+REPORTING_DISCOVERY_URL = 'https://analyticsreporting.googleapis.com/$discovery/rest?version=v4'
+DEFAULT_REPORTING_DISCOVERY_PATH = 'analyticsreporting_v4_discovery.json'
+
+
+def init(argv, doc, filename, parents=(), scope=SCOPE, discovery_path=DEFAULT_DISCOVERY_PATH):
+    """Parses the command line, authorizes and builds the Analytics v3 service.
+
+    The credentials are stored in analytics.dat and the OAuth client in the
+    client_secrets.json next to filename, as with sample_tools.init.
+
+    Args:
+      argv: The command line.
+      doc: Description of the program, usually __doc__.
+      filename: The program's file, usually __file__.
+      parents: argparse.ArgumentParsers of the program's own flags.
+      scope: The OAuth scope.
+      discovery_path: Local copy of the discovery document.
+
+    Returns:
+      A (service, flags) tuple.
+    """
+
+    from oauth2client import client, file, tools
+
+    parser = argparse.ArgumentParser(
+        description=doc, formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[tools.argparser] + list(parents))
+    flags = parser.parse_args(argv[1:])
+
+    client_secrets = os.path.join(os.path.dirname(filename), 'client_secrets.json')
+    flow = client.flow_from_clientsecrets(client_secrets, scope=scope,
+                                          message=tools.message_if_missing(client_secrets))
+    storage = file.Storage('analytics.dat')
+    credentials = storage.get()
+    if credentials is None or credentials.invalid:
+        credentials = tools.run_flow(flow, storage, flags)
+
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import build_http
+
+    http = credentials.authorize(http=build_http())
+    return build_from_document(discovery_document(http, discovery_path), http=http), flags
+
+
+def reporting_service(service, discovery_path=DEFAULT_REPORTING_DISCOVERY_PATH):
+    """Builds the Analytics Reporting API v4 service with the credentials of service.
+
+    Args:
+      service: The Analytics v3 service built by init().
+      discovery_path: Local copy of the v4 discovery document.
+    """
+
+    from googleapiclient.discovery import build_from_document
+
+    http = service._http
+    return build_from_document(discovery_document(http, discovery_path, url=REPORTING_DISCOVERY_URL), http=http)
+
+
+def discovery_document(http, path=DEFAULT_DISCOVERY_PATH, ttl=DISCOVERY_TTL, url=DISCOVERY_URL):
+    """Returns a discovery document, the Analytics v3 one by default, from path while it is fresh.
+
+    A stale copy is still used if fetching a new one fails.
+    """
+
+    document = None
+    if os.path.exists(path):
+        with open(path) as f:
+            document = f.read()
+        if time.time() - os.path.getmtime(path) < ttl:
+            return document
+
+    with metrics.stage('discovery'):
+        try:
+            resp, content = http.request(url)
+        except Exception as error:
+            if document is None:
+                raise
+            print('Could not refresh the discovery document (%s), using %s' % (error, path))
+            return document
+    if resp.status >= 400:
+        if document is None:
+            raise ValueError('Fetching %s failed with HTTP %s' % (url, resp.status))
+        return document
+
+    document = content.decode('utf-8')
+    tmp_path = '%s.%s.tmp' % (path, threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        f.write(document)
+    os.replace(tmp_path, path)
+    return document
@@ -0,0 +1,117 @@
+"""Executes independent GA report queries together as HTTP batch requests.
+
+execute_batch takes a dict of unexecuted requests, for example the next page
+of several days or the MAU query of several profiles, and sends them in
+BatchHttpRequests of up to GA_BATCH_LIMIT sub-requests each: one HTTP round
+trip and one auth header instead of one per query. Sub-requests that fail with
+a retryable error (see ga_client.classify) are sent again in the next round,
+after a backoff, without repeating the ones that succeeded.
+
+The http argument takes any httplib2.Http compatible transport, so batches can
+be replayed against googleapiclient.http.HttpMockSequence.
+"""
+from __future__ import print_function
+
+import metrics
+from ga_client import (DAILY_QUOTA, DEFAULT_RETRIES, FATAL, QUOTA, TRANSIENT, classify, handle_failure,
+                       request_errors, thread_http)
+
+# The Analytics APIs accept at most 10 requests per batch.
+GA_BATCH_LIMIT = 10
+
+SEVERITY = (FATAL, DAILY_QUOTA, QUOTA, TRANSIENT)
+
+
+def execute_batch(service, requests, limiter=None, retries=DEFAULT_RETRIES, http=None,
+                  batch_limit=GA_BATCH_LIMIT, cache=None):
+    """Executes several requests in as few HTTP round trips as possible.
+
+    Args:
+      service: The service object the requests were built from.
+      requests: A dict of {key: unexecuted HttpRequest}.
+      limiter: Optional TokenBucket; every sub-request takes one token, and
+        its budget is told when GA reports the daily quota used up. Batches
+        are made no larger than its capacity, which they could never fill.
+      retries: How many times a failed sub-request is sent again.
+      http: Transport to send the batches on, the calling thread's authorized
+        Http by default.
+      batch_limit: Largest number of sub-requests per batch.
+      cache: Optional ga_cache.ResponseCache. Cached responses are not
+        requested again, and new ones are stored in it.
+
+    Returns:
+      A dict of {key: decoded response}.
+
+    Raises:
+      HttpError: a sub-request failed with a fatal error, or still failed
+        after its retries.
+      QuotaExhausted: the daily quota is used up and the limiter's budget
+        does not wait for it.
+    """
+
+    if limiter is not None:
+        batch_limit = max(1, min(batch_limit, int(limiter.capacity)))
+    responses = {}
+    pending = dict(requests)
+    if cache is not None:
+        for key, request in requests.items():
+            response = cache.get(request)
+            if response is not None:
+                responses[key] = response
+                del pending[key]
+    cached = set(responses)
+    attempt = 0
+    while pending:
+        failed = {}
+        keys = list(pending)
+        for offset in range(0, len(keys), batch_limit):
+            chunk = keys[offset:offset + batch_limit]
+            if limiter is not None:
+                limiter.acquire(len(chunk))
+
+            if len(chunk) == 1:
+                # Not worth the multipart overhead of a batch.
+                try:
+                    with metrics.stage('ga_request'):
+                        metrics.add(requests=1)
+                        responses[chunk[0]] = pending[chunk[0]].execute(http=http or thread_http(service))
+                except request_errors() as error:
+                    failed[chunk[0]] = error
+                continue
+
+            def callback(request_id, response, exception):
+                key = chunk[int(request_id)]
+                if exception is not None:
+                    failed[key] = exception
+                else:
+                    responses[key] = response
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index, key in enumerate(chunk):
+                batch.add(pending[key], request_id='%s' % index)
+            try:
+                with metrics.stage('ga_request', batch=len(chunk)):
+                    metrics.add(requests=len(chunk))
+                    batch.execute(http=http or thread_http(service))
+            except request_errors() as error:
+                # The batch request itself failed, so every sub-request did.
+                for key in chunk:
+                    failed[key] = error
+
+        if not failed:
+            break
+
+        # Handle the worst failure: a fatal error raises, a used up daily quota
+        # waits or raises, and otherwise the round backs off once for all.
+        worst = min(failed.values(), key=lambda error: SEVERITY.index(classify(error)))
+        handle_failure(worst, attempt, limiter, retries)
+
+        pending = dict((key, requests[key]) for key in failed)
+        attempt = attempt + 1
+        print('Retrying %s failed requests, attempt %s' % (len(pending), attempt))
+
+    if cache is not None:
+        for key, response in responses.items():
+            if key not in cached:
+                cache.put(requests[key], response)
+    return responses
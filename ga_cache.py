@@ -0,0 +1,181 @@
+"""On-disk cache of Core Reporting API responses.
+
+GA keeps revising the last few days while it processes them, but a day
+older than that never changes again. ResponseCache stores every response
+under the hash of its query: view, metrics, dimensions, filters, segment,
+sampling level, date range, start index and page size. A response whose
+end_date is at least final_days ago is final and kept until evicted; a more
+recent one expires after recent_ttl seconds. Entries are gzipped JSON files
+in a two level directory tree, and the least recently used are evicted once
+the cache grows past max_bytes, so reruns, backfills and debugging sessions
+cost next to no API requests. Truncated default pages are never stored. A ga_stream.StreamedPage is stored as its JSON
+text and comes back as one, so it is never decoded whole. Reporting API v4
+queries are POSTed, so their key is the JSON body instead, and their
+end_date the latest endDate of its reports.
+"""
+from __future__ import print_function
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import metrics
+from ga_stream import StreamedPage
+
+DEFAULT_CACHE_DIR = 'ga_cache'
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# GA's processing latency: days this old or older are final.
+DEFAULT_FINAL_DAYS = 3
+DEFAULT_RECENT_TTL = 6 * 60 * 60
+
+# Query parameters that make up the cache key.
+KEY_PARAMETERS = ('ids', 'metrics', 'dimensions', 'filters', 'segment', 'sort', 'samplingLevel',
+                  'start-date', 'end-date', 'start-index', 'max-results')
+
+
+def query_parameters(request):
+    """Returns the query parameters of an unexecuted HttpRequest as a dict."""
+
+    if getattr(request, 'method', 'GET') == 'POST' and request.body:
+        body = json.loads(request.body)
+        end_dates = [date_range.get('endDate', '') for report in body.get('reportRequests', [])
+                     for date_range in report.get('dateRanges', [])]
+        # 'today' and 'NdaysAgo' sort after ISO dates, so they make the entry expire.
+        return {'body': body, 'end-date': max(end_dates) if end_dates else ''}
+
+    parameters = dict(parse_qsl(urlparse(request.uri).query))
+    return dict((name, parameters[name]) for name in KEY_PARAMETERS if name in parameters)
+
+
+def final_cutoff(final_days=DEFAULT_FINAL_DAYS, today=None):
+    """Returns the latest day whose data is final."""
+
+    return (today or datetime.date.today()) - datetime.timedelta(days=final_days)
+
+
+class ResponseCache(object):
+    """Content addressed, size bounded cache of GA responses.
+
+    Args:
+      path: Directory of the cache files.
+      max_bytes: Size above which the least recently used entries are evicted.
+      final_days: Responses ending at least this many days ago never expire.
+      recent_ttl: Seconds after which other responses expire.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, final_days=DEFAULT_FINAL_DAYS,
+                 recent_ttl=DEFAULT_RECENT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.final_days = final_days
+        self.recent_ttl = recent_ttl
+        self._lock = threading.Lock()
+        self._size = None
+
+    def key(self, request):
+        parameters = query_parameters(request)
+        return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.json.gz')
+
+    def get(self, request):
+        """Returns the cached response to a request, or None."""
+
+        path = self._file(self.key(request))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            metrics.count('ga_cache_misses')
+            return None
+        if entry['expires'] is not None and entry['expires'] < time.time():
+            metrics.count('ga_cache_misses')
+            return None
+        # The modification time orders the entries for eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        metrics.count('ga_cache_hits')
+        if 'body' in entry:
+            return StreamedPage(entry['body'])
+        return entry['response']
+
+    def put(self, request, response):
+        """Stores the response to a request.
+
+        A v3 response that has a nextLink although its request asked for no
+        page is the API's default first page, not the whole date range, and
+        is not stored.
+        """
+
+        parameters = query_parameters(request)
+        if 'body' not in parameters and 'start-index' not in parameters and response.get('nextLink'):
+            return
+        expires = None
+        end_date = parameters.get('end-date', '')
+        try:
+            final = datetime.datetime.strptime(end_date, '%Y-%m-%d').date() <= final_cutoff(self.final_days)
+        except ValueError:
+            # 'today', 'yesterday' and 'NdaysAgo' move along with the calendar.
+            final = False
+        if not final:
+            expires = time.time() + self.recent_ttl
+
+        path = self._file(self.key(request))
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (path, threading.get_ident())
+        entry = {'query': parameters, 'expires': expires}
+        if isinstance(response, StreamedPage):
+            entry['body'] = response.body
+        else:
+            entry['response'] = response
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f, separators=(',', ':'))
+        size = os.path.getsize(tmp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()
+            else:
+                self._size = self._size + size - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.json.gz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _scan(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache is 10% under max_bytes."""
+
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size = self._size - size
+            metrics.count('ga_cache_evictions')
@@ -0,0 +1,268 @@
+"""Helpers for calling the Google Analytics APIs from several threads.
+
+The pull scripts build one service object through ga_auth.init and then
+fan requests for different days out over a pool of worker threads. The service
+itself can be shared, but the httplib2.Http it was built with can not, so every
+request is executed with a per-thread Http authorized with the same
+credentials, and all threads draw from one TokenBucket to stay under GA's
+per-view query rate.
+
+Failed requests are classified by classify(): transient errors and short-term
+rate limits are retried with exponential backoff and jitter, fatal errors are
+raised at once, and an exhausted daily quota either waits for the quota to
+reset or raises QuotaExhausted so the run can stop cleanly and resume later.
+A TokenBucket may carry a QuotaBudget that counts the day's requests before
+GA has to refuse them.
+
+httplib2 and the API client are only imported once a request fails or a
+per-thread Http is needed, so importing this module for its constants costs
+nothing.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import metrics
+
+# The Core Reporting API allows 10 queries per second per IP address per view
+# and at most 10 concurrent requests per view.
+GA_QPS_PER_VIEW = 10
+GA_MAX_CONCURRENT_REQUESTS = 10
+
+# ... and 10,000 requests per view per day. Quotas reset at midnight Pacific.
+GA_DAILY_REQUESTS_PER_VIEW = 10000
+GA_QUOTA_TIMEZONE = 'America/Los_Angeles'
+
+DEFAULT_RETRIES = 5
+
+TRANSIENT = 'transient'
+QUOTA = 'quota'
+DAILY_QUOTA = 'daily_quota'
+FATAL = 'fatal'
+
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+DAILY_QUOTA_REASONS = ('dailyLimitExceeded',)
+TRANSIENT_REASONS = ('backendError', 'internalServerError')
+
+
+class QuotaExhausted(Exception):
+    """The day's request quota is used up and waiting for it is disabled."""
+
+
+def request_errors():
+    """Returns the exception types a failed request can raise."""
+
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    return HttpError, socket.error, httplib2.HttpLib2Error
+
+
+def error_reasons(error):
+    """Returns the reason strings of an HttpError's JSON body."""
+
+    try:
+        content = json.loads(error.content.decode('utf-8'))
+        return [item.get('reason') for item in content['error'].get('errors', [])]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def classify(error):
+    """Returns TRANSIENT, QUOTA, DAILY_QUOTA or FATAL for a failed request.
+
+    Args:
+      error: The exception raised by executing the request.
+    """
+
+    http_error, socket_error, transport_error = request_errors()
+    if isinstance(error, (socket_error, transport_error)):
+        return TRANSIENT
+    if not isinstance(error, http_error):
+        return FATAL
+
+    reasons = error_reasons(error)
+    if any(reason in DAILY_QUOTA_REASONS for reason in reasons):
+        return DAILY_QUOTA
+    if error.resp.status == 429 or any(reason in QUOTA_REASONS for reason in reasons):
+        return QUOTA
+    if error.resp.status >= 500 or any(reason in TRANSIENT_REASONS for reason in reasons):
+        return TRANSIENT
+    return FATAL
+
+
+def backoff_delay(attempt, base=1.0, maximum=64.0):
+    """Returns the seconds to wait before retry number attempt, with full jitter."""
+
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class QuotaBudget(object):
+    """Counts the requests made against a daily quota, persisted across runs.
+
+    The count is kept in a JSON file together with the Pacific date it belongs
+    to, and starts again from zero when that date changes.
+    """
+
+    def __init__(self, path, limit=GA_DAILY_REQUESTS_PER_VIEW, wait=False):
+        self.path = path
+        self.limit = limit
+        self.wait = wait
+        self._lock = threading.Lock()
+        self._day = None
+        self.used = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self._day = saved.get('day')
+            self.used = saved.get('used', 0)
+
+    @staticmethod
+    def quota_day():
+        from zoneinfo import ZoneInfo
+        return '%s' % datetime.datetime.now(ZoneInfo(GA_QUOTA_TIMEZONE)).date()
+
+    @staticmethod
+    def seconds_to_reset():
+        from zoneinfo import ZoneInfo
+        now = datetime.datetime.now(ZoneInfo(GA_QUOTA_TIMEZONE))
+        tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(),
+                                             tzinfo=now.tzinfo)
+        return (tomorrow - now).total_seconds()
+
+    def charge(self, requests=1):
+        """Counts requests against today's quota.
+
+        Raises:
+          QuotaExhausted: the quota is used up and wait is False. With wait,
+            this blocks until the quota resets instead.
+        """
+
+        while True:
+            with self._lock:
+                day = self.quota_day()
+                if day != self._day:
+                    self._day = day
+                    self.used = 0
+                if self.used + requests <= self.limit:
+                    self.used = self.used + requests
+                    self._save()
+                    metrics.gauge('ga_quota_used', self.used)
+                    return
+            self._exhausted()
+
+    def exhaust(self):
+        """Marks today's quota as used up, e.g. after GA reported it was."""
+
+        with self._lock:
+            self._day = self.quota_day()
+            self.used = self.limit
+            self._save()
+        self._exhausted()
+
+    def _exhausted(self):
+        if not self.wait:
+            raise QuotaExhausted('Daily quota of %s requests used up' % self.limit)
+        wait = self.seconds_to_reset() + 60
+        print('Daily quota of %s requests used up, pausing %d minutes until it resets' % (self.limit, wait / 60))
+        time.sleep(wait)
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'day': self._day, 'used': self.used}, f)
+        os.replace(tmp_path, self.path)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter.
+
+    Tokens are refilled continuously at rate per second up to capacity, and
+    acquire() blocks until the requested number of tokens is available. Tokens
+    are also charged to budget, if one is given. The capacity is at least one
+    token, so a rate below one request per second still lets requests through.
+    """
+
+    def __init__(self, rate=GA_QPS_PER_VIEW, capacity=None, budget=None):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity or rate))
+        self.budget = budget
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if self.budget is not None:
+            self.budget.charge(tokens)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def positive_rate(value):
+    """Parses a --qps flag, which has to be above zero."""
+
+    rate = float(value)
+    if rate <= 0:
+        raise argparse.ArgumentTypeError('%s is not a positive rate' % value)
+    return rate
+
+
+_local = threading.local()
+
+
+def thread_http(service):
+    """Returns an authorized Http object private to the calling thread.
+
+    Args:
+      service: The service object built by ga_auth.init, whose Http
+        carries the OAuth2 credentials to reuse.
+    """
+
+    http = getattr(_local, 'http', None)
+    if http is None:
+        from googleapiclient.http import build_http
+
+        # build_http sets a socket timeout, so a stalled connection fails and is retried.
+        credentials = service._http.request.credentials
+        http = credentials.authorize(http=build_http())
+        _local.http = http
+    return http
+
+
+def handle_failure(error, attempt, limiter=None, retries=DEFAULT_RETRIES):
+    """Waits before retrying a failed request, or re-raises its error.
+
+    Args:
+      error: The exception raised by the request.
+      attempt: How many times the request has failed before.
+      limiter: The TokenBucket the request was drawn from.
+      retries: How many times a request may be retried.
+    """
+
+    kind = classify(error)
+    metrics.count('ga_errors', kind=kind)
+    if kind == DAILY_QUOTA and limiter is not None and limiter.budget is not None:
+        # Waits for the reset, or raises QuotaExhausted.
+        limiter.budget.exhaust()
+        return
+    if kind in (FATAL, DAILY_QUOTA) or attempt >= retries:
+        raise error
+    delay = backoff_delay(attempt)
+    metrics.count('ga_retries', kind=kind)
+    print('Request failed (%s: %s), retrying in %.1fs' % (kind, error, delay))
+    time.sleep(delay)
@@ -0,0 +1,113 @@
+"""Plans the date ranges of Core Reporting API queries from past volumes.
+
+ga:date is one of the web pull's dimensions, so several quiet days are
+fetched as one range and split apart again by date, saving a request per
+day. VolumeHistory remembers how many rows each day returned, plan_ranges
+merges consecutive days while their expected rows fit in one page, and
+should_split tells the fetcher when a range turned out to be too big, or
+sampled, and has to be fetched in halves.
+"""
+from __future__ import print_function
+
+import json
+import os
+import threading
+from datetime import timedelta
+
+# Aim for ranges that fit in one page of the Core Reporting API v3.
+DEFAULT_TARGET_ROWS = 10000
+
+# A multi-day range reporting more rows than this is split in two.
+DEFAULT_SPLIT_ROWS = 2 * DEFAULT_TARGET_ROWS
+
+# Never merge more days than this into one range.
+DEFAULT_MAX_DAYS = 31
+
+
+class VolumeHistory(object):
+    """Rows returned per day, persisted as a JSON file of {day: rows}."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.rows = json.load(f)
+
+    def get(self, day):
+        return self.rows.get(str(day))
+
+    def record(self, counts):
+        """Stores {day: rows} and saves the file."""
+
+        with self._lock:
+            for day, rows in counts.items():
+                self.rows[str(day)] = rows
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.rows, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+def plan_ranges(days, history, target_rows=DEFAULT_TARGET_ROWS, max_days=DEFAULT_MAX_DAYS):
+    """Groups days into ranges to query.
+
+    Consecutive days are merged while the sum of their recorded rows stays
+    within target_rows. Days without a recorded volume get a range of their
+    own, so a first run queries day by day and learns the volumes.
+
+    Args:
+      days: Sorted datetime.date objects to fetch.
+      history: VolumeHistory of earlier runs.
+      target_rows: Expected rows to aim for per range.
+      max_days: Largest number of days per range.
+
+    Returns:
+      A list of (first_day, last_day) tuples, both inclusive.
+    """
+
+    ranges = []
+    first = last = None
+    total = 0
+    for day in days:
+        rows = history.get(day)
+        if (first is not None and rows is not None and day == last + timedelta(days=1) and
+                total + rows <= target_rows and (day - first).days < max_days):
+            last = day
+            total = total + rows
+            continue
+        if first is not None:
+            ranges.append((first, last))
+        if rows is None:
+            ranges.append((day, day))
+            first = last = None
+            total = 0
+        else:
+            first = last = day
+            total = rows
+    if first is not None:
+        ranges.append((first, last))
+    return ranges
+
+
+def should_split(first_day, last_day, results, split_rows=DEFAULT_SPLIT_ROWS):
+    """Returns whether a range's first page shows it should be fetched in halves.
+
+    Args:
+      first_day: First day of the range.
+      last_day: Last day of the range.
+      results: The first page returned for the range.
+      split_rows: Row count above which a multi-day range is split.
+    """
+
+    if first_day == last_day:
+        return False
+    return bool(results.get('containsSampledData')) or results.get('totalResults', 0) > split_rows
+
+
+def split_range(first_day, last_day):
+    """Returns the two halves of a multi-day range."""
+
+    middle = first_day + timedelta(days=(last_day - first_day).days // 2)
+    return (first_day, middle), (middle + timedelta(days=1), last_day)
@@ -0,0 +1,171 @@
+"""Finds Google Analytics views (profiles) by ID or name, with a disk cache.
+
+ProfileResolver lists every account, property and view the user can see with
+a single accountSummaries call of the Management API, caches that tree in a
+JSON file for a day, and looks views up by ID or name. A view can also be
+picked by its position in the listing when conf2.ini names none; the view
+picked is printed so it can be pinned there:
+
+  [GA Profiles]
+  Android = 12345678
+  iOS = iOS App - All Data
+"""
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_PATH = 'ga_profiles_cache.json'
+DEFAULT_TTL = 24 * 60 * 60
+
+# Resolvers of the pulls running side by side list and write the cache one at a time.
+_refresh_lock = threading.Lock()
+
+# accountSummaries returns at most 1000 accounts per page.
+PAGE_SIZE = 1000
+
+
+class AmbiguousProfile(ValueError):
+    """A view name in conf2.ini matches more than one view."""
+
+
+def list_account_summaries(service):
+    """Returns [{'id', 'name', 'webProperties': [{'id', 'name', 'profiles': [...]}]}].
+
+    Args:
+      service: The service object built by the Google API Python client library.
+    """
+
+    accounts = []
+    start_index = 1
+    while True:
+        summaries = service.management().accountSummaries().list(
+            start_index=start_index, max_results=PAGE_SIZE).execute()
+        for account in summaries.get('items', []):
+            accounts.append({
+                'id': account.get('id'),
+                'name': account.get('name'),
+                'webProperties': [{
+                    'id': webproperty.get('id'),
+                    'name': webproperty.get('name'),
+                    'profiles': [{'id': profile.get('id'), 'name': profile.get('name')}
+                                 for profile in webproperty.get('profiles', [])],
+                } for webproperty in account.get('webProperties', [])],
+            })
+        if not summaries.get('nextLink'):
+            return accounts
+        start_index = start_index + summaries.get('itemsPerPage', PAGE_SIZE)
+
+
+def find_profile(accounts, profile=None, webproperty=None, indexes=None):
+    """Looks a view up in the account summaries.
+
+    Args:
+      accounts: As returned by list_account_summaries.
+      profile: View ID or name.
+      webproperty: Optional property ID or name, to tell apart views with the
+        same name.
+      indexes: (account, webproperty, profile) positions, used when profile
+        is not given.
+
+    Returns:
+      A (profile ID, description) tuple, or None if there is no such view.
+
+    Raises:
+      AmbiguousProfile: if the name matches more than one view.
+    """
+
+    if profile:
+        matches = [(account, prop, view)
+                   for account in accounts
+                   for prop in account['webProperties']
+                   for view in prop['profiles']
+                   if profile in (view['id'], view['name']) and
+                   (not webproperty or webproperty in (prop['id'], prop['name']))]
+        if len(matches) > 1:
+            raise AmbiguousProfile('Profile %r matches %s views, give its ID instead' % (profile, len(matches)))
+        if not matches:
+            return None
+        account, prop, view = matches[0]
+    else:
+        try:
+            account = accounts[indexes[0]]
+            prop = account['webProperties'][indexes[1]]
+            view = prop['profiles'][indexes[2]]
+        except IndexError:
+            return None
+
+    return view['id'], '%s / %s / %s' % (account['name'], prop['name'], view['name'])
+
+
+class ProfileResolver(object):
+    """Resolves views against a cached copy of the account summaries."""
+
+    def __init__(self, service, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL):
+        self.service = service
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._accounts = None
+        self._fresh = False
+
+    def refresh(self):
+        """Lists the account summaries from the API and rewrites the cache."""
+
+        with _refresh_lock:
+            self._accounts = list_account_summaries(self.service)
+            self._fresh = True
+            tmp_path = '%s.%s.tmp' % (self.cache_path, threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._accounts, f, indent=1)
+            os.replace(tmp_path, self.cache_path)
+        return self._accounts
+
+    def accounts(self):
+        if self._accounts is None:
+            if (os.path.exists(self.cache_path) and
+                    time.time() - os.path.getmtime(self.cache_path) < self.ttl):
+                with open(self.cache_path) as f:
+                    self._accounts = json.load(f)
+            else:
+                self.refresh()
+        return self._accounts
+
+    def cached(self, profile=None, webproperty=None, indexes=None):
+        """Returns the ID of a view from the cached listing, however old, or None.
+
+        Unlike resolve(), this never calls the API.
+        """
+
+        if self._accounts is None and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self._accounts = json.load(f)
+        found = find_profile(self._accounts or [], profile, webproperty, indexes)
+        return found[0] if found else None
+
+    def resolve(self, profile=None, webproperty=None, indexes=None):
+        """Returns the ID of a view, or None if there is no such view.
+
+        A view that is not in the cache is looked for again in a fresh listing
+        before giving up. Views found by position are printed so they can be
+        pinned by ID.
+
+        Args:
+          profile: View ID or name.
+          webproperty: Optional property ID or name.
+          indexes: (account, webproperty, profile) positions, used when
+            profile is not given.
+        """
+
+        found = find_profile(self.accounts(), profile, webproperty, indexes)
+        if found is None and not self._fresh:
+            found = find_profile(self.refresh(), profile, webproperty, indexes)
+        if found is None:
+            return None
+
+        profile_id, description = found
+        if not profile:
+            print('Using view %s (%s) found by its position in the listing; '
+                  'set its ID in conf2.ini [GA Profiles] to pin it' % (profile_id, description))
+        return profile_id
@@ -0,0 +1,242 @@
+"""Core Reporting API v3 and Analytics Reporting API v4 behind one interface.
+
+The pulls build report queries with backend.query() and run a dict of them
+with backend.execute(). Both backends answer with responses shaped like
+v3's, so paging, range splitting and staging work the same with either:
+
+  {'rows': [[dimension, ..., metric, ...]], 'totalResults': ...,
+   'itemsPerPage': ..., 'nextLink': ..., 'containsSampledData': ...}
+
+v3's data.ga.get returns one report per request and at most 10,000 rows per
+page. v4's reports.batchGet returns pages of up to 100,000 rows and up to
+five reports per request, but the reports of one batchGet must share their
+view, date ranges, sampling level and segments. ReportingV4.execute() packs
+reports that do, such as further pages of one date range, into shared
+batchGets, and sends batchGets that can't share one together in an HTTP
+batch. Each batchGet counts once against the daily quota, however many
+reports it carries.
+
+v4 continues a report from a pageToken, which is the offset of the next row.
+Both backends take the v3 1-based start index, so checkpoints and resumed
+ranges work the same with either. v4 responses hold several reports in one
+body and are decoded whole, so rows are not streamed with it.
+
+The backend is chosen in conf2.ini, v3 by default:
+
+  [GA Reporting]
+  api = v4
+"""
+from __future__ import print_function
+
+import json
+
+import metrics
+import settings
+from ga_batch import execute_batch
+from ga_stream import stream_response
+
+# The fields every report of one v4 batchGet must have in common.
+V4_SHARED_FIELDS = ('viewId', 'dateRanges', 'samplingLevel', 'segments', 'cohortGroup')
+
+
+class CoreReportingV3(object):
+    """Queries the Core Reporting API v3, one report per request.
+
+    Args:
+      service: The Analytics v3 service object built by ga_auth.init.
+      page_size: Rows per page, at most MAX_PAGE_SIZE.
+    """
+
+    name = 'v3'
+    MAX_PAGE_SIZE = 10000
+    reports_per_request = 1
+
+    def __init__(self, service, page_size=None):
+        self.service = service
+        self.page_size = page_size or self.MAX_PAGE_SIZE
+
+    def query(self, profile_id, start_date, end_date, metrics, dimensions, sort=None, filters=None,
+              start_index=None, page_size=None):
+        """Returns an unexecuted data.ga.get request.
+
+        Args:
+          profile_id: The view ID.
+          start_date: First day of the report.
+          end_date: Last day of the report.
+          metrics: Comma separated metric names, e.g. 'ga:users'.
+          dimensions: Comma separated dimension names.
+          sort: Comma separated names to sort the rows by.
+          filters: Filter expression in the v3 syntax.
+          start_index: 1-based index of the first row, for paging. Without
+            it, the API's default page is returned.
+          page_size: Rows per page, the backend's page_size by default.
+        """
+
+        query = dict(ids='ga:' + profile_id, start_date='%s' % start_date, end_date='%s' % end_date,
+                     metrics=metrics, dimensions=dimensions)
+        if sort:
+            query['sort'] = sort
+        if filters:
+            query['filters'] = filters
+        if start_index is not None:
+            query['start_index'] = '%s' % start_index
+            query['max_results'] = '%s' % (page_size or self.page_size)
+        return self.service.data().ga().get(**query)
+
+    def stream(self, request):
+        """Makes a request return a ga_stream.StreamedPage."""
+
+        return stream_response(request)
+
+    def execute(self, requests, limiter=None, cache=None):
+        """Executes {key: request} in HTTP batches, see ga_batch.execute_batch.
+
+        Returns:
+          A dict of {key: response}.
+        """
+
+        return execute_batch(self.service, requests, limiter, cache=cache)
+
+
+class ReportingV4(object):
+    """Queries the Analytics Reporting API v4 through reports.batchGet.
+
+    Args:
+      service: The Analytics Reporting v4 service object, see
+        ga_auth.reporting_service.
+      page_size: Rows per page, at most MAX_PAGE_SIZE.
+    """
+
+    name = 'v4'
+    MAX_PAGE_SIZE = 100000
+    reports_per_request = 5
+
+    def __init__(self, service, page_size=None):
+        self.service = service
+        self.page_size = page_size or self.MAX_PAGE_SIZE
+
+    def query(self, profile_id, start_date, end_date, metrics, dimensions, sort=None, filters=None,
+              start_index=None, page_size=None):
+        """Returns a ReportRequest, to be run by execute().
+
+        Takes the same arguments as CoreReportingV3.query. Without
+        start_index the first page is returned, of page_size rows rather
+        than v4's default of 1,000.
+        """
+
+        report = {
+            'viewId': profile_id,
+            'dateRanges': [{'startDate': '%s' % start_date, 'endDate': '%s' % end_date}],
+            'metrics': [{'expression': name} for name in metrics.split(',')],
+            'dimensions': [{'name': name} for name in dimensions.split(',')],
+            'pageSize': page_size or self.page_size,
+            # Neither is used, and both cost a pass over the rows.
+            'hideTotals': True,
+            'hideValueRanges': True,
+        }
+        if sort:
+            report['orderBys'] = [{'fieldName': name} for name in sort.split(',')]
+        if filters:
+            report['filtersExpression'] = filters
+        if start_index is not None and start_index > 1:
+            report['pageToken'] = '%s' % (start_index - 1)
+        return report
+
+    def stream(self, report):
+        # A batchGet response holds several reports and is decoded whole.
+        return report
+
+    def execute(self, reports, limiter=None, cache=None):
+        """Runs {key: ReportRequest}, packing compatible reports into shared batchGets.
+
+        Args:
+          reports: A dict of {key: ReportRequest} built by query().
+          limiter: Optional TokenBucket; every batchGet takes one token.
+          cache: Optional ga_cache.ResponseCache of the batchGet responses.
+
+        Returns:
+          A dict of {key: v3 shaped response}.
+        """
+
+        groups = {}
+        for key, report in reports.items():
+            shared = json.dumps(dict((name, report.get(name)) for name in V4_SHARED_FIELDS), sort_keys=True)
+            groups.setdefault(shared, []).append(key)
+
+        requests = {}
+        for keys in groups.values():
+            for offset in range(0, len(keys), self.reports_per_request):
+                chunk = tuple(keys[offset:offset + self.reports_per_request])
+                requests[chunk] = self.service.reports().batchGet(
+                    body={'reportRequests': [reports[key] for key in chunk]})
+        metrics.count('ga_reports', len(reports))
+
+        responses = {}
+        batch_responses = execute_batch(self.service, requests, limiter, cache=cache)
+        for chunk in list(batch_responses):
+            # Converted one batchGet at a time, dropping the v4 rows as they go.
+            for key, report in zip(chunk, batch_responses.pop(chunk).get('reports', [])):
+                responses[key] = v3_response(report, reports[key])
+        return responses
+
+
+def v3_response(report, request):
+    """Returns a v4 report shaped like the v3 response to the same query.
+
+    Args:
+      report: One of the reports of a batchGet response.
+      request: The ReportRequest it answers.
+
+    Raises:
+      ValueError: the nextPageToken is not a row offset.
+    """
+
+    data = report.get('data', {})
+    offset = int(request.get('pageToken', 0))
+    rows = [row['dimensions'] + row['metrics'][0]['values'] for row in data.pop('rows', [])]
+    response = {
+        'totalResults': data.get('rowCount', 0),
+        'itemsPerPage': len(rows),
+        'containsSampledData': bool(data.get('samplesReadCounts')),
+        'profileInfo': {'profileId': request['viewId'], 'profileName': 'view %s' % request['viewId']},
+    }
+    if rows:
+        response['rows'] = rows
+    token = report.get('nextPageToken')
+    if token:
+        try:
+            response['itemsPerPage'] = int(token) - offset
+        except ValueError:
+            raise ValueError('Page token %r is not a row offset' % token)
+        response['nextLink'] = token
+    return response
+
+
+BACKENDS = {'v3': CoreReportingV3, 'v4': ReportingV4}
+
+
+def backend_class(api=None):
+    """Returns the backend class of api, 'v3' or 'v4', conf2.ini's choice by default."""
+
+    api = api or settings.reporting_api()
+    if api not in BACKENDS:
+        raise ValueError('Unknown reporting API %r in conf2.ini, use v3 or v4' % api)
+    return BACKENDS[api]
+
+
+def open_backend(service, api=None, page_size=None):
+    """Returns the backend of api, 'v3' or 'v4', conf2.ini's choice by default.
+
+    Args:
+      service: The Analytics v3 service object built by ga_auth.init; the v4
+        service is built on its authorized Http.
+      api: 'v3' or 'v4'.
+      page_size: Rows per page, the API's largest by default.
+    """
+
+    cls = backend_class(api)
+    if cls is ReportingV4:
+        import ga_auth
+
+        service = ga_auth.reporting_service(service)
+    return cls(service, page_size)
@@ -0,0 +1,175 @@
+"""Incremental parsing of Core Reporting API pages, under a memory ceiling.
+
+The API client decodes every response into one Python object before
+returning it, and a page of the web query's seven dimensions, keyword and
+uid among them, takes several times its JSON size once decoded. With
+stream_response() a request returns a StreamedPage instead: the body is kept
+as one string, the small top level members are decoded when first asked for,
+and iter_rows() decodes one row at a time, so rows can be written out as
+they are parsed and never all exist as objects at once.
+
+The body still arrives whole, since httplib2 reads it whole. When a run
+holds too many pages at once, MemoryCeiling tells the fetcher, which then
+queries smaller date ranges and pages.
+"""
+from __future__ import print_function
+
+import json
+import os
+import re
+import resource
+import sys
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+# Strings, which may contain brackets, and brackets.
+_ARRAY_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]]', re.S)
+
+
+def _skip(body, pos):
+    while pos < len(body) and body[pos] in _WHITESPACE:
+        pos = pos + 1
+    return pos
+
+
+def _skip_array(body, pos):
+    """Returns the position after the JSON array starting at pos, without decoding it."""
+
+    depth = 0
+    for match in _ARRAY_TOKENS.finditer(body, pos):
+        token = match.group()
+        if token == '[':
+            depth = depth + 1
+        elif token == ']':
+            depth = depth - 1
+            if not depth:
+                return match.end()
+    raise ValueError('Unterminated array at %s' % pos)
+
+
+class StreamedPage(object):
+    """A Core Reporting API response decoded lazily from its JSON text.
+
+    get() works as on the decoded dict, except for 'rows', which are only
+    available through iter_rows().
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self._members = None
+        self._rows_at = None
+        self._done = False
+
+    def _scan(self, stop_at_rows):
+        """Decodes top level members from the start, stepping over the rows."""
+
+        body = self.body
+        members = {}
+        pos = _skip(body, 0)
+        if body[pos:pos + 1] != '{':
+            raise ValueError('Response is not a JSON object')
+        pos = _skip(body, pos + 1)
+        while body[pos:pos + 1] != '}':
+            key, pos = _DECODER.raw_decode(body, pos)
+            pos = _skip(body, pos)
+            if body[pos:pos + 1] != ':':
+                raise ValueError('Expected ":" at %s' % pos)
+            pos = _skip(body, pos + 1)
+            if key == 'rows':
+                self._rows_at = pos
+                if stop_at_rows:
+                    break
+                pos = _skip_array(body, pos)
+            else:
+                members[key], pos = _DECODER.raw_decode(body, pos)
+            pos = _skip(body, pos)
+            if body[pos:pos + 1] == ',':
+                pos = _skip(body, pos + 1)
+        else:
+            self._done = True
+        self._members = members
+
+    def get(self, key, default=None):
+        if key == 'rows':
+            raise KeyError('Use iter_rows() for the rows of a StreamedPage')
+        if self._members is None:
+            self._scan(stop_at_rows=True)
+        if key not in self._members and not self._done:
+            # The member comes after the rows.
+            self._scan(stop_at_rows=False)
+        return self._members.get(key, default)
+
+    def iter_rows(self):
+        """Yields the rows one at a time, decoding each as it is reached."""
+
+        if self._members is None:
+            self._scan(stop_at_rows=True)
+        if self._rows_at is None:
+            return
+        body = self.body
+        pos = self._rows_at
+        if body[pos:pos + 1] != '[':
+            raise ValueError('Expected "[" at %s' % pos)
+        pos = _skip(body, pos + 1)
+        while body[pos:pos + 1] != ']':
+            row, pos = _DECODER.raw_decode(body, pos)
+            yield row
+            pos = _skip(body, pos)
+            if body[pos:pos + 1] == ',':
+                pos = _skip(body, pos + 1)
+
+
+def page_rows(results):
+    """Returns an iterable of the rows of a decoded response or a StreamedPage."""
+
+    if isinstance(results, StreamedPage):
+        return results.iter_rows()
+    return results.get('rows', [])
+
+
+def stream_response(request):
+    """Makes an unexecuted HttpRequest return a StreamedPage when it succeeds.
+
+    Error responses still go through the API client's own handling, which
+    raises HttpError.
+    """
+
+    postproc = request.postproc
+
+    def streamed(resp, content):
+        if resp.status >= 300 or not content:
+            return postproc(resp, content)
+        return StreamedPage(content.decode('utf-8') if isinstance(content, bytes) else content)
+
+    request.postproc = streamed
+    return request
+
+
+def current_rss():
+    """Returns the resident memory of the process in bytes.
+
+    Where /proc is missing, this is the peak instead of the current size.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MemoryCeiling(object):
+    """A limit on the resident memory of the process.
+
+    Args:
+      max_bytes: Resident size above which exceeded() is true.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def exceeded(self):
+        return current_rss() > self.max_bytes
@@ -0,0 +1,224 @@
+"""Date partitioned Parquet tables with a DuckDB catalog, in place of Redshift.
+
+With --sink local the pulls stage their files in the store as usual, a local
+directory or the bucket, but load them into a LocalLake instead of the
+cluster. Every table is a directory of Hive style partitions of one Parquet
+file each,
+
+  lake/web_acquisition_channel/date=2016-05-01/data.parquet
+  lake/Android_MAU/month=2016-01/data.parquet
+
+and lake/catalog.duckdb holds a view of each table over its partitions, so
+the tables can be queried with `duckdb lake/catalog.duckdb`, or with anything
+that reads Parquet, without S3 or a cluster.
+
+A load only rewrites the partitions it has rows for: rerunning a few days
+rewrites those days' files and nothing else. Each partition is written to a
+new file that is then renamed over the old one, so a reader never sees it
+half written. The partitions of one load are not replaced together,
+though. A load that fails part way leaves the partitions before the failure
+replaced; the pulls then mark nothing loaded, and the next run writes them
+again.
+
+LocalLake has the transaction(), table_exists() and close() of
+redshift.Loader, so code that only asks what is loaded, like where the MAU
+sync starts, works with either. duckdb is only imported when a lake is
+opened.
+"""
+from __future__ import print_function
+
+import contextlib
+import glob
+import os
+import shutil
+import tempfile
+import threading
+
+import metrics
+from object_store import LocalStore
+from staging import read_rows
+
+SINKS = ('redshift', 'local')
+
+CATALOG_FILE = 'catalog.duckdb'
+PARTITION_FILE = 'data.parquet'
+
+# DuckDB types of the staging column types.
+DUCKDB_TYPES = {'string': 'VARCHAR', 'int': 'INTEGER', 'bigint': 'BIGINT', 'date': 'DATE'}
+
+
+def sql_string(value):
+    """Returns value as a quoted SQL string literal."""
+
+    return "'%s'" % ('%s' % value).replace("'", "''")
+
+
+def csv_line(row):
+    """Returns a CSV line of row with every value quoted but None, which DuckDB reads as NULL."""
+
+    return ','.join('' if cell is None else '"%s"' % cell.replace('"', '""') for cell in row) + '\n'
+
+
+class LocalLake(object):
+    """Parquet tables under root, loaded from the files staged in store.
+
+    Args:
+      root: Directory of the tables and the catalog.
+      store: The store the staged files are in.
+    """
+
+    def __init__(self, root, store):
+        import duckdb
+
+        self.root = os.path.abspath(root)
+        self.store = store
+        os.makedirs(self.root, exist_ok=True)
+        self._conn = duckdb.connect(os.path.join(self.root, CATALOG_FILE))
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._tmp = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yields a DuckDB cursor of the catalog.
+
+        Unlike redshift.Loader.transaction, this does not make what is
+        written in it appear at once, see the module docstring. The
+        directory of staged() copies is removed when the outermost block
+        exits.
+        """
+
+        cursor = self._conn.cursor()
+        with self._lock:
+            self._depth = self._depth + 1
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            with self._lock:
+                self._depth = self._depth - 1
+                if not self._depth and self._tmp is not None:
+                    shutil.rmtree(self._tmp, ignore_errors=True)
+                    self._tmp = None
+
+    def close(self):
+        self._conn.close()
+
+    def table_exists(self, cursor, name):
+        cursor.execute("select count(*) from information_schema.tables where lower(table_name) = lower(?);", [name])
+        return cursor.fetchone()[0] > 0
+
+    def _tmp_dir(self):
+        with self._lock:
+            if self._tmp is None:
+                self._tmp = tempfile.mkdtemp(prefix='.staged_', dir=self.root)
+            return self._tmp
+
+    def _local_path(self, key, copies):
+        """Returns a local path of a staged file, copied from the store unless it is local."""
+
+        if isinstance(self.store, LocalStore):
+            return self.store.url(key)
+        handle, path = tempfile.mkstemp(suffix='_' + os.path.basename(key), dir=self._tmp_dir())
+        copies.append(path)
+        with contextlib.closing(self.store.read(key)) as raw, os.fdopen(handle, 'wb') as f:
+            shutil.copyfileobj(raw, f)
+        return path
+
+    @contextlib.contextmanager
+    def staged(self, keys, fmt, columns, escaped=False, **csv_options):
+        """Yields a DuckDB table expression of the rows of staged files.
+
+        Parquet files are read as they are. Text files are read back with
+        staging.read_rows and copied to one plain CSV file, which DuckDB
+        reads with the column types. Local copies are removed when the block
+        exits.
+
+        Args:
+          keys: Store keys of the files, all in format fmt.
+          fmt: One of staging.FORMATS.
+          columns: The (name, type) pairs the files were staged with.
+          escaped: As for staging.open_parts.
+          **csv_options: As for staging.open_parts.
+        """
+
+        copies = []
+        try:
+            if fmt == 'parquet':
+                yield "read_parquet([%s])" % ', '.join(sql_string(self._local_path(key, copies)) for key in keys)
+                return
+
+            handle, path = tempfile.mkstemp(suffix='.csv', dir=self._tmp_dir())
+            copies.append(path)
+            with metrics.stage('lake_read', format=fmt):
+                with os.fdopen(handle, 'w', newline='', encoding='utf-8') as f:
+                    for key in keys:
+                        with contextlib.closing(self.store.read(key)) as raw:
+                            f.writelines(csv_line(row) for row in read_rows(raw, fmt, escaped, **csv_options))
+            yield "read_csv(%s, header = false, quote = '\"', escape = '\"', allow_quoted_nulls = false, columns = {%s})" % (
+                sql_string(path), ', '.join('%s: %s' % (sql_string(name), sql_string(DUCKDB_TYPES[kind]))
+                                           for name, kind in columns))
+        finally:
+            for path in copies:
+                os.remove(path)
+
+    def partitions(self, table):
+        """Returns the partition directory names of a table, e.g. ['date=2016-05-01'], sorted."""
+
+        directory = os.path.join(self.root, table)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if '=' in name)
+
+    def write_partition(self, cursor, table, partition, select):
+        """Replaces one partition of a table with the rows of a query.
+
+        Args:
+          cursor: A cursor from transaction().
+          table: The table name.
+          partition: The partition directory name, e.g. 'date=2016-05-01'.
+          select: The query of the partition's rows.
+
+        Returns:
+          The number of rows written.
+        """
+
+        directory = os.path.join(self.root, table, partition)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, PARTITION_FILE)
+        with metrics.stage('lake_write', table=table):
+            cursor.execute("copy (%s) to %s (format parquet);" % (select, sql_string(path + '.tmp')))
+            rows = cursor.fetchone()[0]
+            metrics.add(rows=rows)
+        os.replace(path + '.tmp', path)
+        return rows
+
+    def drop_partitions(self, table, keep):
+        """Removes the partitions of a table that are not in keep, after a full reload."""
+
+        keep = set(keep)
+        for partition in self.partitions(table):
+            if partition not in keep:
+                print("Dropping %s partition %s" % (table, partition))
+                shutil.rmtree(os.path.join(self.root, table, partition))
+
+    def refresh_view(self, cursor, table):
+        """(Re)creates the catalog view of a table over its partition files.
+
+        New partitions of an existing view are picked up without this; it
+        is needed once a table first gets partitions, or loses them all.
+        """
+
+        pattern = os.path.join(self.root, table, '*', PARTITION_FILE)
+        if glob.glob(pattern):
+            cursor.execute("create or replace view %s as select * from read_parquet(%s, hive_partitioning = false);"
+                           % (table, sql_string(pattern)))
+        else:
+            cursor.execute("drop view if exists %s;" % table)
+
+    def register(self, cursor, name, path):
+        """Makes a Parquet or CSV file, e.g. an export of a Redshift table, a view of the catalog."""
+
+        reader = 'read_parquet' if path.endswith('.parquet') else 'read_csv_auto'
+        cursor.execute("create or replace view %s as select * from %s(%s);"
+                       % (name, reader, sql_string(os.path.abspath(path))))
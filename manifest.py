@@ -0,0 +1,203 @@
+"""Local manifest of the days already uploaded under an object store prefix.
+
+The manifest is a JSON file of completed days, their page files and each
+file's ETag, so whether a day still has to be fetched is a dictionary lookup
+rather than a request to the store. It is bootstrapped, and can be
+re-verified, from a single listing of the prefix in the store, which may be a
+LocalStore standing in for the bucket.
+
+It also checkpoints ranges that are only partly uploaded, with the start index
+of their next page, so an interrupted run resumes from the last page it
+completed, and remembers which days have not been loaded into Redshift, or
+into the local lake, yet.
+"""
+from __future__ import print_function
+
+import json
+import os
+import threading
+
+
+def list_prefix(store, prefix):
+    """Lists every object under a prefix in one go.
+
+    Args:
+      store: An object_store store.
+      prefix: Key prefix ending in '/', e.g. 'Web_Acquisition_Channel/'.
+
+    Returns:
+      A dict of {day: {file name: etag}} where day is the first path component
+      below the prefix.
+    """
+
+    days = {}
+    for key, etag in store.list(prefix).items():
+        key = key[len(prefix):]
+        if '/' not in key:
+            continue
+        day, name = key.split('/', 1)
+        days.setdefault(day, {})[name] = etag
+    return days
+
+
+def range_key(first_day, last_day):
+    return '%s/%s' % (first_day, last_day)
+
+
+def loaded_key(sink):
+    """Returns the day entry key recording loads into sink, and its value when missing."""
+
+    if sink == 'redshift':
+        return 'loaded', True
+    return 'loaded_%s' % sink, False
+
+
+class Manifest(object):
+    """Completed days under one prefix, persisted as a JSON file.
+
+    Day entries look like {'2016-05-01': {'pages': 2, 'files': {name: etag},
+    'loaded': False}}; entries without 'loaded' are taken as loaded into
+    Redshift. Loads into another sink are recorded as e.g. 'loaded_local',
+    and entries without it are taken as not loaded there. Partly
+    uploaded ranges look like {'2016-05-01/2016-05-03': {'next_index': 10001,
+    'files': {day: {name: etag}}, 'rows': {day: rows}}}. record() and
+    checkpoint() may be called from several worker threads.
+    """
+
+    def __init__(self, path, store, prefix):
+        self.path = path
+        self.store = store
+        self.prefix = prefix
+        self.days = {}
+        self.partial = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, day):
+        return str(day) in self.days
+
+    def load(self, verify=False):
+        """Reads the manifest file, listing the prefix if needed.
+
+        Args:
+          verify: Re-list the prefix even when the manifest file exists, and
+            reconcile the two.
+        """
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            # Manifests written before checkpoints were added only hold days.
+            self.days = saved['days'] if 'days' in saved else saved
+            self.partial = saved.get('partial', {}) if 'days' in saved else {}
+            if verify:
+                self.verify()
+        else:
+            print("No manifest at %s, listing %s" % (self.path, self.store.url(self.prefix)))
+            self.days = dict((day, {'pages': len(files), 'files': files})
+                             for day, files in list_prefix(self.store, self.prefix).items())
+            self.save()
+        return self
+
+    def verify(self):
+        """Reconciles the manifest with a fresh listing of the prefix.
+
+        Days whose files are missing or have a different checksum are dropped
+        so they get fetched again, and so are checkpoints; days found only in
+        the listing, and not part of a checkpoint, are added.
+        """
+
+        listed = list_prefix(self.store, self.prefix)
+        with self._lock:
+            for day, entry in list(self.days.items()):
+                files = listed.get(day, {})
+                if any(files.get(name) != md5 for name, md5 in entry['files'].items()):
+                    print("Manifest entry for %s does not match %s, refetching it" % (day, self.store.url(self.prefix)))
+                    del self.days[day]
+            partial_days = set()
+            for key, entry in list(self.partial.items()):
+                if any(listed.get(day, {}).get(name) != md5
+                       for day, files in entry['files'].items() for name, md5 in files.items()):
+                    print("Checkpoint of %s does not match %s, refetching it" % (key, self.store.url(self.prefix)))
+                    del self.partial[key]
+                else:
+                    partial_days.update(entry['files'])
+            for day, files in listed.items():
+                if day not in self.days and day not in partial_days:
+                    self.days[day] = {'pages': len(files), 'files': files}
+        self.save()
+
+    def record(self, day, files):
+        """Marks a day as completed and saves the manifest.
+
+        Args:
+          day: The date that was uploaded.
+          files: A dict of {file name: etag} of its uploaded pages.
+        """
+
+        with self._lock:
+            self.days[str(day)] = {'pages': len(files), 'files': files, 'loaded': False}
+            self._save()
+
+    def checkpoint(self, first_day, last_day, next_index=None, files=None, rows=None):
+        """Saves how far a range has been uploaded, or clears its checkpoint.
+
+        Args:
+          first_day: First day of the range.
+          last_day: Last day of the range.
+          next_index: Start index of the range's next page, or None once the
+            range is complete.
+          files: A dict of {day: {file name: etag}} of the pages uploaded so far.
+          rows: A dict of {day: rows} uploaded so far.
+        """
+
+        key = range_key(first_day, last_day)
+        with self._lock:
+            if next_index is None:
+                if self.partial.pop(key, None) is None:
+                    return
+            else:
+                self.partial[key] = {
+                    'next_index': next_index,
+                    'files': dict(('%s' % day, names) for day, names in files.items()),
+                    'rows': dict(('%s' % day, count) for day, count in rows.items()),
+                }
+            self._save()
+
+    def resume_point(self, first_day, last_day):
+        """Returns the checkpoint of a range, or None if it has none."""
+
+        return self.partial.get(range_key(first_day, last_day))
+
+    def keys(self, days=None):
+        """Returns the store keys of the files of days, or of every day, sorted."""
+
+        with self._lock:
+            days = self.days if days is None else [str(day) for day in days]
+            return sorted('%s%s/%s' % (self.prefix, day, name)
+                          for day in days if day in self.days for name in self.days[day]['files'])
+
+    def unloaded(self, sink='redshift'):
+        """Returns the days uploaded but not yet loaded into sink, sorted."""
+
+        key, default = loaded_key(sink)
+        return sorted(day for day, entry in self.days.items() if not entry.get(key, default))
+
+    def mark_loaded(self, days=None, sink='redshift'):
+        """Marks days, or every day, as loaded into sink and saves."""
+
+        key, _ = loaded_key(sink)
+        with self._lock:
+            for day in (self.days if days is None else days):
+                if str(day) in self.days:
+                    self.days[str(day)][key] = True
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'days': self.days, 'partial': self.partial}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
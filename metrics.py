@@ -0,0 +1,175 @@
+"""Per-stage timings and counts of a pull run.
+
+Code wraps each stage of a run, such as auth, profile discovery, every GA
+request, serialization, upload, COPY and CTAS, in a stage() block, and
+counts rows, bytes or requests against the innermost block of the calling
+thread with add():
+
+  with metrics.stage('serialize', format='csv'):
+      ...
+      metrics.add(rows=len(rows), bytes=size)
+
+Retries and quota usage are recorded with count() and gauge(). Every
+finished stage and every count is appended as one JSON line to the file
+given to configure(); events from before configure() are kept and written
+then. write_prometheus() writes the totals per job and stage in the
+Prometheus text format, for node_exporter's textfile collector. Stages
+nest, and an outer stage's time includes that of its inner ones.
+"""
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'ga_pipeline'
+
+
+class Registry(object):
+    """Collects the stages and counts of one run. Thread safe."""
+
+    def __init__(self):
+        self.job = None
+        self.jsonl_path = None
+        self.prometheus_path = None
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._pending = []
+        self._configured = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, jsonl_path=None, prometheus_path=None, job=None):
+        with self._lock:
+            self.jsonl_path = jsonl_path
+            self.prometheus_path = prometheus_path
+            self.job = job
+            self._configured = True
+            pending, self._pending = self._pending, []
+            for event in pending:
+                event['job'] = event.get('job') or job
+            self._write(pending)
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        stack = self._local.__dict__.setdefault('stack', [])
+        entry = {'stage': name, 'labels': labels, 'counts': {}}
+        stack.append(entry)
+        start = time.time()
+        error = None
+        try:
+            yield entry['counts']
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.time() - start
+            stack.pop()
+            self._finish(entry, start, seconds, error)
+
+    def add(self, **counts):
+        """Adds counts to the calling thread's innermost stage, if any."""
+
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            totals = stack[-1]['counts']
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+
+    def count(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self._emit({'time': time.time(), 'job': self.job, 'counter': name, 'value': value, 'labels': labels})
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[name] = value
+            self._emit({'time': time.time(), 'job': self.job, 'gauge': name, 'value': value, 'labels': labels})
+
+    def _finish(self, entry, start, seconds, error):
+        name = entry['stage']
+        with self._lock:
+            totals = self.stages.setdefault(name, {'seconds': 0.0, 'count': 0, 'errors': 0})
+            totals['seconds'] = totals['seconds'] + seconds
+            totals['count'] = totals['count'] + 1
+            totals['errors'] = totals['errors'] + (1 if error else 0)
+            for key, value in entry['counts'].items():
+                totals[key] = totals.get(key, 0) + value
+            event = {'time': start, 'job': self.job, 'stage': name, 'seconds': round(seconds, 6),
+                     'labels': entry['labels']}
+            event.update(entry['counts'])
+            if error:
+                event['error'] = error
+            self._emit(event)
+
+    def _emit(self, event):
+        if not self._configured:
+            self._pending.append(event)
+        else:
+            self._write([event])
+
+    def _write(self, events):
+        if not events or not self.jsonl_path:
+            return
+        with open(self.jsonl_path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True, default=str) + '\n')
+
+    def summary(self):
+        """Returns (stage, seconds, count) tuples, slowest first."""
+
+        with self._lock:
+            return sorted(((name, totals['seconds'], totals['count']) for name, totals in self.stages.items()),
+                          key=lambda item: -item[1])
+
+    def write_prometheus(self, path=None):
+        """Writes the totals in the Prometheus text format, replacing the file atomically."""
+
+        path = path or self.prometheus_path
+        if not path:
+            return
+        job = self.job or 'unknown'
+        lines = []
+        with self._lock:
+            metrics = {}
+            for name, totals in sorted(self.stages.items()):
+                for key, value in sorted(totals.items()):
+                    metric = '%s_stage_%s' % (PROMETHEUS_PREFIX, 'seconds_total' if key == 'seconds' else key + '_total')
+                    metrics.setdefault(metric, []).append('%s{job="%s",stage="%s"} %s' % (metric, job, name, value))
+            for name, value in sorted(self.counters.items()):
+                metric = '%s_%s_total' % (PROMETHEUS_PREFIX, name)
+                metrics.setdefault(metric, []).append('%s{job="%s"} %s' % (metric, job, value))
+            for name, value in sorted(self.gauges.items()):
+                metric = '%s_%s' % (PROMETHEUS_PREFIX, name)
+                metrics.setdefault(metric, []).append('%s{job="%s"} %s' % (metric, job, value))
+            metric = '%s_last_run_timestamp_seconds' % PROMETHEUS_PREFIX
+            metrics[metric] = ['%s{job="%s"} %s' % (metric, job, int(time.time()))]
+        for metric, samples in sorted(metrics.items()):
+            lines.append('# TYPE %s %s' % (metric, 'counter' if metric.endswith('_total') else 'gauge'))
+            lines.extend(samples)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+_registry = Registry()
+
+configure = _registry.configure
+stage = _registry.stage
+add = _registry.add
+count = _registry.count
+gauge = _registry.gauge
+summary = _registry.summary
+write_prometheus = _registry.write_prometheus
+
+
+def print_summary():
+    """Prints the time spent per stage, slowest first."""
+
+    for name, seconds, calls in summary():
+        print('%-20s %9.2fs  %6d calls' % (name, seconds, calls))
@@ -0,0 +1,245 @@
+"""Object stores the pull scripts stage their files in.
+
+open_store('s3://bucket') returns an S3Store that streams each file straight
+to the bucket as a multipart upload over one pooled, thread safe boto3 client,
+so nothing is written to local disk and no s3cmd process is spawned.
+open_store('/some/dir') returns a LocalStore with the same interface that
+writes under a directory, for testing without AWS.
+
+Both stores hand out binary file objects from open(key), whose etag is set once
+they are closed cleanly and which are discarded by abort(); staging.open_parts
+writes rows into them. read(key) opens a stored file for reading, and
+size(key) returns its size, which S3Store remembers for the files it uploaded
+itself.
+"""
+from __future__ import print_function
+
+import hashlib
+import io
+import os
+
+import metrics
+
+# S3 requires every part but the last to be at least 5MB.
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+# Enough pooled connections for every worker thread the scripts allow.
+MAX_POOL_CONNECTIONS = 10
+
+
+def file_md5(path):
+    """Returns the hex MD5 of a file, which is also its single part S3 ETag."""
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_store(url, access_key=None, secret_key=None):
+    """Returns the store for an 's3://bucket' URL or a local directory."""
+
+    if url.startswith('s3://'):
+        return S3Store(url[len('s3://'):].rstrip('/'), access_key, secret_key)
+    return LocalStore(url)
+
+
+class S3Store(object):
+    """Writes and lists objects in one S3 bucket."""
+
+    def __init__(self, bucket, access_key=None, secret_key=None, part_size=DEFAULT_PART_SIZE):
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.part_size = part_size
+        # {key: bytes} of the objects uploaded through open().
+        self._sizes = {}
+        # One client for the whole run; its connection pool is shared by all
+        # worker threads.
+        self.client = boto3.client(
+            's3', aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+    def url(self, key):
+        return 's3://%s/%s' % (self.bucket, key)
+
+    def open(self, key):
+        return MultipartUpload(self.client, self.bucket, key, self.part_size, self._sizes)
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def list(self, prefix):
+        """Returns {key: etag} for every object under prefix."""
+
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                objects[item['Key']] = item['ETag'].strip('"')
+        return objects
+
+    def size(self, key):
+        """Returns the size of an object in bytes, asking S3 only if it wasn't uploaded by this store."""
+
+        size = self._sizes.get(key)
+        if size is None:
+            size = self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        return size
+
+
+class MultipartUpload(io.RawIOBase):
+    """Binary file object that uploads to S3 in parts as it is written.
+
+    Objects smaller than one part are sent with a single put_object. After
+    close() the object's ETag is in self.etag, and its size in sizes[key] if
+    a sizes dict is given.
+    """
+
+    def __init__(self, client, bucket, key, part_size, sizes=None):
+        super(MultipartUpload, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.sizes = sizes
+        self.etag = None
+        self._buffer = bytearray()
+        self._size = 0
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._size
+
+    def write(self, data):
+        self._size += len(data)
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self._parts) + 1
+        with metrics.stage('upload'):
+            metrics.add(bytes=len(self._buffer))
+            response = self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                PartNumber=number, Body=bytes(self._buffer))
+        self._parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        del self._buffer[:]
+
+    def close(self):
+        if self.closed:
+            return
+        if self._upload_id is None:
+            with metrics.stage('upload'):
+                metrics.add(bytes=len(self._buffer))
+                response = self.client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part()
+            with metrics.stage('upload'):
+                response = self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': self._parts})
+        self.etag = response['ETag'].strip('"')
+        if self.sizes is not None:
+            self.sizes[self.key] = self._size
+        super(MultipartUpload, self).close()
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        del self._buffer[:]
+        super(MultipartUpload, self).close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class LocalStore(object):
+    """Writes and lists files under a local directory laid out like a bucket."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def url(self, key):
+        return os.path.join(self.root, key)
+
+    def open(self, key):
+        return LocalFile(self.url(key))
+
+    def read(self, key):
+        return open(self.url(key), 'rb')
+
+    def list(self, prefix):
+        """Returns {key: md5} for every file under prefix."""
+
+        objects = {}
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.part'):
+                    objects[key] = file_md5(path)
+        return objects
+
+    def size(self, key):
+        return os.path.getsize(self.url(key))
+
+
+class LocalFile(io.RawIOBase):
+    """Binary file that only appears at its path once closed cleanly."""
+
+    def __init__(self, path):
+        super(LocalFile, self).__init__()
+        self.path = path
+        self.etag = None
+        self._digest = hashlib.md5()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path + '.part', 'wb')
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._file.tell()
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._file.close()
+        os.replace(self.path + '.part', self.path)
+        self.etag = self._digest.hexdigest()
+        super(LocalFile, self).close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path + '.part')
+        super(LocalFile, self).close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
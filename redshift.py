@@ -0,0 +1,236 @@
+"""Loads staged files into Redshift over one pooled connection per run.
+
+A Loader holds a pool of one connection that all loads of a run share, and
+transaction() runs them in one transaction: nested transaction() blocks join
+the outermost one, which commits, or rolls back on any error. Tables are
+rebuilt under a _new name and swapped in with ALTER TABLE ... RENAME, which
+Redshift, like PostgreSQL, applies atomically at commit, so readers never see
+them missing.
+
+Files in an S3Store are loaded with Redshift's COPY ... FROM 's3://...'.
+Files in a LocalStore are streamed through COPY ... FROM STDIN instead, so a
+local PostgreSQL can stand in for the cluster, e.g. with
+
+  [Redshift Creds]
+  host = localhost
+  port = 5432
+
+and --store /tmp/bibusuu. PostgreSQL can not read Parquet, so only the text
+formats can be loaded that way.
+
+VACUUM can not run inside a transaction, so maintain() only queues a table
+to be vacuumed and analyzed, which happens right after the commit.
+
+copy_files() loads an exact list of files rather than everything under a
+prefix. On S3 it writes a COPY manifest of them under MANIFEST_PREFIX, named
+by a hash of its contents, so Redshift neither lists the prefix nor picks
+up stray files, and loading the same files again uses the same manifest.
+"""
+from __future__ import print_function
+
+import contextlib
+import gzip
+import hashlib
+import json
+
+import metrics
+from object_store import LocalStore
+from staging import ESCAPED_TEXT_OPTIONS
+
+# Key prefix of the COPY manifests in the store.
+MANIFEST_PREFIX = 'copy_manifests/'
+
+# Loads of fewer rows than this don't get a VACUUM and ANALYZE afterwards.
+DEFAULT_MAINTENANCE_ROWS = 100000
+
+
+class Loader(object):
+    """Runs the loads of one run on a single pooled connection.
+
+    Args:
+      dsn: The psycopg2 connection string.
+      store: The store the staged files are in.
+      access_key: AWS credentials Redshift reads S3 files with.
+      secret_key: AWS credentials Redshift reads S3 files with.
+      maintenance_rows: Rows a load has to change for maintain() to queue
+        its table.
+    """
+
+    def __init__(self, dsn, store, access_key=None, secret_key=None, maintenance_rows=DEFAULT_MAINTENANCE_ROWS):
+        import psycopg2.pool
+
+        self.pool = psycopg2.pool.SimpleConnectionPool(1, 1, dsn)
+        self.store = store
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.maintenance_rows = maintenance_rows
+        self._conn = None
+        self._depth = 0
+        self._redshift = None
+        self._maintenance = {}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yields a cursor whose statements commit together when the outermost block exits."""
+
+        if self._conn is None:
+            self._conn = self.pool.getconn()
+        self._depth = self._depth + 1
+        try:
+            yield self._conn.cursor()
+        except BaseException:
+            self._depth = self._depth - 1
+            if not self._depth:
+                self._maintenance = {}
+                self._conn.rollback()
+                self._release()
+            raise
+        self._depth = self._depth - 1
+        if not self._depth:
+            try:
+                self._conn.commit()
+                self._run_maintenance()
+            finally:
+                self._release()
+
+    def _release(self):
+        self.pool.putconn(self._conn)
+        self._conn = None
+
+    def close(self):
+        self.pool.closeall()
+
+    def is_redshift(self, cursor):
+        """Returns whether the connection is to Redshift rather than PostgreSQL."""
+
+        if self._redshift is None:
+            cursor.execute("select version();")
+            self._redshift = 'Redshift' in cursor.fetchone()[0]
+        return self._redshift
+
+    def maintain(self, table, rows=None, vacuum=False):
+        """Queues an ANALYZE of table, and a VACUUM first if vacuum, for after the commit.
+
+        Args:
+          table: The table that was loaded.
+          rows: Rows the load changed; fewer than maintenance_rows queue
+            nothing. None for a rebuilt table, which is always analyzed.
+          vacuum: Also reclaim deleted rows and re-sort, after a merge.
+        """
+
+        if rows is not None and rows < self.maintenance_rows:
+            return
+        self._maintenance[table] = self._maintenance.get(table, False) or vacuum
+
+    def _run_maintenance(self):
+        pending, self._maintenance = self._maintenance, {}
+        if not pending:
+            return
+        self._conn.autocommit = True
+        try:
+            cursor = self._conn.cursor()
+            for table, vacuum in sorted(pending.items()):
+                try:
+                    if vacuum:
+                        print("Vacuuming %s" % table)
+                        with metrics.stage('vacuum', table=table):
+                            cursor.execute("vacuum %s;" % table)
+                    print("Analyzing %s" % table)
+                    with metrics.stage('analyze', table=table):
+                        cursor.execute("analyze %s;" % table)
+                except Exception as error:
+                    # The load is committed; the next large load tries again.
+                    print("Could not vacuum or analyze %s: %s" % (table, error))
+        finally:
+            self._conn.autocommit = False
+
+    def table_exists(self, cursor, table):
+        cursor.execute("select count(*) from information_schema.tables where table_name = %s;", (table.lower(),))
+        return bool(cursor.fetchone()[0])
+
+    def copy_files(self, cursor, table, keys, staging_format, options):
+        """COPYs exactly the given staged files into table, through a COPY manifest.
+
+        Args:
+          cursor: A cursor from transaction().
+          table: The table to load into.
+          keys: Keys of the files.
+          staging_format: One of staging.FORMATS.
+          options: The Redshift COPY options, from staging.copy_options.
+        """
+
+        keys = sorted(keys)
+        if not keys:
+            return
+        with metrics.stage('copy', table=table):
+            if isinstance(self.store, LocalStore):
+                self._copy_local(cursor, table, keys, staging_format, options)
+                return
+            manifest_key = self.write_manifest(keys, staging_format)
+            cursor.execute("COPY %s  FROM '%s'  CREDENTIALS 'aws_access_key_id=%s;aws_secret_access_key=%s' %s MANIFEST;" % (
+                table, self.store.url(manifest_key), self.access_key, self.secret_key, options))
+            metrics.add(rows=max(cursor.rowcount, 0), files=len(keys))
+
+    def write_manifest(self, keys, staging_format):
+        """Writes a COPY manifest of the files to the store and returns its key.
+
+        Redshift needs the size of every Parquet file in the manifest. The
+        store knows those of the files it uploaded this run; others, left
+        unloaded by an earlier run, are looked up one by one.
+        """
+
+        entries = [{'url': self.store.url(key), 'mandatory': True} for key in keys]
+        if staging_format == 'parquet':
+            for key, entry in zip(keys, entries):
+                entry['meta'] = {'content_length': self.store.size(key)}
+        body = json.dumps({'entries': entries}, indent=1, sort_keys=True).encode('utf-8')
+        key = '%s%s.manifest' % (MANIFEST_PREFIX, hashlib.sha1(body).hexdigest())
+        upload = self.store.open(key)
+        try:
+            upload.write(body)
+        except BaseException:
+            upload.abort()
+            raise
+        upload.close()
+        return key
+
+    def _copy_local(self, cursor, table, keys, staging_format, options):
+        """Streams local files into table with COPY ... FROM STDIN."""
+
+        if staging_format == 'parquet':
+            raise ValueError('Parquet files can only be loaded by Redshift, not from %s' % self.store.url(''))
+        # The escaped text format is PostgreSQL's default text format.
+        statement = "COPY %s FROM STDIN WITH (FORMAT %s)" % (
+            table, 'text' if options.startswith(ESCAPED_TEXT_OPTIONS) else 'csv')
+        for key in keys:
+            with open_local(self.store.url(key), staging_format) as f:
+                cursor.copy_expert(statement, f)
+            metrics.add(rows=max(cursor.rowcount, 0))
+
+    def swap(self, cursor, table, new_table):
+        """Replaces table with new_table by renaming, dropping the old one.
+
+        Readers keep seeing the old table until the transaction commits.
+        Views on the old table keep pointing at it, so its drop fails while
+        any exist.
+        """
+
+        with metrics.stage('swap', table=table):
+            if self.table_exists(cursor, table):
+                cursor.execute("drop table if exists %s_old;" % table)
+                cursor.execute("alter table %s rename to %s_old;" % (table, table))
+                cursor.execute("alter table %s rename to %s;" % (new_table, table))
+                cursor.execute("drop table %s_old;" % table)
+            else:
+                cursor.execute("alter table %s rename to %s;" % (new_table, table))
+
+
+def open_local(path, staging_format):
+    """Opens a local staged text file for reading, decompressed."""
+
+    if staging_format == 'gzip':
+        return gzip.open(path, 'rb')
+    if staging_format == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
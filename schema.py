@@ -0,0 +1,136 @@
+"""Declared layouts of the Redshift tables the pulls load.
+
+A Table declares each column's type and encoding and the table's
+distribution and sort keys, rather than leaving them to Redshift's defaults,
+and the scripts build every table, including the _new tables swapped in by
+full reloads, from the declaration:
+
+  CHANNEL = Table('web_acquisition_channel', [
+      Column('date', 'date', 'raw'),
+      Column('uid', 'integer', 'az64'),
+  ], distkey='uid', sortkey=('date', 'uid'))
+
+ensure() creates a table that is missing and rebuilds one whose columns,
+encodings or keys differ from its declaration by copying it into a new table
+and swapping that in. DISTSTYLE ALL and EVEN can not be told apart from the
+catalog, so switching between those two needs a full reload. On a local
+PostgreSQL standing in for the cluster the Redshift clauses are left out and
+only the column names and types are compared.
+"""
+from __future__ import print_function
+
+import metrics
+
+# pg_table_def shows columns stored without compression as 'none'.
+CATALOG_ENCODINGS = {'raw': 'none'}
+
+
+class Column(object):
+    """One column of a Table.
+
+    Args:
+      name: The column name, in lower case.
+      type: The type as the catalog spells it, e.g. 'character varying(250)'
+        or 'integer', so declarations compare equal to existing tables.
+      encode: The Redshift compression encoding.
+    """
+
+    def __init__(self, name, type, encode=None):
+        self.name = name
+        self.type = type
+        self.encode = encode
+
+
+class Table(object):
+    """Columns, distribution and sort keys of one table.
+
+    Args:
+      name: The table name.
+      columns: Column objects, in table order.
+      distkey: Name of the distribution key column, or None.
+      sortkey: Names of the compound sort key columns.
+      diststyle: 'all' or 'even' for tables without a distkey.
+    """
+
+    def __init__(self, name, columns, distkey=None, sortkey=(), diststyle=None):
+        self.name = name
+        self.columns = columns
+        self.distkey = distkey
+        self.sortkey = tuple(sortkey)
+        self.diststyle = diststyle
+
+    def column_list(self):
+        return ', '.join(column.name for column in self.columns)
+
+    def create_sql(self, name=None, redshift=True):
+        """Returns the CREATE TABLE statement, for a table called name if given."""
+
+        columns = ', '.join('%s %s%s' % (column.name, column.type,
+                                         ' encode %s' % column.encode if redshift and column.encode else '')
+                            for column in self.columns)
+        sql = "create table %s (%s)" % (name or self.name, columns)
+        if redshift:
+            if self.distkey:
+                sql = sql + " diststyle key distkey(%s)" % self.distkey
+            elif self.diststyle:
+                sql = sql + " diststyle %s" % self.diststyle
+            if self.sortkey:
+                sql = sql + " compound sortkey(%s)" % ', '.join(self.sortkey)
+        return sql + ";"
+
+    def layout(self, redshift=True):
+        """Returns the declared layout in the form describe() reads it from the catalog."""
+
+        if not redshift:
+            return sorted((column.name, column.type) for column in self.columns)
+        return sorted((column.name, column.type, CATALOG_ENCODINGS.get(column.encode, column.encode),
+                       column.name == self.distkey,
+                       self.sortkey.index(column.name) + 1 if column.name in self.sortkey else 0)
+                      for column in self.columns)
+
+
+def describe(loader, cursor, name):
+    """Returns the layout of an existing table like Table.layout(), or None if it does not exist."""
+
+    if not loader.table_exists(cursor, name):
+        return None
+    if loader.is_redshift(cursor):
+        cursor.execute('select "column", type, encoding, distkey, sortkey from pg_table_def where tablename = %s;',
+                       (name.lower(),))
+    else:
+        cursor.execute("select attname, format_type(atttypid, atttypmod) from pg_attribute "
+                       "where attrelid = %s::regclass and attnum > 0 and not attisdropped;", (name.lower(),))
+    return sorted(tuple(row) for row in cursor.fetchall())
+
+
+def create(loader, cursor, table, name=None):
+    """(Re)creates a table from its declaration, as name if given, without committing."""
+
+    name = name or table.name
+    cursor.execute("drop table if exists %s;" % name)
+    cursor.execute(table.create_sql(name, redshift=loader.is_redshift(cursor)))
+
+
+def ensure(loader, cursor, table):
+    """Makes a table exist with its declared layout, without committing.
+
+    A table with another layout is copied into a new one, keeping the
+    columns both have, which is swapped in and analyzed after the commit.
+    """
+
+    layout = describe(loader, cursor, table.name)
+    if layout is None:
+        print("Creating table %s" % table.name)
+        create(loader, cursor, table)
+        return
+    if layout == table.layout(loader.is_redshift(cursor)):
+        return
+
+    print("Rebuilding %s with its declared columns and keys" % table.name)
+    existing = set(row[0] for row in layout)
+    columns = ', '.join(column.name for column in table.columns if column.name in existing)
+    with metrics.stage('migrate', table=table.name):
+        create(loader, cursor, table, '%s_new' % table.name)
+        cursor.execute("insert into %s_new (%s) select %s from %s;" % (table.name, columns, columns, table.name))
+        loader.swap(cursor, table.name, '%s_new' % table.name)
+    loader.maintain(table.name)
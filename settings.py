@@ -0,0 +1,81 @@
+"""Credentials and view settings from conf2.ini, read once on first use.
+
+The file is parsed the first time a value is asked for and kept for the rest
+of the run, so --help, or importing one pull script from another, needs
+neither the file nor all of its sections. The sections read are:
+
+  [AWS Credentials]
+  key = ...
+  secret = ...
+
+  [Redshift Creds]
+  host = ...
+  port = 5439
+  user = ...
+  password = ...
+
+  [GA Profiles]
+  Android = 12345678
+
+  [GA Reporting]
+  api = v4
+"""
+from __future__ import print_function
+
+import functools
+
+CONFIG_FILE = 'conf2.ini'
+
+_MISSING = object()
+
+
+@functools.lru_cache(maxsize=None)
+def config():
+    """Returns the parsed conf2.ini."""
+
+    import configparser
+
+    parser = configparser.ConfigParser()
+    parser.read(CONFIG_FILE)
+    return parser
+
+
+def get(section, option, fallback=_MISSING):
+    """Returns a value of conf2.ini.
+
+    Raises:
+      configparser.Error: the value is not set and no fallback was given.
+    """
+
+    if fallback is _MISSING:
+        return config().get(section, option)
+    return config().get(section, option, fallback=fallback)
+
+
+def aws_credentials():
+    """Returns the (access key, secret key) Redshift and S3 are accessed with."""
+
+    return get('AWS Credentials', 'key'), get('AWS Credentials', 'secret')
+
+
+def redshift_dsn():
+    """Returns the psycopg2 connection string of the cluster, and the same without the password for logs."""
+
+    def dsn(password):
+        return "dbname=%s port=%s user=%s password=%s host=%s" % (
+            get('Redshift Creds', 'user'), get('Redshift Creds', 'port'), get('Redshift Creds', 'user'), password,
+            get('Redshift Creds', 'host'))
+
+    return dsn(get('Redshift Creds', 'password')), dsn('****')
+
+
+def reporting_api():
+    """Returns the reporting API the pulls query, 'v3' unless [GA Reporting] says otherwise."""
+
+    return get('GA Reporting', 'api', fallback='v3').strip().lower()
+
+
+def ga_profile(name):
+    """Returns the view ID or name pinned for name in [GA Profiles], or None."""
+
+    return get('GA Profiles', name, fallback=None)
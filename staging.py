@@ -0,0 +1,345 @@
+"""Formats the pull scripts can stage rows in before a Redshift COPY.
+
+Each format pairs a writer with the COPY clause that reads it back, so the two
+are always chosen together:
+
+  csv      plain delimited text, as the scripts always staged
+  gzip     delimited text compressed with gzip, COPY ... GZIP
+  zstd     delimited text compressed with zstandard, COPY ... ZSTD
+  parquet  columnar Parquet, COPY ... FORMAT AS PARQUET
+
+zstd and parquet need the zstandard and pyarrow packages, which are only
+imported when those formats are used.
+
+Text is written through a buffered writer, so the compressor or the upload
+sees large writes rather than one per row. EscapedRowWriter encodes each row
+straight to bytes and only escapes and sanitizes it cell by cell when the
+row is not plain ASCII or contains a character that needs escaping.
+
+open_parts() stages rows as several files of about the same size instead of
+one, so that a COPY of them keeps every slice of the cluster busy.
+
+read_rows() reads the rows of a staged text file back, for loads that don't
+go through COPY.
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import re
+
+import metrics
+
+FORMATS = ('csv', 'gzip', 'zstd', 'parquet')
+
+EXTENSIONS = {
+    'csv': '.csv',
+    'gzip': '.csv.gz',
+    'zstd': '.csv.zst',
+    'parquet': '.parquet',
+}
+
+# Rows buffered per Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# Bytes of text buffered before they are written out.
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Rows open_parts hands to one part before moving on to the next.
+PART_BLOCK_ROWS = 500
+
+# COPY options for text staged with escaped=True: tab delimited, backslash
+# escapes and \N for NULL, which is Redshift's default null string.
+ESCAPED_TEXT_OPTIONS = "delimiter as '\t' escape"
+
+# An escaped character, a delimiter or a run of plain text in escaped text.
+_ESCAPED_TOKENS = re.compile(r'\\(.)|([\t\n])|[^\\\t\n]+', re.S)
+
+
+def staging_name(name, fmt, part=None, parts=1):
+    """Returns the file name for name (without extension) in format fmt.
+
+    Part part of parts gets a suffix, unless there is only the one part.
+    """
+
+    if parts > 1:
+        name = '%s_part%02dof%02d' % (name, part + 1, parts)
+    return name + EXTENSIONS[fmt]
+
+
+def copy_options(fmt, text_options):
+    """Returns the COPY options that read files written in format fmt.
+
+    Args:
+      fmt: One of FORMATS.
+      text_options: The delimiter/quoting options used for the text formats,
+        e.g. "CSV" or "delimiter as '\\t'".
+    """
+
+    if fmt == 'parquet':
+        return 'FORMAT AS PARQUET'
+    if fmt == 'gzip':
+        return '%s GZIP' % text_options
+    if fmt == 'zstd':
+        return '%s ZSTD' % text_options
+    return text_options
+
+
+def part_count(value):
+    """Parses a --copy_parts flag, which has to be at least 1."""
+
+    parts = int(value)
+    if parts < 1:
+        raise argparse.ArgumentTypeError('%s is not a number of files, use 1 or more' % value)
+    return parts
+
+
+@contextlib.contextmanager
+def open_parts(open_part, parts, fmt, columns, escaped=False, **csv_options):
+    """Yields a writer that stages rows in format fmt as up to parts files.
+
+    Rows are handed to the parts in turn, PART_BLOCK_ROWS at a time, so the
+    parts come out about the same size. A part is only opened once it gets
+    rows, so few rows make fewer files. The files are committed if the block
+    exits cleanly and aborted otherwise. The block is timed as a 'serialize'
+    metrics stage, with the bytes written; callers add the rows.
+
+    Args:
+      open_part: Called with a part number from 0 to parts - 1, returns a
+        binary file from store.open(key).
+      parts: The largest number of files.
+      fmt: One of FORMATS.
+      columns: List of (name, type) pairs, type being 'string', 'int',
+        'bigint' or 'date' (an ISO date string). Only Parquet uses the types.
+      escaped: Write the text formats with EscapedRowWriter instead of
+        csv.writer, so None values load as NULL with ESCAPED_TEXT_OPTIONS.
+      **csv_options: Passed on to csv.writer for the text formats.
+    """
+
+    raws = []
+    try:
+        with metrics.stage('serialize', format=fmt):
+            with contextlib.ExitStack() as stack:
+                def open_writer(part):
+                    raws.append(open_part(part))
+                    return stack.enter_context(_writer(raws[-1], fmt, columns, escaped, csv_options))
+
+                yield PartedRowWriter(open_writer, parts)
+            metrics.add(bytes=sum(raw.tell() for raw in raws))
+    except BaseException:
+        for raw in raws:
+            raw.abort()
+        raise
+    for raw in raws:
+        raw.close()
+
+
+@contextlib.contextmanager
+def _writer(raw, fmt, columns, escaped, csv_options):
+    """Yields the row writer of one file, and flushes it when the block exits cleanly."""
+
+    if fmt == 'parquet':
+        writer = ParquetRowWriter(raw, columns)
+        yield writer
+        writer.close()
+        return
+
+    if fmt == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='wb')
+    elif fmt == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    else:
+        stream = raw
+    buffered = io.BufferedWriter(stream, WRITE_BUFFER_SIZE)
+    if escaped:
+        yield EscapedRowWriter(buffered)
+    else:
+        # Characters that can not be encoded are dropped, which is how the
+        # scripts have always sanitized GA values.
+        text = io.TextIOWrapper(buffered, encoding='ascii', errors='ignore', newline='')
+        yield csv.writer(text, **csv_options)
+        text.flush()
+        text.detach()
+    buffered.flush()
+    buffered.detach()
+    if stream is not raw:
+        stream.close()
+
+
+def escaped_lines(rows):
+    """Yields rows as tab delimited ASCII lines for COPY ... ESCAPE, with None as \\N.
+
+    Args:
+      rows: Iterable of rows, whose cells are str, None or anything that
+        formats with '%s'.
+    """
+
+    escapes = EscapedRowWriter.ESCAPES
+    for row in rows:
+        line = '\t'.join(['\\N' if cell is None else cell if cell.__class__ is str else '%s' % cell
+                          for cell in row])
+        # Fast path: nothing to escape or drop. Every tab is a delimiter and
+        # every backslash belongs to a \N.
+        if (line.isascii() and line.count('\t') == len(row) - 1 and '\n' not in line and '\r' not in line and
+                line.count('\\') == row.count(None)):
+            yield line.encode('ascii') + b'\n'
+        else:
+            line = '\t'.join(['\\N' if cell is None else ('%s' % cell).translate(escapes) for cell in row])
+            # Characters that can not be encoded are dropped, which is how the
+            # scripts have always sanitized GA values.
+            yield line.encode('ascii', 'ignore') + b'\n'
+
+
+def escaped_rows(text):
+    """Yields the rows of text written by escaped_lines, as lists of str with None for \\N."""
+
+    row = []
+    cell = []
+    null = False
+    for match in _ESCAPED_TOKENS.finditer(text):
+        escaped, delimiter = match.group(1), match.group(2)
+        if delimiter:
+            row.append(None if null else ''.join(cell))
+            cell = []
+            null = False
+            if delimiter == '\n':
+                yield row
+                row = []
+        elif escaped == 'N' and not cell:
+            null = True
+        elif escaped is not None:
+            cell.append(escaped)
+        else:
+            cell.append(match.group())
+
+
+def read_rows(raw, fmt, escaped=False, **csv_options):
+    """Returns an iterable of the rows of a staged text file, as lists of str.
+
+    The file is read whole; staged files are one day's page or one part of
+    a platform's history.
+
+    Args:
+      raw: A binary file from store.read(key).
+      fmt: One of FORMATS but parquet, which is read by whatever loads it.
+      escaped: The file was written with escaped=True; NULLs come back as None.
+      **csv_options: Passed on to csv.reader otherwise.
+    """
+
+    if fmt == 'parquet':
+        raise ValueError('Parquet files are not read row by row')
+    if fmt == 'gzip':
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif fmt == 'zstd':
+        import zstandard
+        raw = zstandard.ZstdDecompressor().stream_reader(raw)
+    text = raw.read().decode('ascii')
+    if escaped:
+        return escaped_rows(text)
+    return csv.reader(io.StringIO(text, newline=''), **csv_options)
+
+
+class EscapedRowWriter(object):
+    """Writes tab delimited rows for COPY ... ESCAPE, with None as \\N.
+
+    Args:
+      stream: A binary file, ideally buffered.
+    """
+
+    ESCAPES = {ord('\\'): '\\\\', ord('\t'): '\\\t', ord('\n'): '\\\n', ord('\r'): '\\\r'}
+
+    def __init__(self, stream):
+        self._write = stream.write
+
+    def writerow(self, row):
+        for line in escaped_lines((row,)):
+            self._write(line)
+
+    def writerows(self, rows):
+        write = self._write
+        for line in escaped_lines(rows):
+            write(line)
+
+
+class PartedRowWriter(object):
+    """Hands rows to several writers in turn, opening each on first use.
+
+    Args:
+      open_writer: Called with a part number, returns that part's writer.
+      parts: The number of parts.
+    """
+
+    def __init__(self, open_writer, parts):
+        self._open_writer = open_writer
+        self._parts = parts
+        self._writers = {}
+        self._part = 0
+        self._written = 0
+
+    def writerow(self, row):
+        self.writerows((row,))
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        while True:
+            block = list(itertools.islice(rows, PART_BLOCK_ROWS - self._written))
+            if not block:
+                return
+            writer = self._writers.get(self._part)
+            if writer is None:
+                writer = self._writers[self._part] = self._open_writer(self._part)
+            writer.writerows(block)
+            self._written = self._written + len(block)
+            if self._written == PART_BLOCK_ROWS:
+                self._part = (self._part + 1) % self._parts
+                self._written = 0
+
+
+class ParquetRowWriter(object):
+    """Buffers rows and writes them to a Parquet file one row group at a time."""
+
+    def __init__(self, raw, columns):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+        types = {'string': pyarrow.string(), 'int': pyarrow.int32(), 'bigint': pyarrow.int64(),
+                 'date': pyarrow.date32()}
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(raw, self.schema, compression='snappy')
+        self._rows = []
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _flush(self):
+        if not self._rows:
+            return
+        arrays = []
+        for index, (_, kind) in enumerate(self.columns):
+            values = [row[index] for row in self._rows]
+            if kind == 'date':
+                values = [None if value in (None, '') else datetime.date(*map(int, value.split('-')))
+                          for value in values]
+            elif kind != 'string':
+                values = [None if value in (None, '') else int(value) for value in values]
+            arrays.append(self._pa.array(values, type=self.schema.field(index).type))
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self.schema))
+        self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+import dag
+from dag import FAILED, OK, SKIPPED, TIMEOUT, Job
+
+
+def test_dependencies_get_the_values_of_theirs():
+    results = dag.run([
+        Job('load', lambda inputs: inputs['web'] + inputs['mau'], deps=('web', 'mau')),
+        Job('web', lambda inputs: 2),
+        Job('mau', lambda inputs: 3),
+    ])
+
+    assert dict((name, result.status) for name, result in results.items()) == {'web': OK, 'mau': OK, 'load': OK}
+    assert results['load'].value == 5
+    assert dag.print_summary(results)
+
+
+def test_independent_jobs_run_side_by_side():
+    both_started = threading.Barrier(2, timeout=5)
+    results = dag.run([Job('web', lambda inputs: both_started.wait()),
+                       Job('mau', lambda inputs: both_started.wait())])
+
+    assert results['web'].status == results['mau'].status == OK
+
+
+def fail(inputs):
+    raise RuntimeError('GA is down')
+
+
+def test_dependents_of_a_failed_job_are_skipped():
+    results = dag.run([
+        Job('web', fail),
+        Job('mau', lambda inputs: 3),
+        Job('load', lambda inputs: None, deps=('web', 'mau')),
+        Job('report', lambda inputs: None, deps=('load',)),
+    ])
+
+    assert results['web'].status == FAILED
+    assert str(results['web'].error) == 'GA is down'
+    assert results['mau'].status == OK
+    assert results['load'].status == SKIPPED
+    assert results['report'].status == SKIPPED
+    assert not dag.print_summary(results)
+
+
+def test_a_job_past_its_timeout_is_abandoned():
+    release = threading.Event()
+    try:
+        results = dag.run([
+            Job('web', lambda inputs: release.wait(5), timeout=0.05),
+            Job('mau', lambda inputs: 3, timeout=5),
+            Job('load', lambda inputs: None, deps=('web', 'mau')),
+        ])
+    finally:
+        release.set()
+
+    assert results['web'].status == TIMEOUT
+    assert results['web'].seconds < 5
+    assert results['mau'].status == OK
+    assert results['load'].status == SKIPPED
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        dag.run([Job('load', lambda inputs: None, deps=('web',))])
+
+
+def test_cycle():
+    with pytest.raises(ValueError):
+        dag.run([Job('a', lambda inputs: None, deps=('b',)), Job('b', lambda inputs: None, deps=('a',))])
@@ -0,0 +1,72 @@
+from datetime import date, timedelta
+
+from ga_planner import VolumeHistory, plan_ranges, should_split, split_range
+
+
+def days(first, count):
+    return [first + timedelta(days=offset) for offset in range(count)]
+
+
+def history_of(tmp_path, rows):
+    history = VolumeHistory(str(tmp_path / 'volumes.json'))
+    history.record(rows)
+    return history
+
+
+def test_days_without_volumes_get_ranges_of_their_own(tmp_path):
+    may = days(date(2016, 5, 1), 3)
+
+    assert plan_ranges(may, history_of(tmp_path, {})) == [(day, day) for day in may]
+
+
+def test_quiet_days_are_merged_up_to_the_target(tmp_path):
+    may = days(date(2016, 5, 1), 5)
+    history = history_of(tmp_path, dict((day, 400) for day in may))
+
+    assert plan_ranges(may, history, target_rows=1000) == [(may[0], may[1]), (may[2], may[3]), (may[4], may[4])]
+
+
+def test_unknown_days_and_gaps_break_ranges(tmp_path):
+    may = days(date(2016, 5, 1), 6)
+    history = history_of(tmp_path, dict((day, 10) for day in may if day != may[2]))
+    pending = [day for day in may if day != may[4]]
+
+    assert plan_ranges(pending, history) == [(may[0], may[1]), (may[2], may[2]), (may[3], may[3]), (may[5], may[5])]
+
+
+def test_ranges_stay_within_max_days(tmp_path):
+    may = days(date(2016, 5, 1), 7)
+    history = history_of(tmp_path, dict((day, 0) for day in may))
+
+    assert plan_ranges(may, history, max_days=3) == [(may[0], may[2]), (may[3], may[5]), (may[6], may[6])]
+
+
+def test_history_is_saved(tmp_path):
+    history_of(tmp_path, {date(2016, 5, 1): 12})
+
+    assert VolumeHistory(str(tmp_path / 'volumes.json')).get(date(2016, 5, 1)) == 12
+    assert VolumeHistory(str(tmp_path / 'volumes.json')).get(date(2016, 5, 2)) is None
+
+
+def test_should_split():
+    first, last = date(2016, 5, 1), date(2016, 5, 4)
+
+    assert not should_split(first, last, {'totalResults': 100}, split_rows=100)
+    assert should_split(first, last, {'totalResults': 101}, split_rows=100)
+    assert should_split(first, last, {'totalResults': 1, 'containsSampledData': True})
+    assert not should_split(first, last, {})
+
+
+def test_single_days_are_never_split():
+    day = date(2016, 5, 1)
+
+    assert not should_split(day, day, {'totalResults': 10 ** 6, 'containsSampledData': True}, split_rows=100)
+
+
+def test_split_range():
+    assert split_range(date(2016, 5, 1), date(2016, 5, 4)) == (
+        (date(2016, 5, 1), date(2016, 5, 2)), (date(2016, 5, 3), date(2016, 5, 4)))
+    assert split_range(date(2016, 5, 1), date(2016, 5, 3)) == (
+        (date(2016, 5, 1), date(2016, 5, 2)), (date(2016, 5, 3), date(2016, 5, 3)))
+    assert split_range(date(2016, 5, 1), date(2016, 5, 2)) == (
+        (date(2016, 5, 1), date(2016, 5, 1)), (date(2016, 5, 2), date(2016, 5, 2)))
@@ -0,0 +1,111 @@
+import copy
+import json
+import os
+from datetime import date
+
+import pytest
+
+import ga_reporting
+from ga_reporting import ReportingV4, v3_response
+from ga_stream import page_rows
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+def query(backend, start_index=None, first=date(2016, 5, 1), last=date(2016, 5, 2), profile_id='1234'):
+    return backend.query(profile_id, first, last, metrics='ga:users', dimensions='ga:date,ga:dimension2',
+                         sort='ga:date', start_index=start_index)
+
+
+def test_start_index_becomes_a_row_offset_page_token():
+    backend = ReportingV4(None, page_size=3)
+
+    assert 'pageToken' not in query(backend)
+    assert 'pageToken' not in query(backend, start_index=1)
+    assert query(backend, start_index=4)['pageToken'] == '3'
+    assert query(backend, start_index=100001)['pageToken'] == '100000'
+    assert query(backend)['pageSize'] == 3
+
+
+def test_first_page():
+    report = fixture('v4_batch_get.json')['reports'][0]
+
+    assert v3_response(report, query(ReportingV4(None))) == {
+        'rows': [['20160501', '17', '2'], ['20160501', '23', '1'], ['20160502', '17', '4']],
+        'totalResults': 7,
+        'itemsPerPage': 3,
+        'nextLink': '3',
+        'containsSampledData': True,
+        'profileInfo': {'profileId': '1234', 'profileName': 'view 1234'},
+    }
+
+
+def test_next_page_counts_items_from_its_own_offset():
+    report = fixture('v4_batch_get.json')['reports'][1]
+    response = v3_response(report, query(ReportingV4(None), start_index=6))
+
+    assert response['rows'] == [['20160502', '31', '1']]
+    assert response['itemsPerPage'] == 1
+    assert response['nextLink'] == '6'
+    assert response['containsSampledData'] is False
+
+
+def test_report_without_rows():
+    report = fixture('v4_batch_get_empty.json')['reports'][0]
+    response = v3_response(report, query(ReportingV4(None)))
+
+    assert 'rows' not in response
+    assert 'nextLink' not in response
+    assert response['totalResults'] == 0
+    assert response['itemsPerPage'] == 0
+    assert page_rows(response) == []
+
+
+def test_page_token_that_is_not_an_offset():
+    report = fixture('v4_batch_get.json')['reports'][0]
+    report['nextPageToken'] = 'CAESAggB'
+
+    with pytest.raises(ValueError):
+        v3_response(report, query(ReportingV4(None)))
+
+
+class FakeReports(object):
+
+    def batchGet(self, body):
+        return body
+
+
+class FakeService(object):
+
+    def reports(self):
+        return FakeReports()
+
+
+def test_execute_packs_reports_sharing_view_and_dates(monkeypatch):
+    sent = []
+
+    def execute_batch(service, requests, limiter=None, cache=None):
+        sent.extend(requests.values())
+        recorded = fixture('v4_batch_get.json')['reports'][0]
+        return dict((chunk, {'reports': [copy.deepcopy(recorded) for _ in chunk]}) for chunk in requests)
+
+    monkeypatch.setattr(ga_reporting, 'execute_batch', execute_batch)
+    backend = ReportingV4(FakeService())
+    reports = dict(('page %s' % index, query(backend, start_index=index * 3 + 1)) for index in range(6))
+    reports['other days'] = query(backend, first=date(2016, 5, 3), last=date(2016, 5, 3))
+    reports['other view'] = query(backend, profile_id='5678')
+    responses = backend.execute(reports)
+
+    assert sorted(len(body['reportRequests']) for body in sent) == [1, 1, 1, 5]
+    for body in sent:
+        shared = [dict((name, report.get(name)) for name in ga_reporting.V4_SHARED_FIELDS)
+                  for report in body['reportRequests']]
+        assert all(fields == shared[0] for fields in shared)
+    assert sorted(responses) == sorted(reports)
+    assert responses['other view']['profileInfo']['profileId'] == '5678'
+    assert responses['page 0']['itemsPerPage'] == 3
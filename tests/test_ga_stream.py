@@ -0,0 +1,126 @@
+import json
+
+import pytest
+
+from ga_stream import StreamedPage, page_rows, stream_response
+
+
+def page(body):
+    return StreamedPage(json.dumps(body))
+
+
+def test_members_before_and_after_rows():
+    streamed = page({'kind': 'analytics#gaData', 'rows': [['20160501', '3'], ['20160502', '4']],
+                     'totalResults': 2, 'nextLink': 'next'})
+
+    assert streamed.get('kind') == 'analytics#gaData'
+    assert streamed.get('totalResults') == 2
+    assert streamed.get('nextLink') == 'next'
+    assert streamed.get('missing', 'default') == 'default'
+    assert list(streamed.iter_rows()) == [['20160501', '3'], ['20160502', '4']]
+
+
+def test_rows_first_then_members():
+    streamed = page({'rows': [['a']], 'totalResults': 1})
+
+    assert list(streamed.iter_rows()) == [['a']]
+    assert streamed.get('totalResults') == 1
+
+
+def test_brackets_and_escaped_quotes_inside_strings():
+    rows = [['say "hi"]', '[not', 'an ] array'], ['back\\slash\\"', 'été', '{"x": [1]}']]
+    streamed = page({'rows': rows, 'note': 'after ] the [ rows "quoted"'})
+
+    assert streamed.get('note') == 'after ] the [ rows "quoted"'
+    assert list(streamed.iter_rows()) == rows
+
+
+def test_whitespace_between_tokens():
+    streamed = StreamedPage('\n { "rows" : [ [ "a" , "1" ] ,\n [ "b" , "2" ] ] ,\t"totalResults" : 2 }\n')
+
+    assert streamed.get('totalResults') == 2
+    assert list(streamed.iter_rows()) == [['a', '1'], ['b', '2']]
+
+
+def test_no_rows():
+    streamed = page({'kind': 'analytics#gaData', 'totalResults': 0})
+
+    assert list(streamed.iter_rows()) == []
+    assert list(page_rows(streamed)) == []
+    assert streamed.get('totalResults') == 0
+
+
+def test_empty_rows():
+    streamed = page({'rows': [], 'totalResults': 0})
+
+    assert list(streamed.iter_rows()) == []
+    assert streamed.get('totalResults') == 0
+
+
+def test_rows_only_through_iter_rows():
+    with pytest.raises(KeyError):
+        page({'rows': [['a']]}).get('rows')
+
+
+def test_page_rows_of_decoded_response():
+    assert page_rows({'rows': [['a']]}) == [['a']]
+    assert page_rows({}) == []
+
+
+def test_body_that_is_not_an_object():
+    with pytest.raises(ValueError):
+        StreamedPage('[1, 2]').get('kind')
+
+
+def test_truncated_rows():
+    streamed = StreamedPage('{"rows": [["a"], ["b"')
+
+    with pytest.raises(ValueError):
+        streamed.get('totalResults')
+
+
+class FakeResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.calls = []
+        self.postproc = self.decode
+
+    def decode(self, resp, content):
+        self.calls.append((resp.status, content))
+        if resp.status >= 300:
+            raise RuntimeError('HTTP %s' % resp.status)
+        return json.loads(content)
+
+
+def test_stream_response_returns_streamed_page():
+    request = stream_response(FakeRequest())
+    streamed = request.postproc(FakeResponse(200), b'{"rows": [["a"]], "totalResults": 1}')
+
+    assert isinstance(streamed, StreamedPage)
+    assert streamed.get('totalResults') == 1
+    assert list(streamed.iter_rows()) == [['a']]
+    assert request.calls == []
+
+
+def test_stream_response_leaves_error_bodies_to_the_client():
+    request = stream_response(FakeRequest())
+    body = b'{"error": {"code": 403, "message": "User Rate Limit Exceeded"}}'
+
+    with pytest.raises(RuntimeError):
+        request.postproc(FakeResponse(403), body)
+    assert request.calls == [(403, body)]
+
+
+def test_stream_response_leaves_empty_bodies_to_the_client():
+    request = FakeRequest()
+    request.decode = lambda resp, content: {}
+    request.postproc = request.decode
+    stream_response(request)
+
+    assert request.postproc(FakeResponse(204), b'') == {}
@@ -0,0 +1,81 @@
+import json
+from datetime import date, timedelta
+
+from ga_planner import VolumeHistory
+from manifest import Manifest
+from object_store import LocalStore
+from Web_Channel_Attribution import FIRST_DAY, PREFIX, pending_ranges
+
+MAY_1, MAY_2, MAY_3, MAY_4 = [date(2016, 5, day) for day in (1, 2, 3, 4)]
+
+
+def manifest_at(tmp_path):
+    return Manifest(str(tmp_path / 'manifest.json'), LocalStore(str(tmp_path / 'store')), PREFIX).load()
+
+
+def reloaded(manifest):
+    return Manifest(manifest.path, None, PREFIX).load()
+
+
+def test_checkpoint_and_resume_point(tmp_path):
+    manifest = manifest_at(tmp_path)
+    manifest.checkpoint(MAY_1, MAY_3, 10001, {MAY_1: {'a.csv': 'etag-a'}}, {MAY_1: 9000})
+
+    expected = {'next_index': 10001, 'files': {'2016-05-01': {'a.csv': 'etag-a'}}, 'rows': {'2016-05-01': 9000}}
+    assert manifest.resume_point(MAY_1, MAY_3) == expected
+    assert reloaded(manifest).resume_point(MAY_1, MAY_3) == expected
+    assert manifest.resume_point(MAY_1, MAY_2) is None
+
+    manifest.checkpoint(MAY_1, MAY_3)
+    assert manifest.resume_point(MAY_1, MAY_3) is None
+    assert reloaded(manifest).partial == {}
+
+
+def test_unloaded_per_sink(tmp_path):
+    manifest = manifest_at(tmp_path)
+    manifest.days['2016-05-01'] = {'pages': 1, 'files': {'a.csv': 'etag-a'}}
+    manifest.record(MAY_2, {'b.csv': 'etag-b'})
+    manifest.record(MAY_3, {'c.csv': 'etag-c'})
+
+    # Days recorded before the loaded flag existed were loaded into Redshift.
+    assert manifest.unloaded() == ['2016-05-02', '2016-05-03']
+    assert manifest.unloaded('local') == ['2016-05-01', '2016-05-02', '2016-05-03']
+
+    manifest.mark_loaded([MAY_2])
+    manifest.mark_loaded(sink='local')
+    assert reloaded(manifest).unloaded() == ['2016-05-03']
+    assert reloaded(manifest).unloaded('local') == []
+    assert manifest.keys([MAY_2, MAY_4]) == [PREFIX + '2016-05-02/b.csv']
+
+
+def test_manifest_written_before_checkpoints(tmp_path):
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps({'2016-05-01': {'pages': 1, 'files': {'a.csv': 'etag-a'}}}))
+    manifest = Manifest(str(path), None, PREFIX).load()
+
+    assert MAY_1 in manifest
+    assert manifest.partial == {}
+    assert manifest.unloaded() == []
+
+
+def test_pending_ranges_skip_uploaded_days_and_resume_checkpoints(tmp_path):
+    manifest = manifest_at(tmp_path)
+    manifest.record(MAY_1, {'a.csv': 'etag-a'})
+    # The second half of a range that was split, stopped after its first page.
+    manifest.checkpoint(MAY_3, MAY_4, 10001, {MAY_3: {'c.csv': 'etag-c'}}, {MAY_3: 10000})
+    ranges, resumed = pending_ranges(manifest, VolumeHistory(str(tmp_path / 'volumes.json')), 10000, quiet=True)
+
+    assert resumed == [(MAY_3, MAY_4)]
+    assert ranges[:3] == [(MAY_2, MAY_2), (MAY_3, MAY_4), (date(2016, 5, 5), date(2016, 5, 5))]
+    assert ranges[-1] == (date.today() - timedelta(days=1),) * 2
+    assert sum((last - first).days + 1 for first, last in ranges) == (date.today() - FIRST_DAY).days - 1
+
+
+def test_pending_ranges_drop_checkpoints_of_uploaded_days(tmp_path):
+    manifest = manifest_at(tmp_path)
+    manifest.record(MAY_2, {'b.csv': 'etag-b'})
+    manifest.checkpoint(MAY_1, MAY_2, 10001, {MAY_1: {'a.csv': 'etag-a'}}, {MAY_1: 10000})
+    ranges, resumed = pending_ranges(manifest, VolumeHistory(str(tmp_path / 'volumes.json')), 10000, quiet=True)
+
+    assert resumed == []
+    assert ranges[0] == (MAY_1, MAY_1)
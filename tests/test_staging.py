@@ -0,0 +1,57 @@
+import io
+
+from staging import EscapedRowWriter, escaped_lines, escaped_rows
+
+
+def round_trip(rows):
+    return list(escaped_rows(b''.join(escaped_lines(rows)).decode('ascii')))
+
+
+def test_plain_rows_take_the_fast_path():
+    assert list(escaped_lines([['2016-05-01', 'google', None, 42]])) == [b'2016-05-01\tgoogle\t\\N\t42\n']
+    assert round_trip([['2016-05-01', 'google', None, '42']]) == [['2016-05-01', 'google', None, '42']]
+
+
+def test_tab_newline_and_carriage_return():
+    rows = [['a\tb', 'line\nbreak', 'cr\rlf']]
+
+    assert list(escaped_lines(rows)) == [b'a\\\tb\tline\\\nbreak\tcr\\\rlf\n']
+    assert round_trip(rows) == rows
+
+
+def test_backslash():
+    rows = [['C:\\path\\', '\\\\', 'end\\']]
+
+    assert round_trip(rows) == rows
+
+
+def test_none_and_the_string_backslash_n():
+    rows = [[None, '\\N', '', None]]
+
+    assert list(escaped_lines(rows)) == [b'\\N\t\\\\N\t\t\\N\n']
+    assert round_trip(rows) == rows
+
+
+def test_non_ascii_is_dropped():
+    assert list(escaped_lines([['caf\u00e9', '\u65e5\u672c', 'ok']])) == [b'caf\t\tok\n']
+    assert round_trip([['caf\u00e9\tau lait', 'x']]) == [['caf\tau lait', 'x']]
+
+
+def test_non_string_cells_are_formatted():
+    assert round_trip([[1, 2.5, None]]) == [['1', '2.5', None]]
+
+
+def test_several_rows():
+    rows = [['a', None], ['b\n', 'c\\'], ['', 'd']]
+
+    assert round_trip(rows) == rows
+
+
+def test_writer_matches_escaped_lines():
+    rows = [['a\tb', None], ['plain', 'row']]
+    stream = io.BytesIO()
+    writer = EscapedRowWriter(stream)
+    writer.writerow(rows[0])
+    writer.writerows(rows[1:])
+
+    assert stream.getvalue() == b''.join(escaped_lines(rows))
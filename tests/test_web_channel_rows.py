@@ -0,0 +1,70 @@
+import csv
+import os
+from datetime import date
+
+import pytest
+
+from manifest import Manifest
+from object_store import LocalStore
+from staging import read_rows
+from Web_Channel_Attribution import OLD_PREFIX, PREFIX, migrate_v1, normalize_row, split_source_medium
+
+
+@pytest.mark.parametrize('source_medium, expected', [
+    ('google / organic', ('google', 'organic')),
+    # Split like the old regexp_substr SQL: the source up to the last '/',
+    # the medium from the first one.
+    ('a/b / c', ('a/b', '/b c')),
+    ('(direct) / (none)', ('(direct)', '(none)')),
+    ('google', ('', '')),
+    ('(not set) / (not set)', ('(not set)', None)),
+])
+def test_split_source_medium(source_medium, expected):
+    assert split_source_medium(source_medium) == expected
+
+
+def row(**cells):
+    values = {'date': '20160501', 'channel': 'Organic Search', 'source_medium': 'google / organic',
+              'campaign': 'spring', 'social_network': 'Facebook', 'keyword': 'shoes', 'uid': '42', 'users': '3'}
+    values.update(cells)
+    return [values[name] for name in ('date', 'channel', 'source_medium', 'campaign', 'social_network',
+                                      'keyword', 'uid', 'users')]
+
+
+def test_normalize_row():
+    assert normalize_row(row()) == ['2016-05-01', 'google', 'organic', 'spring', 'Facebook', 'shoes', '42']
+
+
+@pytest.mark.parametrize('column, index', [('campaign', 3), ('social_network', 4), ('keyword', 5)])
+def test_not_set_becomes_none(column, index):
+    normalized = normalize_row(row(**{column: '(not set)'}))
+
+    assert normalized[index] is None
+    assert [value for i, value in enumerate(normalized) if i != index] == \
+        [value for i, value in enumerate(normalize_row(row())) if i != index]
+
+
+def test_not_set_medium_becomes_none_but_source_is_kept():
+    assert normalize_row(row(source_medium='(not set) / (not set)'))[1:3] == ['(not set)', None]
+
+
+def write_old(store, day, rows):
+    path = store.url('%s%s/Web_Channel_Attribution_%s_1.csv' % (OLD_PREFIX, day, day))
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w', newline='') as f:
+        csv.writer(f, delimiter='\t', quoting=csv.QUOTE_ALL).writerows(rows)
+
+
+def test_migrate_v1_keeps_each_files_own_day(tmp_path):
+    store = LocalStore(str(tmp_path / 'store'))
+    write_old(store, '2016-05-01', [row(), row(date='20160502', uid='7')])
+    write_old(store, '2016-05-02', [row(date='20160502', uid='7', keyword='(not set)'), row(date='20160503')])
+    manifest = Manifest(str(tmp_path / 'manifest.json'), store, PREFIX).load()
+
+    assert migrate_v1(store, manifest, 'csv') == [date(2016, 5, 1), date(2016, 5, 2)]
+    assert manifest.unloaded() == ['2016-05-01', '2016-05-02']
+    assert [list(read_rows(store.read(key), 'csv', escaped=True)) for key in manifest.keys()] == [
+        [['2016-05-01', 'google', 'organic', 'spring', 'Facebook', 'shoes', '42']],
+        [['2016-05-02', 'google', 'organic', 'spring', 'Facebook', None, '7']],
+    ]
+    assert migrate_v1(store, manifest, 'csv') == []